@@ -1,4 +1,7 @@
 from django.contrib import admin
-from . models import SpotifyToken
+from . models import CatalogArtist, CatalogTrack, MusicBrainzArtist, SpotifyToken
 
-admin.site.register(SpotifyToken)
\ No newline at end of file
+admin.site.register(SpotifyToken)
+admin.site.register(MusicBrainzArtist)
+admin.site.register(CatalogTrack)
+admin.site.register(CatalogArtist)
\ No newline at end of file
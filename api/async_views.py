@@ -0,0 +1,479 @@
+import asyncio
+import json
+from functools import wraps
+
+import httpx
+from asgiref.sync import sync_to_async
+from django_ratelimit.core import is_ratelimited
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import JWTAuthentication
+from . import caching, catalog, musicbrainz, popularity, projection, streams, upstream
+from .paging import all_pages
+from .tokens import get_valid_token
+from .views import (
+    SPOTIFY_RATELIMIT, TRACK_NOT_FOUND_TIMEOUT, TRACK_STALE_TIMEOUT,
+    artist_parts, artist_profile_result, last_fm_params, last_fm_parts, ratelimit_error, track_result_timeout,
+    track_search_params, track_search_result, track_spotify_cache_key, user_parts,
+)
+
+
+# ─── Async proxy views ───────────────────────────────────────────────────────
+#
+# Same routes, cache keys and TTLs as the sync views in views.py, but the
+# upstream round trip is awaited instead of blocking a worker. Concurrent
+# misses on a key make one upstream call, as in the sync views, and stale
+# entries are served right away and refreshed by a task on the event loop.
+# api/urls.py
+# serves these when API_ASYNC_VIEWS is on, which spotify/asgi.py enables.
+
+
+def _authenticate(request):
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed as e:
+        return None, JsonResponse(e.detail, status=e.status_code, safe=False)
+    return (result[0] if result else None), None
+
+
+def _check_ratelimit(request):
+    return is_ratelimited(request=request, increment=True, **SPOTIFY_RATELIMIT)
+
+
+def async_spotify_auth_required(func):
+    @wraps(func)
+    async def wrapper(request, *args, **kwargs):
+        # In the order api_view and spotify_auth_required run them: a bad
+        # JWT is answered before the rate limit counts the request.
+        user, error = await sync_to_async(_authenticate)(request)
+        if error:
+            return error
+        if await sync_to_async(_check_ratelimit)(request):
+            return ratelimit_error(request, None)
+        if user is None:
+            return JsonResponse({'error': 'not_authenticated'}, status=401)
+        request.user = user
+
+        try:
+            access_token = await sync_to_async(get_valid_token)(user)
+            if not access_token:
+                return JsonResponse({'error': 'token_expired'}, status=401)
+
+            return await func(request, *args, access_token=access_token, **kwargs)
+        except httpx.HTTPError as e:
+            print(f"[upstream] {func.__name__} failed: {e!r}")
+            return JsonResponse({'error': 'upstream_unavailable'}, status=502)
+    return wrapper
+
+
+def _auth(access_token):
+    return {'Authorization': f'Bearer {access_token}'}
+
+
+async def _cached(cache_key, fresh, stale, compute):
+    """(entry, error), with `compute()` a coroutine returning (data, error); misses are coalesced."""
+    return await caching.acached_entry(cache_key, fresh, compute, stale)
+
+
+def _respond(request, entry, error):
+    """JSON for a cached entry, narrowed by `fields=`; a 304 if the client has it."""
+    if entry is None:
+        return JsonResponse(error, status=error['status'])
+
+    fields, fields_error = caching.requested_fields(request.GET)
+    if fields_error:
+        return JsonResponse(fields_error, status=400)
+
+    return caching.entry_response(request, entry, fields, render=lambda data: JsonResponse(data, safe=False))
+
+
+def _fetcher(url, error, keep=None, **kwargs):
+    """A coroutine compute() for _cached: GET `url`, trimmed to `keep`.
+
+    views.fetcher's counterpart; pass it as `fetch` to the views' parts builders.
+    """
+    async def fetch():
+        response = await upstream.aget(url, **kwargs)
+        if not response.is_success:
+            return None, {'error': error, 'status': response.status_code}
+        return projection.project(response.json(), keep), None
+    return fetch
+
+
+async def _cached_get(request, cache_key, fresh, stale, url, error, keep=None, **kwargs):
+    """`keep` trims what is cached; the request's `fields=` trims what is sent."""
+    return _respond(request, *await _cached(cache_key, fresh, stale, _fetcher(url, error, keep, **kwargs)))
+
+
+async def _cached_parts(parts, read=True):
+    """name: (data, error) for views' parts built with `fetch=_fetcher`, fetched concurrently.
+
+    With `read` false the parts are known misses and go straight to a fetch.
+    """
+    async def fetch(key, fresh, stale, compute):
+        try:
+            if read:
+                entry, error = await _cached(key, fresh, stale, compute)
+            else:
+                entry, error = await caching.afetch_entry(key, fresh, compute, stale)
+        except httpx.HTTPError as e:
+            return None, {'error': str(e), 'status': 502}
+        return (entry.data if entry is not None else None), error
+
+    fetched = await asyncio.gather(*(fetch(*part) for part in parts.values()))
+    return dict(zip(parts, fetched))
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def me(request, access_token):
+    return await _cached_get(
+        request, f'me-{request.user.id}', 60*60*24, 60*60*24*7,
+        'https://api.spotify.com/v1/me',
+        'Failed to fetch profile',
+        headers=_auth(access_token),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def top_tracks(request, access_token):
+    time_range = request.GET.get("time_range", "medium_term")
+    return await _cached_get(
+        request, f'top-tracks-{request.user.id}-{time_range}', 60*30, 60*60*24,
+        'https://api.spotify.com/v1/me/top/tracks',
+        'Failed to fetch top tracks',
+        keep=projection.TOP_TRACKS,
+        headers=_auth(access_token),
+        params={"time_range": time_range, "limit": 50},
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def top_artists(request, access_token):
+    time_range = request.GET.get("time_range", "medium_term")
+    return await _cached_get(
+        request, f'top-artist-{request.user.id}-{time_range}', 60*60*24, 60*60*24*7,
+        'https://api.spotify.com/v1/me/top/artists',
+        'Failed to fetch top artists',
+        headers=_auth(access_token),
+        params={"time_range": time_range, "limit": 50, "fields": "items(id,name,images,genres,followers,popularity,external_urls,uri)"},
+    )
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@async_spotify_auth_required
+async def play_track(request, access_token):
+    try:
+        track_uri = json.loads(request.body or b'{}').get("track_uri")
+    except (ValueError, AttributeError):
+        track_uri = request.POST.get("track_uri")
+    if not track_uri:
+        return JsonResponse({'error': 'track_uri is required'}, status=400)
+
+    headers = _auth(access_token)
+    response = await upstream.aput(
+        "https://api.spotify.com/v1/me/player/play",
+        headers=headers,
+        json={"uris": [track_uri]},
+    )
+
+    # No active device — try to find one and retry
+    if response.status_code == 404:
+        devices_response = await upstream.aget("https://api.spotify.com/v1/me/player/devices", headers=headers)
+        devices = devices_response.json().get("devices", []) if devices_response.is_success else []
+        if not devices:
+            return JsonResponse({'error': 'no_device', 'message': 'No active Spotify device found'}, status=404)
+
+        device_id = devices[0]["id"]
+        await upstream.aput(
+            "https://api.spotify.com/v1/me/player",
+            headers=headers,
+            json={"device_ids": [device_id], "play": False},
+        )
+        response = await upstream.aput(
+            f"https://api.spotify.com/v1/me/player/play?device_id={device_id}",
+            headers=headers,
+            json={"uris": [track_uri]},
+        )
+
+    if response.status_code == 204:
+        return JsonResponse({"ok": True}, status=200)
+
+    if not response.is_success:
+        return JsonResponse({'error': 'Failed to play track', 'status': response.status_code}, status=response.status_code)
+
+    return JsonResponse(response.json(), safe=False)
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+@popularity.counted
+async def get_artist(request, access_token):
+    artist_id = request.GET.get('artist_id')
+    if not artist_id:
+        return JsonResponse({'error': 'artist_id is required'})
+
+    return await _cached_get(
+        request, f'artist-{artist_id}', 60*60*24, 60*60*24*7,
+        f'https://api.spotify.com/v1/artists/{artist_id}',
+        'Failed to fetch top artists',
+        headers=_auth(access_token),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+@all_pages('https://api.spotify.com/v1/me/playlists', 'Failed to fetch playlists', projection.PLAYLISTS)
+async def get_my_playlists(request, access_token):
+    return await _cached_get(
+        request, f'myplaylists-{request.user.id}', 60*60*24, 60*60*24,
+        'https://api.spotify.com/v1/me/playlists',
+        'Failed to fetch playlists',
+        keep=projection.PLAYLISTS,
+        headers=_auth(access_token),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+@all_pages('https://api.spotify.com/v1/artists/{artist_id}/albums', 'Failed to fetch albums')
+async def get_artist_albums(request, access_token):
+    artist_id = request.GET.get('artist_id')
+    return await _cached_get(
+        request, f'artist_albums-{artist_id}', 60*60*24, 60*60*24*7,
+        f"https://api.spotify.com/v1/artists/{artist_id}/albums",
+        'Failed to fetch playlists',
+        headers=_auth(access_token),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_artist_info_via_last_fm(request, access_token):
+    artist_name = request.GET.get('artist_name')
+    return await _cached_get(
+        request, f"artist-info-last-fm-{artist_name}", 60*60*24*3, 60*60*24*7,
+        "https://ws.audioscrobbler.com/2.0/",
+        'Failed to get artist info via last fm',
+        params=last_fm_params("artist.getInfo", artist_name),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_artist_top_tracks_via_last_fm(request, access_token):
+    artist_name = request.GET.get('artist_name')
+    return await _cached_get(
+        request, f"artist-top-tracks-last-fm-{artist_name}", 60*60*24*3, 60*60*24*7,
+        "https://ws.audioscrobbler.com/2.0/",
+        'Failed to get artist top tracks via last fm',
+        params=last_fm_params("artist.getTopTracks", artist_name),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_similar_artist_links(request, access_token):
+    artist_mbid = request.GET.get('artist_mbid')
+    if not artist_mbid:
+        return JsonResponse({"error": "artist_mbid is required"}, status=400)
+
+    async def fetch():
+        spotify_url = await musicbrainz.aspotify_url(artist_mbid, wait=settings.MUSICBRAINZ_WAIT)
+        if spotify_url is None:
+            return None, {"error": "Failed to fetch from MusicBrainz", "status": 503}
+        return {"spotify_url": spotify_url or None}, None
+
+    return _respond(request, *await _cached(f"artist-mbid-{artist_mbid}", 60*60*24*3, 60*60*24*30, fetch))
+
+
+# ─── Dashboard: everything the first render needs, in one round trip ──────
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def dashboard(request, access_token):
+    time_range = request.GET.get("time_range", "short_term")
+    parts = user_parts(request.user.id, access_token, time_range, fetch=_fetcher)
+    # The dashboard doesn't render playlists.
+    del parts['playlists']
+
+    cached = await sync_to_async(caching.read_many)([key for key, _, _, _ in parts.values()])
+    result = {}
+    for name, (key, fresh, stale, compute) in parts.items():
+        result[name], is_stale = cached.get(key, (None, False))
+        if is_stale:
+            caching.arefresh_in_background(key, fresh, compute, stale)
+    missing = {name: part for name, part in parts.items() if result[name] is None}
+
+    async def currently_playing():
+        try:
+            return await _currently_playing_part(access_token)
+        except httpx.HTTPError as e:
+            return None, {'error': str(e), 'status': 502}
+
+    fetched, fetched_playing = await asyncio.gather(_cached_parts(missing, read=False), currently_playing())
+    fetched['currently_playing'] = fetched_playing
+
+    errors = {}
+    for name, (data, error) in fetched.items():
+        result[name] = data
+        if error:
+            errors[name] = error
+
+    result['errors'] = errors
+    return JsonResponse(result)
+
+
+# ─── Artist page: Spotify artist + albums + Last.fm info + top tracks ──────
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+@popularity.counted
+async def artist_profile(request, access_token):
+    artist_id = request.GET.get('artist_id')
+    if not artist_id:
+        return JsonResponse({'error': 'artist_id is required'}, status=400)
+
+    # Optional: lets the Last.fm lookups start without waiting for the artist.
+    artist_name = request.GET.get('artist_name')
+
+    parts = artist_parts(artist_id, access_token, fetch=_fetcher)
+    if artist_name:
+        parts.update(last_fm_parts(artist_name, fetch=_fetcher))
+    fetched = await _cached_parts(parts)
+
+    if not artist_name:
+        artist, _ = fetched['artist']
+        if artist and artist.get('name'):
+            fetched.update(await _cached_parts(last_fm_parts(artist['name'], fetch=_fetcher)))
+
+    return JsonResponse(artist_profile_result(fetched, artist_name))
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_track_spotify_url(request, access_token):
+    artist_name = request.GET.get('artist')
+    track_name = request.GET.get('track')
+    if not artist_name or not track_name:
+        return JsonResponse({"error": "artist and track are required"}, status=400)
+
+    async def fetch():
+        stored = await sync_to_async(catalog.find_track)(artist_name, track_name, TRACK_NOT_FOUND_TIMEOUT)
+        if stored is not None:
+            return stored, None
+
+        response = await upstream.aget(
+            "https://api.spotify.com/v1/search",
+            headers=_auth(access_token),
+            params=track_search_params(artist_name, track_name),
+        )
+        if not response.is_success:
+            return None, {"error": "Failed to search Spotify", "status": response.status_code}
+
+        result = track_search_result(response.json())
+        await sync_to_async(catalog.store_tracks)({(artist_name, track_name): result})
+        return result, None
+
+    cache_key = track_spotify_cache_key(artist_name, track_name)
+    return _respond(request, *await _cached(cache_key, track_result_timeout, TRACK_STALE_TIMEOUT, fetch))
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_recently_played_tracks(request, access_token):
+    return await _cached_get(
+        request, f"{request.user.id}-recently-played-tracks", 60*5, 60*60,
+        "https://api.spotify.com/v1/me/player/recently-played",
+        'Failed to fetch recently played tracks',
+        keep=projection.RECENTLY_PLAYED,
+        headers=_auth(access_token),
+        params={'limit': 50},
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def call_next_api_url(request, access_token):
+    next_url = request.GET.get("next_url")
+    if not next_url:
+        return JsonResponse("error getting next url", safe=False)
+
+    return await _cached_get(
+        request, f"{request.user.id}-{next_url}", 60*10, 60*60,
+        next_url,
+        'Failed to fetch next url',
+        keep=projection.for_url(next_url),
+        headers=_auth(access_token),
+    )
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def search_item(request, access_token):
+    q = request.GET.get("q")
+    if not q:
+        return JsonResponse({"error": "q is required"}, status=400)
+
+    return await _cached_get(
+        request, f"search-{q}", 60*10, 60*60,
+        "https://api.spotify.com/v1/search",
+        'Failed to search',
+        keep=projection.SEARCH,
+        headers=_auth(access_token),
+        params={
+            "q": q,
+            "limit": 10,
+            "type": "album,playlist,track,artist,episode,show,audiobook",
+            "offset": 0,
+            "include_external": "audio",
+        },
+    )
+
+
+async def _currently_playing_part(access_token):
+    response = await upstream.aget(
+        "https://api.spotify.com/v1/me/player/currently-playing",
+        params={"additional_types": "track"},
+        headers=_auth(access_token),
+    )
+
+    if response.status_code == 204 or not response.content:
+        return {"is_playing": False}, None
+
+    if not response.is_success:
+        return None, {"error": "Failed to get currently playing", "status": response.status_code}
+
+    return response.json(), None
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def get_currently_playing(request, access_token):
+    data, error = await _currently_playing_part(access_token)
+    if error:
+        return JsonResponse(error, status=error["status"])
+
+    return JsonResponse(data, safe=False)
+
+
+@require_http_methods(["GET"])
+@async_spotify_auth_required
+async def currently_playing_stream(request, access_token):
+    """Server-Sent Events: the get_currently_playing payload, pushed only when it changes."""
+    response = StreamingHttpResponse(
+        streams.currently_playing_events(request.user),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,11 @@
+from rest_framework_simplejwt import authentication
+
+from . import timing
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+    """simplejwt's JWT authentication, timed as the request's `auth` phase."""
+
+    def authenticate(self, request):
+        with timing.phase('auth'):
+            return super().authenticate(request)
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import math
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# ─── Shared upstream budget ─────────────────────────────────────────────────
+#
+# Spotify limits each app over a rolling 30-second window and answers 429
+# with a Retry-After once it is exceeded; every worker that keeps calling
+# only makes the throttling last longer. So every call api/upstream.py makes
+# to a host in UPSTREAM_BUDGETS first takes a unit from buckets in the
+# shared cache: one for the whole app and one per access token, refilled
+# every `window` seconds. A 429 closes the host for every worker until its
+# Retry-After has passed. A bucket is an add() and an incr() on the shared
+# cache, so the count is only exact on an L2 that makes both atomic across
+# workers (see api/cache_backends.py).
+#
+# A call that would have to wait longer than UPSTREAM_BUDGET_MAX_WAIT is
+# answered with a local 429 instead of reaching the host. Cached responses
+# don't call upstream at all, and stale ones keep being served when their
+# background refresh gets that 429.
+
+_stats = {'calls': 0, 'waited': 0, 'throttled_locally': 0, 'upstream_429s': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _config(url):
+    host = urlsplit(url).netloc
+    return host, getattr(settings, 'UPSTREAM_BUDGETS', {}).get(host)
+
+
+def _max_wait():
+    return getattr(settings, 'UPSTREAM_BUDGET_MAX_WAIT', 2)
+
+
+def _token_id(headers):
+    auth = (headers or {}).get('Authorization')
+    return hashlib.sha1(auth.encode()).hexdigest()[:16] if auth else None
+
+
+def _blocked_key(host):
+    return f'budget-{host}-blocked'
+
+
+def _buckets(host, config, token):
+    """[(key, limit)] for the current window, and seconds until the next one."""
+    window = config.get('window', 30)
+    now = time.time()
+    n = int(now // window)
+    buckets = []
+    if token and config.get('token'):
+        buckets.append((f'budget-{host}-{token}-{n}', config['token']))
+    buckets.append((f'budget-{host}-app-{n}', config['app']))
+    return buckets, (n + 1) * window - now
+
+
+def _try(host, config, token):
+    """Take a unit from every bucket: 0, or how many seconds until that is possible."""
+    blocked_until = cache.get(_blocked_key(host))
+    if blocked_until and blocked_until > time.time():
+        return blocked_until - time.time()
+
+    buckets, reset = _buckets(host, config, token)
+    for key, limit in buckets:
+        cache.add(key, 0, timeout=math.ceil(reset) + 1)
+        try:
+            used = cache.incr(key)
+        except ValueError:      # expired between add() and incr()
+            cache.set(key, used := 1, timeout=math.ceil(reset) + 1)
+        if used > limit:
+            return reset
+    return 0
+
+
+async def _atry(host, config, token):
+    blocked_until = await cache.aget(_blocked_key(host))
+    if blocked_until and blocked_until > time.time():
+        return blocked_until - time.time()
+
+    buckets, reset = _buckets(host, config, token)
+    for key, limit in buckets:
+        await cache.aadd(key, 0, timeout=math.ceil(reset) + 1)
+        try:
+            used = await cache.aincr(key)
+        except ValueError:
+            await cache.aset(key, used := 1, timeout=math.ceil(reset) + 1)
+        if used > limit:
+            return reset
+    return 0
+
+
+def acquire(url, headers=None):
+    """0 once the call may go ahead, or the seconds it would still have to wait."""
+    host, config = _config(url)
+    if config is None:
+        return 0
+    _count('calls')
+    deadline = time.monotonic() + _max_wait()
+    while (delay := _try(host, config, _token_id(headers))) > 0:
+        if time.monotonic() + delay > deadline:
+            _count('throttled_locally')
+            return delay
+        _count('waited')
+        time.sleep(delay)
+    return 0
+
+
+async def aacquire(url, headers=None):
+    host, config = _config(url)
+    if config is None:
+        return 0
+    _count('calls')
+    deadline = time.monotonic() + _max_wait()
+    while (delay := await _atry(host, config, _token_id(headers))) > 0:
+        if time.monotonic() + delay > deadline:
+            _count('throttled_locally')
+            return delay
+        _count('waited')
+        await asyncio.sleep(delay)
+    return 0
+
+
+def _retry_after(value, default):
+    if not value:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def retry_after_seconds(url, status, headers):
+    """How long the host is closed after this response, or None if it isn't a 429."""
+    host, config = _config(url)
+    if config is None or status != 429:
+        return None
+    return _retry_after(headers.get('Retry-After'), config.get('retry_after', 5))
+
+
+def _block(host, seconds):
+    _count('upstream_429s')
+    print(f"[upstream] {host} answered 429, pausing calls for {seconds:.0f}s")
+    return _blocked_key(host), time.time() + seconds, math.ceil(seconds) + 1
+
+
+def observe(url, status, headers):
+    """Close the host for every worker when it answers 429."""
+    seconds = retry_after_seconds(url, status, headers)
+    if seconds:
+        key, until, timeout = _block(urlsplit(url).netloc, seconds)
+        cache.set(key, until, timeout=timeout)
+
+
+async def aobserve(url, status, headers):
+    seconds = retry_after_seconds(url, status, headers)
+    if seconds:
+        key, until, timeout = _block(urlsplit(url).netloc, seconds)
+        await cache.aset(key, until, timeout=timeout)
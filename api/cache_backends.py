@@ -0,0 +1,328 @@
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+from django.utils._os import safe_makedirs
+
+from . import timing
+
+
+# ─── Two-tier cache: in-process LRU (L1) in front of a shared backend (L2) ──
+#
+#   CACHES = {
+#       'default': {
+#           'BACKEND': 'api.cache_backends.TieredCache',
+#           'OPTIONS': {'L2': 'shared', 'L1_MAX_BYTES': 64 * 1024 * 1024, 'L1_TIMEOUT': 60},
+#       },
+#       'shared': {...any Django cache backend...},
+#   }
+#
+# L1 is bounded by the pickled size of its entries and holds each one for at
+# most L1_TIMEOUT seconds, so workers never serve another worker's overwritten
+# value for longer than that. Keys with an L1_BYPASS prefix (locks, counters,
+# tokens) only ever live in L2. add() and incr() always go straight to L2, so
+# they are exactly as atomic across workers as L2 makes them: RedisCache and
+# FileCache below are, Django's FileBasedCache is not (its add() is has_key()
+# then set(), its incr() get() then set()).
+
+
+class LRUStore:
+    """Byte-bounded LRU of pickled values, shared by every thread in the process."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()    # key -> (pickled, expires_at)
+        self.lock = threading.Lock()
+        self.stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'l1_evictions': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, pickled, seconds):
+        with self.lock:
+            self._drop(key)
+            if seconds <= 0 or len(pickled) > self.max_bytes:
+                return
+            self.entries[key] = (pickled, time.monotonic() + seconds)
+            self.bytes += len(pickled)
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.stats['l1_evictions'] += 1
+
+    def delete(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[0])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _timed(method):
+    # A request's Server-Timing `cache` phase; the rate limiter's keys are its own.
+    @wraps(method)
+    def wrapper(self, key, *args, **kwargs):
+        with timing.phase('ratelimit' if isinstance(key, str) and key.startswith('rl:') else 'cache'):
+            return method(self, key, *args, **kwargs)
+    return wrapper
+
+
+class TieredCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = options.get('L2', 'shared')
+        self._l1_timeout = options.get('L1_TIMEOUT', 60)
+        self._l1_bypass = tuple(options.get('L1_BYPASS', ()))
+
+        # Django builds one backend instance per thread; L1 is per process.
+        with _stores_lock:
+            self._l1 = _stores.setdefault(
+                location or self._l2_alias,
+                LRUStore(options.get('L1_MAX_BYTES', 64 * 1024 * 1024)),
+            )
+
+    @property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    def _key(self, key, version):
+        return self.make_and_validate_key(key, version=version)
+
+    def _bypass(self, key):
+        return bool(self._l1_bypass) and key.startswith(self._l1_bypass)
+
+    def _l1_get(self, key, version):
+        if self._bypass(key):
+            return None
+        return self._l1.get(self._key(key, version))
+
+    def _l1_set(self, key, value, timeout, version):
+        if self._bypass(key):
+            return
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        seconds = self._l1_timeout if timeout is None else min(self._l1_timeout, timeout)
+        self._l1.set(self._key(key, version), pickle.dumps(value, self.pickle_protocol), seconds)
+
+    # ── Cache API ──
+
+    @_timed
+    def get(self, key, default=None, version=None):
+        pickled = self._l1_get(key, version)
+        if pickled is not None:
+            self._l1.count('l1_hits')
+            return pickle.loads(pickled)
+
+        sentinel = object()
+        value = self.l2.get(key, sentinel, version=version)
+        if value is sentinel:
+            self._l1.count('misses')
+            return default
+
+        self._l1.count('l2_hits')
+        self._l1_set(key, value, None, version)
+        return value
+
+    @_timed
+    def get_l2(self, key, default=None, version=None):
+        """get() from L2 only, replacing this process's L1 copy with what it finds."""
+        sentinel = object()
+        value = self.l2.get(key, sentinel, version=version)
+        if value is sentinel:
+            self._l1.delete(self._key(key, version))
+            return default
+        self._l1_set(key, value, None, version)
+        return value
+
+    async def aget_l2(self, key, default=None, version=None):
+        return await sync_to_async(self.get_l2, thread_sensitive=True)(key, default, version)
+
+    @_timed
+    def get_many(self, keys, version=None):
+        found = {}
+        remaining = []
+        for key in keys:
+            pickled = self._l1_get(key, version)
+            if pickled is not None:
+                found[key] = pickle.loads(pickled)
+            else:
+                remaining.append(key)
+
+        fetched = self.l2.get_many(remaining, version=version) if remaining else {}
+        for key, value in fetched.items():
+            self._l1_set(key, value, None, version)
+
+        self._l1.count('l1_hits', len(found))
+        self._l1.count('l2_hits', len(fetched))
+        self._l1.count('misses', len(remaining) - len(fetched))
+        found.update(fetched)
+        return found
+
+    @_timed
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout=timeout, version=version)
+        self._l1_set(key, value, timeout, version)
+
+    @_timed
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout=timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._l1_set(key, value, timeout, version)
+        return failed
+
+    @_timed
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.add(key, value, timeout=timeout, version=version)
+
+    @_timed
+    def incr(self, key, delta=1, version=None):
+        self._l1.delete(self._key(key, version))
+        return self.l2.incr(key, delta, version=version)
+
+    @_timed
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._l1.delete(self._key(key, version))
+        return self.l2.touch(key, timeout=timeout, version=version)
+
+    @_timed
+    def delete(self, key, version=None):
+        self._l1.delete(self._key(key, version))
+        return self.l2.delete(key, version=version)
+
+    @_timed
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._l1.delete(self._key(key, version))
+        self.l2.delete_many(keys, version=version)
+
+    @_timed
+    def has_key(self, key, version=None):
+        if self._l1_get(key, version) is not None:
+            return True
+        return self.l2.has_key(key, version=version)
+
+    def clear(self):
+        self._l1.clear()
+        self.l2.clear()
+
+    def stats(self):
+        with self._l1.lock:
+            return {**self._l1.stats, 'l1_entries': len(self._l1.entries), 'l1_bytes': self._l1.bytes}
+
+
+# ─── File-backed L2 with atomic add() and incr() ────────────────────────────
+#
+# The coalescing locks, token refresh lock, upstream budgets and metrics
+# slots all rely on add() being won by exactly one worker and on incr() not
+# losing updates. FileCache runs both under an exclusive lock on one of
+# LOCK_STRIPES lock files (picked by the key's file name), so concurrent
+# callers on one key take turns. get() and set() stay lock-free: set()
+# replaces the file with a rename, which readers never see half-written.
+#
+# FileBasedCache culls on every set(), and its cull lists the whole cache
+# directory. FileCache culls at most once every CULL_INTERVAL seconds per
+# process instead, after the write and outside the stripe lock, so between
+# culls the directory can run somewhat past MAX_ENTRIES.
+
+_next_cull = {}     # cache directory -> monotonic time this process may cull it again
+_next_cull_lock = threading.Lock()
+
+
+class FileCache(FileBasedCache):
+    LOCK_STRIPES = 256
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._cull_interval = params.get('OPTIONS', {}).get('CULL_INTERVAL', 60)
+
+    @contextmanager
+    def _locked(self, key, version):
+        fname = self._key_to_file(key, version)
+        directory = os.path.join(self._dir, 'locks')
+        safe_makedirs(directory, mode=0o700, exist_ok=True)
+        stripe = int(os.path.basename(fname)[:8], 16) % self.LOCK_STRIPES
+        with open(os.path.join(directory, f'{stripe}.lock'), 'ab') as f:
+            locks.lock(f, locks.LOCK_EX)
+            try:
+                yield fname
+            finally:
+                locks.unlock(f)
+
+    def _cull(self):
+        # Called by FileBasedCache.set() on every write; see _maybe_cull().
+        pass
+
+    def _maybe_cull(self):
+        now = time.monotonic()
+        with _next_cull_lock:
+            if _next_cull.get(self._dir, 0) > now:
+                return
+            _next_cull[self._dir] = now + self._cull_interval
+        super()._cull()
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version)
+        self._maybe_cull()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked(key, version):
+            if self.has_key(key, version):
+                return False
+            super().set(key, value, timeout, version)
+        self._maybe_cull()
+        return True
+
+    def incr(self, key, delta=1, version=None):
+        with self._locked(key, version) as fname:
+            try:
+                with open(fname, 'rb') as f:
+                    expiry = pickle.load(f)
+                    value = pickle.loads(zlib.decompress(f.read()))
+            except (FileNotFoundError, EOFError):
+                expiry, value = 0, None
+            remaining = None if expiry is None else expiry - time.time()
+            if remaining is not None and remaining <= 0:
+                raise ValueError(f"Key '{key}' not found")
+            # Keeps the key's expiry, where BaseCache.incr() resets it.
+            value += delta
+            super().set(key, value, timeout=remaining, version=version)
+        self._maybe_cull()
+        return value
@@ -0,0 +1,682 @@
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from string import Formatter
+
+import requests
+from asgiref.sync import sync_to_async
+
+try:
+    import brotli
+except ImportError:  # optional: responses are then only pre-compressed with gzip
+    brotli = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+
+from rest_framework.response import Response
+
+from . import metrics, projection, upstream
+
+
+# ─── Cached upstream fetches with request coalescing ────────────────────────
+#
+# When a key is missing, only one caller fetches it from upstream: one per
+# process via an in-flight table, and one across workers via a lock key in
+# the shared cache. Everyone else waits for that result instead of sending
+# their own request. `compute()` returns (data, error); only data is cached.
+#
+# Entries are kept for `fresh + stale` seconds. Once past `fresh` they are
+# still served, and a background task fetches the new value; callers only
+# wait on upstream when the key is missing altogether.
+#
+# Each entry is stored as the final JSON bytes, plus gzip/brotli copies for
+# larger bodies, and a strong ETag of those bytes, all built once when it is
+# stored. A cache hit is answered with the stored bytes (or a 304) without
+# decoding or re-encoding anything.
+
+_flights = {}
+_flights_lock = threading.Lock()
+_aflights = weakref.WeakKeyDictionary()    # event loop -> {key: Future}, for async callers
+_refreshing = set()     # keys with a background refresh queued or running
+_refresh_tasks = set()  # keeps async refreshes referenced until they finish
+_refresh_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='cache-refresh')
+
+_stats = {
+    'hits': 0,
+    'stale_hits': 0,          # served stale while refreshing in the background
+    'misses': 0,
+    'background_refreshes': 0,
+    'upstream_fetches': 0,
+    'coalesced_local': 0,     # waited on a fetch in this process
+    'coalesced_shared': 0,    # got the value another worker fetched
+    'lock_timeouts': 0,       # gave up waiting and fetched anyway
+}
+_stats_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+COMPRESS_MIN_BYTES = 1024
+
+
+class Entry:
+    """A cached value as JSON bytes, its compressed copies, ETag and freshness."""
+
+    def __init__(self, data, fresh_until):
+        self.body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+        self.encodings = {}
+        if len(self.body) >= COMPRESS_MIN_BYTES:
+            self.encodings['gzip'] = gzip.compress(self.body, compresslevel=6)
+            if brotli is not None:
+                self.encodings['br'] = brotli.compress(self.body, mode=brotli.MODE_TEXT, quality=5)
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.fresh_until = fresh_until
+
+    @property
+    def data(self):
+        # Only the aggregate views and `fields=` need the decoded value.
+        return json.loads(self.body)
+
+    @property
+    def is_stale(self):
+        return self.fresh_until <= time.time()
+
+
+def _count_shared(name):
+    try:
+        if not cache.add(f'stats-{name}', 1, timeout=None):
+            cache.incr(f'stats-{name}')
+    except ValueError:
+        pass
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+    if name.startswith('coalesced'):
+        _count_shared(name)
+
+
+async def _acount(name):
+    with _stats_lock:
+        _stats[name] += 1
+    if name.startswith('coalesced'):
+        await sync_to_async(_count_shared)(name)
+
+
+def stats():
+    with _stats_lock:
+        local = dict(_stats)
+    shared = cache.get_many(['stats-coalesced_local', 'stats-coalesced_shared'])
+    result = {
+        'process': local,
+        'upstream_calls_saved': {
+            'process': local['coalesced_local'] + local['coalesced_shared'],
+            'all_workers': sum(shared.values()),
+        },
+    }
+    if hasattr(cache, 'stats'):
+        result['tiers'] = cache.stats()
+    return result
+
+
+def _timeout_for(timeout, data):
+    return timeout(data) if callable(timeout) else timeout
+
+
+def _wait():
+    return getattr(settings, 'CACHE_COALESCE_WAIT', 5)
+
+
+def _lock_ttl():
+    return getattr(settings, 'CACHE_COALESCE_LOCK_TTL', 15)
+
+
+# ─── Reading and writing entries ─────────────────────────────────────────────
+
+def _entry(data, fresh, stale):
+    seconds = _timeout_for(fresh, data)
+    return Entry(data, time.time() + seconds), seconds + stale
+
+
+def _as_entry(value):
+    # Bare data, as cached before entries existed, counts as stale so it gets refreshed.
+    if value is None or isinstance(value, Entry):
+        return value
+    return Entry(value, 0)
+
+
+def _unwrap(entry):
+    if entry is None:
+        return None, False
+    return entry.data, entry.is_stale
+
+
+def read_entry(cache_key):
+    return _as_entry(cache.get(cache_key))
+
+
+async def aread_entry(cache_key):
+    return _as_entry(await cache.aget(cache_key))
+
+
+def read_shared_entry(cache_key):
+    """read_entry past this process's L1 copy, which another worker may have replaced."""
+    return _as_entry(getattr(cache, 'get_l2', cache.get)(cache_key))
+
+
+async def aread_shared_entry(cache_key):
+    return _as_entry(await getattr(cache, 'aget_l2', cache.aget)(cache_key))
+
+
+def read(cache_key):
+    """(data, is_stale), or (None, False) if the key isn't cached."""
+    return _unwrap(read_entry(cache_key))
+
+
+def record_lookup(cache_key, entry):
+    result = 'miss' if entry is None else 'stale' if entry.is_stale else 'hit'
+    metrics.inc('cache_lookups_total', family=metrics.cache_family(cache_key), result=result)
+
+
+def read_many(keys, record=True):
+    """{key: (data, is_stale)} for the keys that are cached.
+
+    Counted in the lookup metrics unless `record` is false (cache warmers).
+    """
+    keys = list(keys)
+    entries = {key: _as_entry(value) for key, value in cache.get_many(keys).items()}
+    if record:
+        for key in keys:
+            record_lookup(key, entries.get(key))
+    return {key: _unwrap(entry) for key, entry in entries.items()}
+
+
+def get_many(keys):
+    return {key: data for key, (data, _) in read_many(keys).items()}
+
+
+def store(cache_key, data, fresh, stale=0):
+    entry, timeout = _entry(data, fresh, stale)
+    cache.set(cache_key, entry, timeout=timeout)
+    return entry
+
+
+async def astore(cache_key, data, fresh, stale=0):
+    entry, timeout = _entry(data, fresh, stale)
+    await cache.aset(cache_key, entry, timeout=timeout)
+    return entry
+
+
+def store_many(values, fresh, stale=0):
+    now = time.time()
+    cache.set_many({key: Entry(data, now + fresh) for key, data in values.items()}, timeout=fresh + stale)
+
+
+# ─── Coalesced fetches ───────────────────────────────────────────────────────
+#
+# These work on Entry objects; fetch_once and cached_fetch hand back the data.
+
+def _wait_for_leader(cache_key, lock_key, deadline):
+    """The entry the lock holder stored, or None once its lock is gone or time is up."""
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = read_entry(cache_key)
+        if entry is not None or not cache.has_key(lock_key):
+            return entry
+    return None
+
+
+def _fetch_across_workers(cache_key, fresh, compute, stale):
+    lock_key = f'lock-{cache_key}'
+    deadline = time.time() + _wait()
+    while not cache.add(lock_key, 1, timeout=_lock_ttl()):
+        entry = _wait_for_leader(cache_key, lock_key, deadline)
+        if entry is not None:
+            _count('coalesced_shared')
+            return entry, None
+        if time.time() >= deadline:
+            _count('lock_timeouts')
+            return _fetch(cache_key, fresh, compute, stale)
+        # The holder let go without storing anything (its fetch failed);
+        # the next add() picks one new fetcher among the waiters.
+
+    try:
+        # Another worker may have filled it between our miss and the lock.
+        entry = read_shared_entry(cache_key)
+        if entry is not None and not entry.is_stale:
+            _count('coalesced_shared')
+            return entry, None
+        return _fetch(cache_key, fresh, compute, stale)
+    finally:
+        cache.delete(lock_key)
+
+
+def _fetch(cache_key, fresh, compute, stale):
+    _count('upstream_fetches')
+    data, error = compute()
+    if data is None:
+        return None, error
+    return store(cache_key, data, fresh, stale), error
+
+
+def fetch_entry(cache_key, fresh, compute, stale=0):
+    """Fill a key that is known to be missing, coalescing concurrent callers."""
+    with _flights_lock:
+        flight = _flights.get(cache_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[cache_key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(_wait()):
+            _count('coalesced_local')
+            return flight.result
+        _count('lock_timeouts')
+        return _fetch(cache_key, fresh, compute, stale)
+
+    try:
+        flight.result = _fetch_across_workers(cache_key, fresh, compute, stale)
+        return flight.result
+    finally:
+        flight.done.set()
+        with _flights_lock:
+            _flights.pop(cache_key, None)
+
+
+def cached_entry(cache_key, fresh, compute, stale=0):
+    entry = read_entry(cache_key)
+    record_lookup(cache_key, entry)
+    if entry is not None:
+        _count('stale_hits' if entry.is_stale else 'hits')
+        if entry.is_stale:
+            refresh_in_background(cache_key, fresh, compute, stale)
+        return entry, None
+
+    _count('misses')
+    return fetch_entry(cache_key, fresh, compute, stale)
+
+
+def _data(result):
+    entry, error = result
+    return (entry.data if entry is not None else None), error
+
+
+def fetch_once(cache_key, fresh, compute, stale=0):
+    return _data(fetch_entry(cache_key, fresh, compute, stale))
+
+
+def cached_fetch(cache_key, fresh, compute, stale=0):
+    return _data(cached_entry(cache_key, fresh, compute, stale))
+
+
+# ─── Coalesced fetches for async views ──────────────────────────────────────
+#
+# The same, for a coroutine `compute()`: callers on one event loop share an
+# asyncio future per key, and workers share the same `lock-{key}`.
+
+async def _afetch(cache_key, fresh, compute, stale):
+    await _acount('upstream_fetches')
+    data, error = await compute()
+    if data is None:
+        return None, error
+    return await astore(cache_key, data, fresh, stale), error
+
+
+async def _await_leader(cache_key, lock_key, deadline):
+    while time.time() < deadline:
+        await asyncio.sleep(0.05)
+        entry = await aread_entry(cache_key)
+        if entry is not None or not await cache.ahas_key(lock_key):
+            return entry
+    return None
+
+
+async def _afetch_across_workers(cache_key, fresh, compute, stale):
+    lock_key = f'lock-{cache_key}'
+    deadline = time.time() + _wait()
+    while not await cache.aadd(lock_key, 1, timeout=_lock_ttl()):
+        entry = await _await_leader(cache_key, lock_key, deadline)
+        if entry is not None:
+            await _acount('coalesced_shared')
+            return entry, None
+        if time.time() >= deadline:
+            await _acount('lock_timeouts')
+            return await _afetch(cache_key, fresh, compute, stale)
+
+    try:
+        entry = await aread_shared_entry(cache_key)
+        if entry is not None and not entry.is_stale:
+            await _acount('coalesced_shared')
+            return entry, None
+        return await _afetch(cache_key, fresh, compute, stale)
+    finally:
+        await cache.adelete(lock_key)
+
+
+def _retrieved(future):
+    # Nobody may be waiting; don't let asyncio report the exception as lost.
+    if not future.cancelled():
+        future.exception()
+
+
+async def afetch_entry(cache_key, fresh, compute, stale=0):
+    """fetch_entry for a coroutine `compute()`."""
+    loop = asyncio.get_running_loop()
+    flights = _aflights.setdefault(loop, {})
+    flight = flights.get(cache_key)
+
+    if flight is not None:
+        try:
+            # shield: a waiter timing out must not cancel the shared fetch.
+            result = await asyncio.wait_for(asyncio.shield(flight), _wait())
+        except asyncio.TimeoutError:
+            result = None
+        if result is not None:
+            await _acount('coalesced_local')
+            return result
+        # It timed out, or its request went away before it finished.
+        await _acount('lock_timeouts')
+        return await _afetch(cache_key, fresh, compute, stale)
+
+    flight = flights[cache_key] = loop.create_future()
+    flight.add_done_callback(_retrieved)
+    try:
+        result = await _afetch_across_workers(cache_key, fresh, compute, stale)
+        flight.set_result(result)
+        return result
+    except Exception as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        if not flight.done():
+            flight.set_result(None)
+        flights.pop(cache_key, None)
+
+
+async def acached_entry(cache_key, fresh, compute, stale=0):
+    """cached_entry for a coroutine `compute()`; stale entries refresh on the event loop."""
+    entry = await aread_entry(cache_key)
+    record_lookup(cache_key, entry)
+    if entry is not None:
+        await _acount('stale_hits' if entry.is_stale else 'hits')
+        if entry.is_stale:
+            arefresh_in_background(cache_key, fresh, compute, stale)
+        return entry, None
+
+    await _acount('misses')
+    return await afetch_entry(cache_key, fresh, compute, stale)
+
+
+# ─── Background refresh of stale entries ─────────────────────────────────────
+
+def _claim_refresh(cache_key):
+    with _flights_lock:
+        if cache_key in _refreshing or cache_key in _flights:
+            return False
+        _refreshing.add(cache_key)
+        return True
+
+
+def _release_refresh(cache_key):
+    with _flights_lock:
+        _refreshing.discard(cache_key)
+
+
+def refresh_in_background(cache_key, fresh, compute, stale=0):
+    if _claim_refresh(cache_key):
+        _refresh_pool.submit(_refresh, cache_key, fresh, compute, stale)
+
+
+def _refresh(cache_key, fresh, compute, stale):
+    lock_key = f'lock-{cache_key}'
+    try:
+        # Another worker is already refreshing it.
+        if not cache.add(lock_key, 1, timeout=_lock_ttl()):
+            return
+        try:
+            # Or refreshed it already: every worker's L1 still has the stale
+            # copy, so each would refresh it again once the lock is free.
+            entry = read_shared_entry(cache_key)
+            if entry is not None and not entry.is_stale:
+                _count('coalesced_shared')
+                return
+            _count('background_refreshes')
+            _fetch(cache_key, fresh, compute, stale)
+        finally:
+            cache.delete(lock_key)
+    except Exception as e:
+        print(f"[cache-refresh] {cache_key} failed: {e}")
+    finally:
+        _release_refresh(cache_key)
+        close_old_connections()
+
+
+def arefresh_in_background(cache_key, fresh, compute, stale=0):
+    """Same as refresh_in_background, for an async `compute()` on the running loop."""
+    if _claim_refresh(cache_key):
+        # Outlives the request, so it must not inherit the request's
+        # sync_to_async executor from the current context.
+        task = contextvars.Context().run(
+            asyncio.get_running_loop().create_task, _arefresh(cache_key, fresh, compute, stale),
+        )
+        _refresh_tasks.add(task)
+        task.add_done_callback(_refresh_tasks.discard)
+
+
+async def _arefresh(cache_key, fresh, compute, stale):
+    lock_key = f'lock-{cache_key}'
+    try:
+        if not await cache.aadd(lock_key, 1, timeout=_lock_ttl()):
+            return
+        try:
+            entry = await aread_shared_entry(cache_key)
+            if entry is not None and not entry.is_stale:
+                await _acount('coalesced_shared')
+                return
+            await _acount('background_refreshes')
+            data, _ = await compute()
+            if data is not None:
+                await astore(cache_key, data, fresh, stale)
+        finally:
+            await cache.adelete(lock_key)
+    except Exception as e:
+        print(f"[cache-refresh] {cache_key} failed: {e}")
+    finally:
+        _release_refresh(cache_key)
+
+
+# ─── Helpers for views ──────────────────────────────────────────────────────
+
+def fetch_part(fetch, error, fields=None):
+    """Call upstream: (data, None) on success, or (None, error). `fields` trims the data."""
+    try:
+        response = fetch()
+    except requests.exceptions.RequestException as e:
+        return None, {'error': str(e), 'status': 502}
+
+    if not response.ok:
+        return None, {'error': error, 'status': response.status_code}
+
+    return projection.project(response.json(), fields), None
+
+
+def cached_part(cache_key, fresh, fetch, error, stale=0):
+    return cached_fetch(cache_key, fresh, lambda: fetch_part(fetch, error), stale)
+
+
+def cached_many(items, cache_key, fetch, fresh, stale=0):
+    """Multi-get `items` from the cache, fetch the misses concurrently and store them.
+
+    `fetch(item)` returns the value to cache, or None to leave it uncached.
+    Returns {item: value} for every item that resolved.
+    """
+    keys = {item: cache_key(item) for item in items}
+    cached = read_many(keys.values())
+    found = {}
+    for item, key in keys.items():
+        data, is_stale = cached.get(key, (None, False))
+        if data is None:
+            continue
+        found[item] = data
+        if is_stale:
+            refresh_in_background(key, fresh, lambda item=item: (fetch(item), None), stale)
+    missing = [item for item in keys if item not in found]
+
+    def resolve(item):
+        data, _ = fetch_once(keys[item], fresh, lambda: (fetch(item), None), stale)
+        return data
+
+    for item, value in zip(missing, upstream.fan_out(resolve, missing)):
+        if value is not None:
+            found[item] = value
+    return found
+
+
+def _respond(result, fields=None):
+    if isinstance(result, Response):
+        return result
+    data, error = result
+    if error:
+        return Response(error, status=error['status'])
+    return Response(projection.project(data, fields))
+
+
+def response_etag(entry, fields_spec=None):
+    """The quoted ETag for an entry, as sent when narrowed to `fields_spec`."""
+    if not fields_spec:
+        return quote_etag(entry.etag)
+    return quote_etag(f"{entry.etag}-{hashlib.md5(fields_spec.encode()).hexdigest()[:8]}")
+
+
+def not_modified(request, etag):
+    """Whether the request's If-None-Match already covers `etag`."""
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return '*' in etags or etag in (e.removeprefix('W/') for e in etags)
+
+
+def _accepted(accept_encoding):
+    """{coding: q} from an Accept-Encoding header."""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def _encoding_for(request, entry):
+    accepted = _accepted(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for coding in ('br', 'gzip'):
+        if coding in entry.encodings and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def _body_response(request, entry):
+    coding = _encoding_for(request, entry)
+    response = HttpResponse(entry.encodings[coding] if coding else entry.body, content_type='application/json')
+    if coding:
+        response['Content-Encoding'] = coding
+    if entry.encodings:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def entry_response(request, entry, fields=None, render=Response):
+    """The response for a cached entry: a 304 if the client has it, else its stored bytes.
+
+    Narrowed by `fields` (parsed from `fields=`) it has to be rendered, by `render(data)`.
+    """
+    etag = response_etag(entry, request.GET.get('fields') if fields is not None else None)
+    if not_modified(request, etag):
+        response = HttpResponseNotModified()
+    elif fields is not None:
+        response = render(projection.project(entry.data, fields))
+    else:
+        response = _body_response(request, entry)
+    response['ETag'] = etag
+    # Per-user data: keep it out of shared caches, and revalidate every time.
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def requested_fields(query_params):
+    """The `fields=` query parameter, parsed: (fields, None) or (None, error)."""
+    spec = query_params.get('fields')
+    if not spec:
+        return None, None
+    try:
+        return projection.parse(spec), None
+    except ValueError as e:
+        return None, {'error': f'invalid fields: {e}', 'status': 400}
+
+
+def cached_view(key, fresh, stale=0, params=None):
+    """Cache what a view returns, (data, error), serving stale data while it refreshes.
+
+    `key` is a template filled from the query string (with defaults from
+    `params`) and {user}, the requesting user's id; or a callable taking the
+    request. When the key can't be built (a parameter is missing or empty)
+    the view runs uncached, so it can reject the request itself. A view may also
+    return a Response, which is sent as is. A `fields=` query parameter
+    narrows what is sent, not what is cached. Cached responses carry the
+    entry's ETag and a matching If-None-Match gets a 304.
+
+        @cached_view('top-tracks-{user}-{time_range}', fresh=60*30, stale=60*60*24,
+                     params={'time_range': 'medium_term'})
+    """
+    defaults = params or {}
+    placeholders = [name for _, name, _, _ in Formatter().parse(key) if name] if isinstance(key, str) else []
+
+    def cache_key(request):
+        if callable(key):
+            return key(request)
+        values = {}
+        for name in placeholders:
+            value = request.user.id if name == 'user' else request.query_params.get(name, defaults.get(name))
+            if value is None or value == '':
+                return None
+            values[name] = value
+        return key.format(**values)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            fields, error = requested_fields(request.query_params)
+            if error:
+                return Response(error, status=error['status'])
+
+            compute = lambda: func(request, *args, **kwargs)
+            key_for_request = cache_key(request)
+            if key_for_request is None:
+                return _respond(compute(), fields)
+
+            entry, error = cached_entry(key_for_request, fresh, compute, stale)
+            if entry is None:
+                return Response(error, status=error['status'])
+            return entry_response(request, entry, fields)
+        return wrapper
+    return decorator
@@ -0,0 +1,110 @@
+import unicodedata
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import CatalogArtist, CatalogTrack
+
+
+# ─── Catalog: resolved tracks and artists, kept in the database ─────────────
+#
+# What Spotify search found for a Last.fm (artist, track) pair, and the
+# artists resolved for similar-artist images, used to live only in cache
+# entries. They are kept here instead, indexed on normalized names and
+# Spotify IDs, so they survive cache flushes and restarts and can be warmed
+# in bulk. The cache stays in front as a hot copy. Pairs Spotify found
+# nothing for are stored too, and searched again once `retry_missing_after`
+# seconds have passed.
+
+def normalize(name):
+    """Lookup key for a name: Unicode-normalized, case-folded, whitespace collapsed."""
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())[:255]
+
+
+def _track_id(spotify_url):
+    return spotify_url.rstrip('/').split('/')[-1].split('?')[0] if spotify_url else ''
+
+
+def _result(row):
+    if not row.spotify_url:
+        return {"spotify_url": None, "image": None, "reason": "not found on Spotify"}
+    return {"spotify_url": row.spotify_url, "image": row.image or None}
+
+
+def find_tracks(pairs, retry_missing_after):
+    """{(artist, track): result} for the pairs already resolved, shaped like a search result."""
+    keys = {pair: (normalize(pair[0]), normalize(pair[1])) for pair in pairs}
+    if not keys:
+        return {}
+    rows = CatalogTrack.objects.filter(
+        artist_key__in={artist for artist, _ in keys.values()},
+        track_key__in={track for _, track in keys.values()},
+    )
+    by_key = {(row.artist_key, row.track_key): row for row in rows}
+    retry_before = timezone.now() - timedelta(seconds=retry_missing_after)
+
+    found = {}
+    for pair, key in keys.items():
+        row = by_key.get(key)
+        if row is None or (not row.spotify_url and row.updated_at < retry_before):
+            continue
+        found[pair] = _result(row)
+    return found
+
+
+def find_track(artist_name, track_name, retry_missing_after):
+    return find_tracks([(artist_name, track_name)], retry_missing_after).get((artist_name, track_name))
+
+
+def store_tracks(results):
+    """Upsert {(artist, track): search result} in one statement."""
+    rows = {}
+    for (artist_name, track_name), result in results.items():
+        spotify_url = result.get("spotify_url") or ''
+        key = (normalize(artist_name), normalize(track_name))
+        rows[key] = CatalogTrack(
+            artist_key=key[0],
+            track_key=key[1],
+            artist_name=artist_name[:255],
+            track_name=track_name[:255],
+            spotify_id=_track_id(spotify_url),
+            spotify_url=spotify_url,
+            image=result.get("image") or '',
+        )
+    CatalogTrack.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=['artist_key', 'track_key'],
+        update_fields=['artist_name', 'track_name', 'spotify_id', 'spotify_url', 'image', 'updated_at'],
+    )
+
+
+def find_artists(spotify_ids):
+    """{spotify_id: artist} for the artists already resolved, with the fields the views read."""
+    return {
+        row.spotify_id: {
+            "id": row.spotify_id,
+            "name": row.name,
+            "images": [{"url": row.image}] if row.image else [],
+        }
+        for row in CatalogArtist.objects.filter(spotify_id__in=list(spotify_ids))
+    }
+
+
+def store_artists(artists):
+    """Upsert Spotify artist objects in one statement."""
+    rows = {}
+    for artist in artists:
+        images = artist.get("images") or []
+        rows[artist["id"]] = CatalogArtist(
+            spotify_id=artist["id"],
+            name=(artist.get("name") or '')[:255],
+            name_key=normalize(artist.get("name") or ''),
+            image=images[0]["url"] if images else '',
+        )
+    CatalogArtist.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=['spotify_id'],
+        update_fields=['name', 'name_key', 'image', 'updated_at'],
+    )
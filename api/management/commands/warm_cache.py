@@ -0,0 +1,175 @@
+"""Fill the shared cache with the data of the most requested artists.
+
+    python manage.py warm_cache [--top 200] [--days 7] [--concurrency 8]
+    python manage.py warm_cache --artist 4Z8W4fKeB5YxbusRsdQVPb --artist ...
+    python manage.py warm_cache --file artist_ids.txt
+
+Warms the shared entries artist pages read: `artist-{id}` (fetched 50 at a
+time), `artist_albums-{id}`, and the Last.fm artist info and top tracks.
+Entries that are still fresh are skipped unless --force is given.
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api import caching, catalog, popularity, upstream, views
+from api.tokens import app_token, get_valid_token
+
+
+WRITE_BATCH = 100
+
+
+class Command(BaseCommand):
+    help = "Pre-fetch Spotify and Last.fm data of popular artists into the cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=200, help="How many of the most requested artists to warm.")
+        parser.add_argument('--days', type=int, default=7, help="Count requests over this many days.")
+        parser.add_argument('--artist', action='append', default=[], help="Spotify artist ID to warm (repeatable).")
+        parser.add_argument('--file', help="File with one Spotify artist ID per line.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Upstream calls in flight at once.")
+        parser.add_argument('--user', help="Call Spotify with this user's token instead of the app's.")
+        parser.add_argument('--force', action='store_true', help="Refetch entries that are still fresh.")
+
+    def handle(self, *args, **options):
+        artist_ids = self.artist_ids(options)
+        if not artist_ids:
+            self.stdout.write("No artists to warm.")
+            return
+
+        access_token = self.access_token(options['user'])
+        self.concurrency = max(1, options['concurrency'])
+        self.force = options['force']
+        self.started = time.monotonic()
+        self.written = self.skipped = self.failed = 0
+
+        self.stdout.write(f"Warming {len(artist_ids)} artists with {self.concurrency} calls in flight")
+        artists = self.warm_artists(artist_ids, access_token)
+
+        parts = []
+        for artist_id in artist_ids:
+            parts.append(views.artist_parts(artist_id, access_token)['albums'])
+            name = (artists.get(artist_id) or {}).get('name')
+            if name:
+                parts.extend(views.last_fm_parts(name).values())
+        self.warm(parts)
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {len(artist_ids)} artists in {elapsed:.1f}s: {self.written} entries written "
+            f"({self.written / elapsed:.1f}/s), {self.skipped} already fresh, {self.failed} failed"
+        ))
+
+    def artist_ids(self, options):
+        ids = list(options['artist'])
+        if options['file']:
+            try:
+                with open(options['file']) as f:
+                    ids.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+            except OSError as e:
+                raise CommandError(f"Can't read {options['file']}: {e}")
+        if not ids:
+            popularity.flush()
+            ids = popularity.top_artists(options['top'], options['days'])
+        return list(dict.fromkeys(ids))
+
+    def access_token(self, username):
+        if username:
+            try:
+                token = get_valid_token(User.objects.get(username=username))
+            except User.DoesNotExist:
+                raise CommandError(f"No user {username!r}")
+        else:
+            token = app_token()
+        if not token:
+            raise CommandError("Couldn't get a Spotify access token")
+        return token
+
+    def todo(self, keys):
+        """The keys that need fetching, and the data of the ones that are cached."""
+        cached = caching.read_many(keys, record=False)
+        data = {key: value for key, (value, _) in cached.items()}
+        if self.force:
+            return list(keys), data
+        todo = [key for key in keys if key not in cached or cached[key][1]]
+        self.skipped += len(keys) - len(todo)
+        return todo, data
+
+    def warm_artists(self, artist_ids, access_token):
+        """Artist objects by ID, fetching what isn't fresh 50 at a time."""
+        keys = {f'artist-{artist_id}': artist_id for artist_id in artist_ids}
+        todo, cached = self.todo(list(keys))
+        artists = {keys[key]: data for key, data in cached.items()}
+        missing = [keys[key] for key in todo]
+        chunks = [missing[i:i + views.SPOTIFY_ARTISTS_CHUNK] for i in range(0, len(missing), views.SPOTIFY_ARTISTS_CHUNK)]
+
+        def fetch(chunk):
+            try:
+                response = upstream.get(
+                    "https://api.spotify.com/v1/artists",
+                    headers={'Authorization': f'Bearer {access_token}'},
+                    params={"ids": ",".join(chunk)},
+                )
+            except requests.exceptions.RequestException as e:
+                self.stderr.write(f"artists {chunk[0]}…: {e}")
+                return chunk, []
+            if not response.ok:
+                self.stderr.write(f"artists {chunk[0]}…: {response.status_code}")
+                return chunk, []
+            return chunk, [a for a in response.json().get("artists", []) if a]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for chunk, found in pool.map(fetch, chunks):
+                fetched = {f'artist-{artist["id"]}': artist for artist in found}
+                if fetched:
+                    caching.store_many(fetched, fresh=60*60*24, stale=60*60*24*7)
+                    catalog.store_artists(fetched.values())
+                    artists.update({artist["id"]: artist for artist in found})
+                self.written += len(fetched)
+                self.failed += len(chunk) - len(fetched)
+                self.progress("artists", len(artists), len(artist_ids))
+        return artists
+
+    def warm(self, parts):
+        """Fetch (key, fresh, stale, compute) parts concurrently, storing them in batches."""
+        by_key = {part[0]: part for part in parts}
+        todo, _ = self.todo(list(by_key))
+        pending = defaultdict(dict)     # (fresh, stale) -> {key: data}
+        done = 0
+
+        def write():
+            for (fresh, stale), values in pending.items():
+                caching.store_many(values, fresh=fresh, stale=stale)
+                self.written += len(values)
+            pending.clear()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(by_key[key][3]): key for key in todo}
+            for future in as_completed(futures):
+                key = futures[future]
+                _, fresh, stale, _ = by_key[key]
+                try:
+                    data, error = future.result()
+                except requests.exceptions.RequestException as e:
+                    data, error = None, {'error': str(e)}
+                if error:
+                    self.failed += 1
+                    self.stderr.write(f"{key}: {error.get('error')}")
+                else:
+                    pending[(fresh, stale)][key] = data
+                done += 1
+                if sum(len(values) for values in pending.values()) >= WRITE_BATCH:
+                    write()
+                self.progress("entries", done, len(todo))
+        write()
+
+    def progress(self, what, done, total):
+        step = max(1, total // 10)
+        if done == total or done % step == 0:
+            elapsed = time.monotonic() - self.started
+            self.stdout.write(f"  {what}: {done}/{total} ({done / max(elapsed, 1e-6):.1f}/s)")
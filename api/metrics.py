@@ -0,0 +1,250 @@
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.decorators import sync_and_async_middleware
+
+from asgiref.sync import iscoroutinefunction
+
+
+# ─── Hot-path metrics ────────────────────────────────────────────────────────
+#
+# Counters and latency histograms for views, upstream calls, cache lookups,
+# token refreshes and rate limiting. Recording one is a dict update under a
+# lock in the process; nothing leaves it on the request path.
+#
+# Each worker publishes its totals to the shared cache every
+# METRICS_PUBLISH_INTERVAL seconds, off the request thread, into one of
+# METRICS_MAX_WORKERS slots (`stats-metrics-{n}`) claimed with cache.add.
+# /api/metrics/ adds up every slot and renders Prometheus text. A slot
+# expires a few intervals after its worker is gone, so totals can drop
+# when workers are replaced; Prometheus treats that as a counter reset.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+    'view_seconds': ('histogram', "Time to the response, by view."),
+    'upstream_seconds': ('histogram', "Upstream call latency, by host and endpoint."),
+    'cache_lookups_total': ('counter', "Cache lookups, by key family and result (hit, stale, miss)."),
+    'token_refreshes_total': ('counter', "Spotify token refreshes, by result."),
+    'rate_limited_total': ('counter', "Requests rejected by our own rate limit."),
+    'upstream_throttled_total': ('counter', "Upstream 429s: from the host, or from our budget for it."),
+    'db_lock_retries_total': ('counter', "Token writes retried after finding the database locked."),
+}
+
+# Cache keys carry user IDs, artist names and hashes; only their family is a
+# label. Longest prefix first.
+CACHE_FAMILIES = (
+    'artist-top-tracks-last-fm', 'artist-info-last-fm', 'artist-mbid', 'artist_albums', 'artist',
+    'track-spotify', 'top-tracks', 'top-artist', 'myplaylists', 'search', 'me',
+)
+
+_series = {}        # (name, labels) -> counter value, or [bucket counts..., sum, count]
+_lock = threading.Lock()
+_last_publish = time.monotonic()
+_publish_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metrics')
+_slot = None        # (pid, n) once this worker has claimed a slot
+
+
+def inc(name, amount=1, **labels):
+    key = (name, tuple(labels.items()))
+    with _lock:
+        _series[key] = _series.get(key, 0) + amount
+    _maybe_publish()
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(labels.items()))
+    with _lock:
+        values = _series.get(key)
+        if values is None:
+            values = _series[key] = [0] * (len(BUCKETS) + 3)
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+    _maybe_publish()
+
+
+def cache_family(cache_key):
+    return next((f for f in CACHE_FAMILIES if cache_key.startswith(f + '-')), 'other')
+
+
+# Upstream calls are labelled by host and route template. Only the routes we
+# call are listed; any other host or path (a `next_url` pointing elsewhere, an
+# ID segment a client made up) is `other`, so clients can't add series.
+UPSTREAM_ROUTES = {
+    'api.spotify.com': (
+        '/v1/artists', '/v1/artists/{id}', '/v1/artists/{id}/albums', '/v1/search', '/v1/me',
+        '/v1/me/player', '/v1/me/player/currently-playing', '/v1/me/player/devices', '/v1/me/player/play',
+        '/v1/me/player/recently-played', '/v1/me/playlists', '/v1/me/top/artists', '/v1/me/top/tracks',
+    ),
+    'accounts.spotify.com': ('/api/token',),
+    'ws.audioscrobbler.com': ('/2.0/?method=artist.getInfo', '/2.0/?method=artist.getTopTracks'),
+    'musicbrainz.org': ('/ws/2/artist/{id}',),
+}
+
+_ROUTES = {
+    host: [(re.compile(re.escape(route).replace(re.escape('{id}'), '[^/?]+') + '$'), route) for route in routes]
+    for host, routes in UPSTREAM_ROUTES.items()
+}
+
+
+def host(url):
+    netloc = urlsplit(url).netloc
+    return netloc if netloc in UPSTREAM_ROUTES else 'other'
+
+
+def endpoint(url, params=None):
+    """The UPSTREAM_ROUTES template `url` (plus Last.fm's `method` parameter) matches, or `other`."""
+    parts = urlsplit(url)
+    method = params.get('method') if isinstance(params, dict) else None
+    path = f'{parts.path}?method={method}' if method else parts.path
+    for pattern, route in _ROUTES.get(parts.netloc, ()):
+        if pattern.match(path):
+            return route
+    return 'other'
+
+
+# ─── Publishing across workers ───────────────────────────────────────────────
+
+def _interval():
+    return getattr(settings, 'METRICS_PUBLISH_INTERVAL', 10)
+
+
+def _slot_key(n):
+    return f'stats-metrics-{n}'
+
+
+def _maybe_publish():
+    global _last_publish
+    if time.monotonic() - _last_publish < _interval():
+        return
+    with _lock:
+        if time.monotonic() - _last_publish < _interval():
+            return
+        _last_publish = time.monotonic()
+    _publish_pool.submit(publish)
+
+
+def snapshot():
+    with _lock:
+        return {key: list(value) if isinstance(value, list) else value for key, value in _series.items()}
+
+
+def publish():
+    """Write this worker's totals to its slot in the shared cache; returns the slot."""
+    global _slot
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    value = {'worker': worker, 'series': snapshot()}
+    timeout = int(_interval() * 3) + 1
+    try:
+        if _slot is not None and _slot[0] == os.getpid():
+            current = cache.get(_slot_key(_slot[1]))
+            if current is None or current['worker'] == worker:
+                cache.set(_slot_key(_slot[1]), value, timeout=timeout)
+                return _slot[1]
+        for n in range(getattr(settings, 'METRICS_MAX_WORKERS', 64)):
+            if cache.add(_slot_key(n), value, timeout=timeout):
+                _slot = (os.getpid(), n)
+                return n
+        print("[metrics] no free slot to publish in")
+    except Exception as e:
+        print(f"[metrics] publish failed: {e!r}")
+    return None
+
+
+def collect():
+    """Every worker's published totals, added up; this worker's are current."""
+    own = publish()
+    slots = cache.get_many([_slot_key(n) for n in range(getattr(settings, 'METRICS_MAX_WORKERS', 64))])
+    workers = [value['series'] for key, value in slots.items() if key != _slot_key(own)]
+    workers.append(snapshot())
+
+    totals = {}
+    for series in workers:
+        for key, value in series.items():
+            if isinstance(value, list):
+                current = totals.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    current[i] += v
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals, len(workers)
+
+
+# ─── Prometheus text ─────────────────────────────────────────────────────────
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def render(totals, workers=1):
+    lines = [
+        '# HELP spontify_workers Workers whose metrics are included.',
+        '# TYPE spontify_workers gauge',
+        f'spontify_workers {workers}',
+    ]
+    for name, (kind, help_text) in METRICS.items():
+        series = sorted(((labels, value) for (n, labels), value in totals.items() if n == name), key=str)
+        if not series:
+            continue
+        full = f'spontify_{name}'
+        lines += [f'# HELP {full} {help_text}', f'# TYPE {full} {kind}']
+        for labels, value in series:
+            if kind == 'counter':
+                lines.append(f'{full}{_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{full}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{full}_sum{_labels(labels)} {value[-2]:.6f}')
+            lines.append(f'{full}_count{_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# ─── Per-view latency ────────────────────────────────────────────────────────
+
+def _observe_view(request, response, start):
+    match = getattr(request, 'resolver_match', None)
+    observe(
+        'view_seconds',
+        time.perf_counter() - start,
+        view=(match.url_name or match.view_name) if match else 'unmatched',
+        method=request.method,
+        status=response.status_code,
+    )
+
+
+@sync_and_async_middleware
+def MetricsMiddleware(get_response):
+    """Times every request to its response (for a stream, to its headers)."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            _observe_view(request, response, start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            _observe_view(request, response, start)
+            return response
+    return middleware
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MusicBrainzArtist',
+            fields=[
+                ('mbid', models.CharField(max_length=36, primary_key=True, serialize=False)),
+                ('spotify_url', models.URLField(blank=True, default='', max_length=255)),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
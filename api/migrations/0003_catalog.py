@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_musicbrainzartist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogArtist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_id', models.CharField(max_length=32, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('name_key', models.CharField(db_index=True, max_length=255)),
+                ('image', models.URLField(blank=True, default='', max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CatalogTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('artist_key', models.CharField(max_length=255)),
+                ('track_key', models.CharField(max_length=255)),
+                ('artist_name', models.CharField(max_length=255)),
+                ('track_name', models.CharField(max_length=255)),
+                ('spotify_id', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+                ('spotify_url', models.URLField(blank=True, default='', max_length=255)),
+                ('image', models.URLField(blank=True, default='', max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('artist_key', 'track_key'), name='catalog_track_names')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistHit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_id', models.CharField(max_length=32)),
+                ('day', models.DateField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('spotify_id', 'day'), name='artist_hit_per_day')],
+            },
+        ),
+    ]
@@ -8,4 +8,61 @@ class SpotifyToken(models.Model):
     expires_at = models.DateTimeField()
 
     def __str__(self):
-        return f"{self.user.username}'s Spotify Token"
\ No newline at end of file
+        return f"{self.user.username}'s Spotify Token"
+
+class MusicBrainzArtist(models.Model):
+    """Spotify link MusicBrainz has for an artist MBID; spotify_url is empty if it has none
+    or MusicBrainz rejected the MBID."""
+    mbid = models.CharField(max_length=36, primary_key=True)
+    spotify_url = models.URLField(max_length=255, blank=True, default='')
+    fetched_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.mbid} -> {self.spotify_url or '(no Spotify link)'}"
+
+
+# ─── Catalog (api/catalog.py) ───────────────────────────────────────────────
+
+class CatalogTrack(models.Model):
+    """What a Spotify search found for a Last.fm (artist, track) pair; empty spotify_url if nothing."""
+    artist_key = models.CharField(max_length=255)
+    track_key = models.CharField(max_length=255)
+    artist_name = models.CharField(max_length=255)
+    track_name = models.CharField(max_length=255)
+    spotify_id = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    spotify_url = models.URLField(max_length=255, blank=True, default='')
+    image = models.URLField(max_length=255, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['artist_key', 'track_key'], name='catalog_track_names'),
+        ]
+
+    def __str__(self):
+        return f"{self.artist_name} - {self.track_name}"
+
+
+class CatalogArtist(models.Model):
+    spotify_id = models.CharField(max_length=32, unique=True)
+    name = models.CharField(max_length=255)
+    name_key = models.CharField(max_length=255, db_index=True)
+    image = models.URLField(max_length=255, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+# ─── Access stats (api/popularity.py) ───────────────────────────────────────
+
+class ArtistHit(models.Model):
+    """Artist page requests per day, so warm_cache knows which artists to warm."""
+    spotify_id = models.CharField(max_length=32)
+    day = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['spotify_id', 'day'], name='artist_hit_per_day'),
+        ]
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent import futures
+
+import requests
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from . import upstream
+from .models import MusicBrainzArtist
+
+
+# ─── MusicBrainz: paced lookups, remembered in the database ─────────────────
+#
+# MusicBrainz allows about one request per second per client and answers
+# bursts with 503. Every lookup goes through one queue per process, drained
+# by a single thread no faster than MUSICBRAINZ_INTERVAL (the musicbrainz.org
+# entry in UPSTREAM_BUDGETS keeps the workers together to the same pace).
+# Asking for an MBID that is already queued waits on that same lookup.
+#
+# Answers are kept in MusicBrainzArtist, including "no Spotify link" and
+# MBIDs MusicBrainz rejects or doesn't know (stored the same way), so an MBID
+# is fetched from MusicBrainz once rather than once per cache expiry. Only
+# rate limiting and network errors are retried, and those aren't stored.
+
+USER_AGENT = "Spontify/1.0 (avilakraeg@gmail.com)"
+MAX_ATTEMPTS = 3
+RETRY_STATUSES = (429, 503)
+
+logger = logging.getLogger(__name__)
+
+_pending = {}           # mbid -> Future, while queued or in flight
+_queue = queue.Queue()
+_lock = threading.Lock()
+_worker = None
+
+
+def _interval():
+    return getattr(settings, 'MUSICBRAINZ_INTERVAL', 1.1)
+
+
+def fetch_spotify_url(mbid):
+    """(spotify_url, 200), '' if MusicBrainz has none; (None, status) if it didn't answer."""
+    response = upstream.get(
+        f"https://musicbrainz.org/ws/2/artist/{mbid}?inc=url-rels&fmt=json",
+        headers={"User-Agent": USER_AGENT},
+    )
+
+    if response.status_code != 200:
+        return None, response.status_code
+
+    relations = response.json().get("relations", [])
+
+    spotify_url = next(
+        (r["url"]["resource"] for r in relations if "spotify.com/artist" in r["url"]["resource"]),
+        ''
+    )
+
+    return spotify_url, 200
+
+
+def stored(mbids):
+    """{mbid: spotify_url} for the MBIDs already looked up."""
+    return dict(MusicBrainzArtist.objects.filter(mbid__in=list(mbids)).values_list('mbid', 'spotify_url'))
+
+
+def enqueue(mbid):
+    """A Future for `mbid`'s Spotify URL ('' if none, None if the lookup failed)."""
+    global _worker
+    with _lock:
+        future = _pending.get(mbid)
+        if future is None:
+            future = _pending[mbid] = futures.Future()
+            _queue.put((mbid, 1))
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_drain, name='musicbrainz', daemon=True)
+            _worker.start()
+    return future
+
+
+def _resolve(mbid, spotify_url):
+    with _lock:
+        future = _pending.pop(mbid, None)
+    if future is not None and not future.done():
+        future.set_result(spotify_url)
+
+
+def _drain():
+    last_call = 0
+    while True:
+        mbid, attempt = _queue.get()
+        try:
+            last_call = _lookup(mbid, attempt, last_call)
+        except Exception:
+            # Whatever went wrong, the worker carries on with the queue and
+            # the callers waiting on this MBID get "not known" right away.
+            logger.exception("lookup of %s failed", mbid)
+            _resolve(mbid, None)
+
+
+def _lookup(mbid, attempt, last_call):
+    """Look up one queued MBID no sooner than MUSICBRAINZ_INTERVAL after `last_call`; returns the new last_call."""
+    close_old_connections()
+    # Queued again by a caller that checked just before it was stored.
+    try:
+        known = stored([mbid])
+    except DatabaseError:
+        known = {}
+    if mbid in known:
+        _resolve(mbid, known[mbid])
+        return last_call
+
+    wait = last_call + _interval() - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    last_call = time.monotonic()
+
+    try:
+        spotify_url, status = fetch_spotify_url(mbid)
+    except requests.exceptions.RequestException as e:
+        logger.warning("%s: %s", mbid, e)
+        spotify_url, status = None, None
+    except ValueError as e:
+        logger.warning("%s: %s", mbid, e)
+        spotify_url, status = None, 502
+
+    retry = status is None or status in RETRY_STATUSES
+    if spotify_url is None and not retry and 400 <= status < 500:
+        # A malformed or unknown MBID won't have a link next time either.
+        spotify_url = ''
+
+    if spotify_url is not None:
+        try:
+            MusicBrainzArtist.objects.update_or_create(mbid=mbid, defaults={'spotify_url': spotify_url})
+        except DatabaseError as e:
+            logger.warning("couldn't store %s: %s", mbid, e)
+        _resolve(mbid, spotify_url)
+    elif retry and attempt < MAX_ATTEMPTS:
+        # Rate limited or unreachable: back off, then try again behind what's queued.
+        logger.warning("%s for %s, retrying", status or 'no answer', mbid)
+        last_call = time.monotonic() + _interval() * attempt * 2
+        _queue.put((mbid, attempt + 1))
+    else:
+        _resolve(mbid, None)
+    return last_call
+
+
+def spotify_urls(mbids, wait):
+    """{mbid: spotify_url} for MBIDs stored or resolved within `wait` seconds.
+
+    Lookups that take longer stay queued, so they are stored for next time.
+    """
+    mbids = set(mbids)
+    try:
+        found = stored(mbids)
+    except DatabaseError as e:
+        # Queue them all; the worker checks what's stored before calling out.
+        logger.warning("couldn't read stored links: %s", e)
+        found = {}
+    queued = {mbid: enqueue(mbid) for mbid in mbids - found.keys()}
+    futures.wait(queued.values(), timeout=wait)
+    for mbid, future in queued.items():
+        if future.done() and future.result() is not None:
+            found[mbid] = future.result()
+    return found
+
+
+def spotify_url(mbid, wait):
+    """`mbid`'s Spotify URL, '' if it has none, or None if that isn't known in time."""
+    return spotify_urls([mbid], wait).get(mbid)
+
+
+async def aspotify_url(mbid, wait):
+    link = await MusicBrainzArtist.objects.filter(mbid=mbid).afirst()
+    if link is not None:
+        return link.spotify_url
+    try:
+        # shield: timing out must not cancel the lookup other callers share.
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(enqueue(mbid))), wait)
+    except asyncio.TimeoutError:
+        return None
@@ -0,0 +1,198 @@
+import asyncio
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from itertools import islice
+from string import Formatter
+from urllib.parse import quote
+
+import httpx
+import requests
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+
+from . import projection, upstream
+
+
+# ─── All pages of a Spotify collection, streamed ────────────────────────────
+#
+# With `?all=1`, get_my_playlists and get_artist_albums answer with every
+# item of the collection instead of its first page. The first page gives
+# `total`; the remaining offsets are fetched PAGES_WINDOW at a time, and
+# items go out as NDJSON as soon as the pages before them have arrived, so
+# the client renders the first items before the last page is fetched. Only
+# the pages in the window are held, however large the collection. These
+# pages aren't cached: the first page of the normal route still is.
+#
+# One JSON object per line:
+#   {"total": 120}            first, capped at PAGES_MAX_ITEMS
+#   {"item": {...}}           one per item, in order
+#   {"done": true, "count": 120}
+# or, if a page fails, {"error": ..., "status": ...} as the last line.
+
+
+def _limit():
+    return getattr(settings, 'PAGES_LIMIT', 50)
+
+
+def _window():
+    return getattr(settings, 'PAGES_WINDOW', 4)
+
+
+def _max_items():
+    return getattr(settings, 'PAGES_MAX_ITEMS', 5000)
+
+
+def line(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+
+def _page_result(response, error):
+    if response.status_code >= 400:
+        return None, {'error': error, 'status': response.status_code}
+    return response.json(), None
+
+
+def _params(offset):
+    return {'offset': offset, 'limit': _limit()}
+
+
+def _start(first):
+    """The first page's items, and the offsets still to fetch."""
+    items = first.get('items') or []
+    total = min(first.get('total') or 0, _max_items())
+    return items[:total], total, range(len(items), total, _limit())
+
+
+def stream_pages(url, access_token, error, keep=None):
+    """NDJSON lines for every item of the paged collection at `url`; `keep` projects each item."""
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    def fetch(offset):
+        try:
+            return _page_result(upstream.get(url, headers=headers, params=_params(offset)), error)
+        except requests.exceptions.RequestException as e:
+            return None, {'error': str(e), 'status': 502}
+
+    first, failed = fetch(0)
+    if failed:
+        yield line(failed)
+        return
+    items, total, offsets = _start(first)
+    yield line({'total': total})
+    for item in items:
+        yield line({'item': projection.project(item, keep)})
+    count = len(items)
+
+    offsets = iter(offsets)
+    pool = ThreadPoolExecutor(max_workers=_window(), thread_name_prefix='pages')
+    pending = deque(pool.submit(fetch, offset) for offset in islice(offsets, _window()))
+    try:
+        while pending:
+            page, failed = pending.popleft().result()
+            if failed:
+                yield line(failed)
+                return
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(pool.submit(fetch, offset))
+            # The collection can shrink while we page through it.
+            for item in (page.get('items') or [])[:total - count]:
+                yield line({'item': projection.project(item, keep)})
+                count += 1
+        yield line({'done': True, 'count': count})
+    finally:
+        # Also on a client disconnect: don't fetch pages nobody will read.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def astream_pages(url, access_token, error, keep=None):
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    async def fetch(offset):
+        try:
+            return _page_result(await upstream.aget(url, headers=headers, params=_params(offset)), error)
+        except httpx.HTTPError as e:
+            return None, {'error': str(e) or repr(e), 'status': 502}
+
+    first, failed = await fetch(0)
+    if failed:
+        yield line(failed)
+        return
+    items, total, offsets = _start(first)
+    yield line({'total': total})
+    for item in items:
+        yield line({'item': projection.project(item, keep)})
+    count = len(items)
+
+    offsets = iter(offsets)
+    pending = deque(asyncio.ensure_future(fetch(offset)) for offset in islice(offsets, _window()))
+    try:
+        while pending:
+            page, failed = await pending.popleft()
+            if failed:
+                yield line(failed)
+                return
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(asyncio.ensure_future(fetch(offset)))
+            for item in (page.get('items') or [])[:total - count]:
+                yield line({'item': projection.project(item, keep)})
+                count += 1
+        yield line({'done': True, 'count': count})
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def ndjson_response(lines):
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    response['Cache-Control'] = 'private, no-store'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def all_pages(url, error, keep=None):
+    """Serve `?all=1` on a paged view by streaming every item of `url`.
+
+    `url` is a template filled from the query string, like cached_view's
+    keys; `keep` is the view's projection of a page, whose `items` part is
+    applied to each item. Works on sync and async views alike.
+
+        @all_pages('https://api.spotify.com/v1/artists/{artist_id}/albums', 'Failed to fetch albums')
+    """
+    placeholders = [name for _, name, _, _ in Formatter().parse(url) if name]
+    keep_item = keep.get('items') if keep else None
+
+    def page_url(request):
+        values = {}
+        for name in placeholders:
+            value = request.GET.get(name)
+            if not value:
+                return None, JsonResponse({'error': f'{name} is required'}, status=400)
+            values[name] = quote(value, safe='')
+        return url.format(**values), None
+
+    def wants_all(request):
+        return request.GET.get('all') in ('1', 'true')
+
+    def decorator(func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(request, *args, access_token, **kwargs):
+                if not wants_all(request):
+                    return await func(request, *args, access_token=access_token, **kwargs)
+                target, invalid = page_url(request)
+                return invalid or ndjson_response(astream_pages(target, access_token, error, keep_item))
+        else:
+            @wraps(func)
+            def wrapper(request, *args, access_token, **kwargs):
+                if not wants_all(request):
+                    return func(request, *args, access_token=access_token, **kwargs)
+                target, invalid = page_url(request)
+                return invalid or ndjson_response(stream_pages(target, access_token, error, keep_item))
+        return wrapper
+    return decorator
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import ArtistHit
+
+
+# ─── Artist popularity ───────────────────────────────────────────────────────
+#
+# Artist page requests are counted per day so `manage.py warm_cache` knows
+# which artists to warm after a deploy or a cache wipe. Counts gather in the
+# process and are written at most every POPULARITY_FLUSH_INTERVAL seconds,
+# off the request thread; whatever hasn't been written when a worker exits
+# is lost, which only makes the ranking slightly less exact.
+
+_counts = Counter()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flush_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='popularity')
+
+
+def record(artist_id):
+    global _last_flush
+    with _lock:
+        _counts[artist_id] += 1
+        if time.monotonic() - _last_flush < getattr(settings, 'POPULARITY_FLUSH_INTERVAL', 60):
+            return
+        _last_flush = time.monotonic()
+    _flush_pool.submit(flush)
+
+
+def counted(view):
+    """Record the `artist_id` of every request to `view`, including ones
+    its cache answers. Goes outside cached_view, which skips the view on a hit."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.GET.get('artist_id'):
+                record(request.GET['artist_id'])
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.GET.get('artist_id'):
+                record(request.GET['artist_id'])
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+def flush():
+    with _lock:
+        counts = dict(_counts)
+        _counts.clear()
+    if not counts:
+        return
+
+    day = timezone.localdate()
+    try:
+        with transaction.atomic():
+            ArtistHit.objects.bulk_create(
+                [ArtistHit(spotify_id=artist_id, day=day) for artist_id in counts],
+                ignore_conflicts=True,
+            )
+            for artist_id, n in counts.items():
+                ArtistHit.objects.filter(spotify_id=artist_id, day=day).update(count=F('count') + n)
+    except Exception as e:
+        print(f"[popularity] flush failed: {e!r}")
+    finally:
+        close_old_connections()
+
+
+def top_artists(limit, days):
+    """Spotify IDs of the most requested artists over the last `days` days, most requested first."""
+    since = timezone.localdate() - timedelta(days=days)
+    return list(
+        ArtistHit.objects.filter(day__gt=since)
+        .values('spotify_id')
+        .annotate(total=Sum('count'))
+        .order_by('-total', 'spotify_id')
+        .values_list('spotify_id', flat=True)[:limit]
+    )
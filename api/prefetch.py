@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from . import caching, upstream, views
+from .tokens import get_valid_token
+
+
+# ─── Post-login prefetch ─────────────────────────────────────────────────────
+#
+# spotify_callback queues warm_user() once the token is stored, so the first
+# dashboard load after login is served from the cache. It fills the same
+# entries the views read: profile, top tracks and artists for every time
+# range, recently played, playlists, and the artist and albums of the user's
+# top few artists. Calls go through api/upstream.py like any other, so they
+# take from the shared budget (api/budget.py); an entry that already is fresh
+# is left alone, and a login within PREFETCH_COOLDOWN of the last one skips it.
+
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+
+
+def _warm(parts):
+    """Fetch the (key, fresh, stale, compute) parts that aren't fresh in the cache."""
+    parts = list(parts)
+    cached = caching.read_many((key for key, _, _, _ in parts), record=False)
+    todo = [part for part in parts if part[0] not in cached or cached[part[0]][1]]
+
+    def fetch(part):
+        key, fresh, stale, compute = part
+        return caching.fetch_once(key, fresh, compute, stale)
+
+    return dict(zip((key for key, _, _, _ in todo), upstream.fan_out(fetch, todo, limit=settings.PREFETCH_CONCURRENCY)))
+
+
+def warm_user(user):
+    """Fill the cache for `user`; returns {cache key: (data, error)} for what it fetched."""
+    access_token = get_valid_token(user)
+    if not access_token:
+        return {}
+
+    # The ranges the dashboard opens with come first.
+    ranges = ['short_term'] + [r for r in views.TIME_RANGES if r != 'short_term']
+    parts = [views.user_parts(user.id, access_token, time_range) for time_range in ranges]
+    first = parts[0]
+    rest = [part for by_name in parts[1:] for name, part in by_name.items() if name in ('top_tracks', 'top_artists')]
+    fetched = _warm(first.values())
+    fetched.update(_warm(rest))
+
+    # Top artists are full artist objects already: seed `artist-{id}` from
+    # them and only fetch the albums.
+    top_artists, _ = caching.read(first['top_artists'][0])
+    artists = ((top_artists or {}).get('items') or [])[:settings.PREFETCH_TOP_ARTISTS]
+    artist_parts = [views.artist_parts(artist['id'], access_token) for artist in artists]
+    known = caching.read_many((parts['artist'][0] for parts in artist_parts), record=False)
+    seeds = {
+        parts['artist'][0]: artist
+        for artist, parts in zip(artists, artist_parts)
+        if parts['artist'][0] not in known
+    }
+    if seeds:
+        caching.store_many(seeds, fresh=60*60*24, stale=60*60*24*7)
+    fetched.update(_warm(parts['albums'] for parts in artist_parts))
+    return fetched
+
+
+def _run(user):
+    try:
+        fetched = warm_user(user)
+        errors = sum(1 for _, error in fetched.values() if error)
+        print(f"[prefetch] user {user.id}: fetched {len(fetched)} entries, {errors} failed")
+    except Exception as e:
+        print(f"[prefetch] user {user.id} failed: {e!r}")
+    finally:
+        close_old_connections()
+
+
+def prefetch_user(user):
+    """Queue warm_user() off the request thread, at most once per PREFETCH_COOLDOWN."""
+    if not settings.PREFETCH_ON_LOGIN:
+        return False
+    if not cache.add(f'lock-prefetch-{user.id}', 1, timeout=settings.PREFETCH_COOLDOWN):
+        return False
+    _pool.submit(_run, user)
+    return True
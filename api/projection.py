@@ -0,0 +1,85 @@
+from urllib.parse import urlparse
+
+
+# ─── Field projection for Spotify responses ─────────────────────────────────
+#
+# Spotify sends far more than the frontend reads: available_markets on every
+# track and album, full album objects, seven search types. The proxy views
+# keep only the fields listed here, before the response is cached. Specs use
+# the syntax of Spotify's own `fields` parameter: `items(name,album(images))`.
+# A field without a sub-list is kept whole; lists are projected item by item.
+
+
+def parse(spec):
+    """'a,b(c,d)' -> {'a': None, 'b': {'c': None, 'd': None}}. Raises ValueError."""
+    fields = current = {}
+    stack = []
+    name = ''
+    for char in spec.replace(' ', ''):
+        if char in ',()':
+            if char == '(':
+                if not name:
+                    raise ValueError(f"field list without a name in {spec!r}")
+                stack.append(current)
+                current[name] = current = {}
+            elif name:
+                current[name] = None
+            if char == ')':
+                if not stack:
+                    raise ValueError(f"unbalanced ')' in {spec!r}")
+                current = stack.pop()
+            name = ''
+        else:
+            name += char
+    if stack:
+        raise ValueError(f"unbalanced '(' in {spec!r}")
+    if name:
+        current[name] = None
+    return fields
+
+
+def project(data, fields):
+    if fields is None:
+        return data
+    if isinstance(data, list):
+        return [project(item, fields) for item in data]
+    if not isinstance(data, dict):
+        return data
+    return {key: project(data[key], sub) for key, sub in fields.items() if key in data}
+
+
+def _page(items):
+    return f'items({items}),total,limit,offset,next,previous'
+
+
+TRACK = 'id,name,uri,duration_ms,explicit,external_urls,album(id,name,images),artists(id,name)'
+
+TOP_TRACKS = parse(_page(TRACK))
+
+RECENTLY_PLAYED = parse(f'items(played_at,track({TRACK})),next,cursors,limit')
+
+PLAYLIST = 'id,name,uri,images,public,external_urls,owner(id,display_name),tracks(total)'
+
+PLAYLISTS = parse(_page(PLAYLIST))
+
+SEARCH = parse(','.join([
+    f'tracks({_page(TRACK)})',
+    f"artists({_page('id,name,uri,images,genres,external_urls,followers(total)')})",
+    f"albums({_page('id,name,uri,images,album_type,release_date,external_urls,artists(id,name)')})",
+    f'playlists({_page(PLAYLIST)})',
+    f"episodes({_page('id,name,uri,images,description,duration_ms,release_date,external_urls')})",
+    f"shows({_page('id,name,uri,images,publisher,total_episodes,external_urls')})",
+    f"audiobooks({_page('id,name,uri,images,total_chapters,external_urls,authors(name)')})",
+]))
+
+# For call_next_api_url, which follows the `next` links of the endpoints above.
+BY_PATH = {
+    '/v1/me/top/tracks': TOP_TRACKS,
+    '/v1/me/player/recently-played': RECENTLY_PLAYED,
+    '/v1/me/playlists': PLAYLISTS,
+    '/v1/search': SEARCH,
+}
+
+
+def for_url(url):
+    return BY_PATH.get(urlparse(url).path.rstrip('/'))
@@ -0,0 +1,233 @@
+import asyncio
+import contextvars
+import json
+import time
+import uuid
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import upstream
+from .tokens import get_valid_token
+
+
+# ─── Currently-playing stream ────────────────────────────────────────────────
+#
+# One poller per user asks Spotify what is playing and pushes to every open
+# tab (Server-Sent Events) only when that changes: another track or device,
+# play/pause, or a seek. Between checks it sleeps as long as it can: rarely
+# when nothing is playing, and until the end of the track (capped) when
+# something is. Across workers one poller holds a lease in the shared cache
+# and publishes what it fetched; the others read that instead of Spotify.
+
+_pollers = weakref.WeakKeyDictionary()   # event loop -> {user_id: _Poller}
+
+
+def _loop_pollers():
+    return _pollers.setdefault(asyncio.get_running_loop(), {})
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _idle_interval():
+    return _setting('NOW_PLAYING_IDLE_INTERVAL', 15)
+
+
+def _paused_interval():
+    return _setting('NOW_PLAYING_PAUSED_INTERVAL', 5)
+
+
+def _playing_max_interval():
+    return _setting('NOW_PLAYING_MAX_INTERVAL', 8)
+
+
+def _min_interval():
+    return _setting('NOW_PLAYING_MIN_INTERVAL', 1)
+
+
+def _heartbeat():
+    return _setting('NOW_PLAYING_HEARTBEAT', 15)
+
+
+SEEK_TOLERANCE_MS = 3000
+
+
+def next_delay(payload):
+    """Seconds until it's worth asking Spotify again."""
+    item = payload.get('item')
+    if not item:
+        return _idle_interval()
+    if not payload.get('is_playing'):
+        return _paused_interval()
+    remaining = (item.get('duration_ms', 0) - payload.get('progress_ms', 0)) / 1000
+    return max(_min_interval(), min(remaining + 0.5, _playing_max_interval()))
+
+
+def _signature(payload):
+    item = payload.get('item') or {}
+    device = payload.get('device') or {}
+    return payload.get('is_playing'), item.get('id'), device.get('id')
+
+
+def _progress_at(payload, fetched_at, now):
+    progress = payload.get('progress_ms') or 0
+    if payload.get('is_playing'):
+        progress += int((now - fetched_at) * 1000)
+    return progress
+
+
+def changed(previous, previous_at, payload, fetched_at):
+    """Whether a client showing `previous` needs `payload`: new track/state, or a seek."""
+    if previous is None or _signature(previous) != _signature(payload):
+        return True
+    if not payload.get('item'):
+        return False
+    expected = _progress_at(previous, previous_at, fetched_at)
+    return abs((payload.get('progress_ms') or 0) - expected) > SEEK_TOLERANCE_MS
+
+
+def _now_playing(payload, fetched_at):
+    """`payload` with progress_ms moved on to now, for clients joining late."""
+    if not payload.get('is_playing'):
+        return payload
+    return {**payload, 'progress_ms': _progress_at(payload, fetched_at, time.time())}
+
+
+async def fetch_currently_playing(access_token):
+    response = await upstream.aget(
+        "https://api.spotify.com/v1/me/player/currently-playing",
+        params={"additional_types": "track"},
+        headers={'Authorization': f'Bearer {access_token}'},
+    )
+    if response.status_code == 204 or not response.content:
+        return {"is_playing": False}
+    if not response.is_success:
+        return None
+    return response.json()
+
+
+class _Poller:
+    def __init__(self, user):
+        self.user = user
+        self.owner = uuid.uuid4().hex
+        self.subscribers = set()
+        self.payload = None
+        self.fetched_at = 0
+        self.task = None
+
+    @property
+    def lease_key(self):
+        return f'lock-currently-playing-{self.user.id}'
+
+    @property
+    def state_key(self):
+        return f'live-currently-playing-{self.user.id}'
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.add(queue)
+        if self.payload is not None:
+            queue.put_nowait(_now_playing(self.payload, self.fetched_at))
+        if self.task is None or self.task.done():
+            # The poller outlives the request that started it, so it must
+            # not inherit that request's sync_to_async executor.
+            self.task = contextvars.Context().run(asyncio.get_running_loop().create_task, self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, payload, fetched_at):
+        if not changed(self.payload, self.fetched_at, payload, fetched_at):
+            self.payload, self.fetched_at = payload, fetched_at
+            return
+        self.payload, self.fetched_at = payload, fetched_at
+        for queue in list(self.subscribers):
+            # Slow readers only need the latest state.
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(payload)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                delay = await self.poll()
+            except Exception as e:
+                print(f"[currently-playing] user {self.user.id} poll failed: {e!r}")
+                delay = _paused_interval() * 2
+            await asyncio.sleep(delay)
+
+        # Nothing is awaited between the check above and this, so a new
+        # subscriber has either kept this poller running or will start another.
+        pollers = _loop_pollers()
+        if pollers.get(self.user.id) is self:
+            del pollers[self.user.id]
+        if await cache.aget(self.lease_key) == self.owner:
+            await cache.adelete(self.lease_key)
+
+    async def _hold_lease(self):
+        lease = _idle_interval() * 2
+        if await cache.aadd(self.lease_key, self.owner, timeout=lease):
+            return True
+        if await cache.aget(self.lease_key) == self.owner:
+            await cache.atouch(self.lease_key, lease)
+            return True
+        return False
+
+    async def poll(self):
+        """Fetch (or read what another worker fetched), publish, and return the next delay."""
+        if not await self._hold_lease():
+            shared = await cache.aget(self.state_key)
+            if shared is None:
+                return _min_interval()
+            self.publish(shared['payload'], shared['fetched_at'])
+            return max(_min_interval(), shared['next_poll'] - time.time() + 0.2)
+
+        try:
+            access_token = await sync_to_async(get_valid_token)(self.user)
+            payload = await fetch_currently_playing(access_token) if access_token else None
+        except httpx.HTTPError as e:
+            print(f"[currently-playing] user {self.user.id}: {e!r}")
+            payload = None
+        if payload is None:
+            return _paused_interval() * 2
+
+        fetched_at = time.time()
+        delay = next_delay(payload)
+        await cache.aset(
+            self.state_key,
+            {'payload': payload, 'fetched_at': fetched_at, 'next_poll': fetched_at + delay},
+            timeout=int(delay + _idle_interval() * 2),
+        )
+        self.publish(payload, fetched_at)
+        return delay
+
+
+def _event(payload):
+    return f"event: currently_playing\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+async def currently_playing_events(user):
+    """SSE lines for one connection; the poller is shared by all of the user's connections."""
+    pollers = _loop_pollers()
+    poller = pollers.get(user.id)
+    if poller is None:
+        poller = pollers[user.id] = _Poller(user)
+    queue = poller.subscribe()
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), timeout=_heartbeat())
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _event(payload)
+    finally:
+        poller.unsubscribe(queue)
@@ -1,3 +1,1560 @@
-from django.test import TestCase
+import asyncio
+import gc
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import Client, SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import (
+    budget, cache_backends, caching, catalog, metrics, musicbrainz, paging, popularity, prefetch, projection, streams, tokens, upstream,
+)
+from .models import CatalogTrack, MusicBrainzArtist, SpotifyToken
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def file_caches(directory):
+    """The deployed setup: TieredCache in front of a FileCache in `directory`."""
+    return {
+        'default': {
+            'BACKEND': 'api.cache_backends.TieredCache',
+            'LOCATION': directory,
+            'OPTIONS': {'L2': 'shared', 'L1_BYPASS': ('lock-', 'stats-', 'spotify-token-', 'budget-')},
+        },
+        'shared': {'BACKEND': 'api.cache_backends.FileCache', 'LOCATION': directory},
+    }
+
+
+def fake_response(status, payload=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(payload).encode() if payload is not None else b''
+    return response
+
+
+class AuthedTestCase(TransactionTestCase):
+    """Empty caches, a user 'listener' with a Spotify token, and a JWT for them."""
+
+    access_token = 'token'
+    expires_in = timedelta(hours=1)
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        tokens._local.clear()
+        tokens._user_locks.clear()
+
+        self.user = User.objects.create(username='listener')
+        self.token = SpotifyToken.objects.create(
+            user=self.user,
+            access_token=self.access_token,
+            refresh_token='refresh-token',
+            expires_at=timezone.now() + self.expires_in,
+        )
+        self.jwt = str(RefreshToken.for_user(self.user).access_token)
+
+    def get(self, path, params=None, **headers):
+        return Client().get(path, params, HTTP_AUTHORIZATION=f'Bearer {self.jwt}', **headers)
+
+    def post(self, path, data, **headers):
+        return Client().post(
+            path, data, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {self.jwt}', **headers,
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class SingleFlightTokenRefreshTests(AuthedTestCase):
+    CONCURRENCY = 25
+    access_token = 'expired-token'
+    expires_in = -timedelta(minutes=5)
+
+    def setUp(self):
+        super().setUp()
+        self.refreshes = 0
+        self.counter_lock = threading.Lock()
+
+    def fake_upstream(self, method, url, **kwargs):
+        if url == 'https://accounts.spotify.com/api/token':
+            with self.counter_lock:
+                self.refreshes += 1
+            time.sleep(0.2)
+            return fake_response(200, {'access_token': 'fresh-token', 'expires_in': 3600})
+
+        return fake_response(200, {'is_playing': True, 'auth': kwargs['headers']['Authorization']})
+
+    def hammer(self):
+        results = []
+        barrier = threading.Barrier(self.CONCURRENCY)
+
+        def poll():
+            try:
+                barrier.wait()
+                response = self.get('/api/get_currently_playing/')
+                results.append((response.status_code, response.json().get('auth')))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=poll) for _ in range(self.CONCURRENCY)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def assert_single_refresh(self, results):
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(len(results), self.CONCURRENCY)
+        self.assertEqual(set(results), {(200, 'Bearer fresh-token')})
+        self.assertEqual(SpotifyToken.objects.get(user=self.user).access_token, 'fresh-token')
+
+    def test_concurrent_requests_with_expired_token_refresh_once(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            results = self.hammer()
+
+        self.assert_single_refresh(results)
+
+    def test_shared_cache_lock_alone_keeps_refresh_single_flight(self):
+        # A fresh lock per call stands in for callers in separate workers,
+        # leaving only the lock in the shared file cache to coordinate them.
+        with tempfile.TemporaryDirectory() as directory, override_settings(CACHES=file_caches(directory)), \
+                mock.patch('api.upstream.request', side_effect=self.fake_upstream), \
+                mock.patch('api.tokens._user_lock', side_effect=lambda user_id: threading.Lock()):
+            results = self.hammer()
+
+        self.assert_single_refresh(results)
+
+    def test_per_user_locks_are_dropped_once_nobody_holds_them(self):
+        held = tokens._user_lock(self.user.id)
+        self.assertIs(tokens._user_lock(self.user.id), held)
+
+        del held
+        gc.collect()
+        self.assertEqual(len(tokens._user_locks), 0)
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            self.hammer()
+        gc.collect()
+        self.assertEqual(len(tokens._user_locks), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, PREFETCH_ON_LOGIN=False)
+class TokenCacheTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.refreshes = 0
+
+    def fake_accounts(self, method, url, **kwargs):
+        if url == 'https://accounts.spotify.com/api/token':
+            if kwargs['data']['grant_type'] == 'authorization_code':
+                return fake_response(200, {'access_token': 'login-token', 'refresh_token': 'r', 'expires_in': 3600})
+            self.refreshes += 1
+            time.sleep(0.2)
+            return fake_response(200, {'access_token': f'refreshed-token-{self.refreshes}', 'expires_in': 3600})
+        return fake_response(200, {'id': 'listener', 'email': 'listener@example.com'})
+
+    def test_repeat_lookups_skip_the_database(self):
+        self.assertEqual(tokens.get_valid_token(self.user), 'token')
+        with self.assertNumQueries(0), mock.patch('api.tokens.cache.get') as shared_get:
+            self.assertEqual(tokens.get_valid_token(self.user), 'token')
+        shared_get.assert_not_called()
+
+        # Past SPOTIFY_TOKEN_LOCAL_TTL the shared cache answers, still not the database.
+        tokens._local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(tokens.get_valid_token(self.user), 'token')
+
+    def test_refresh_and_login_replace_the_cached_token(self):
+        self.assertEqual(tokens.get_valid_token(self.user), 'token')
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_accounts):
+            SpotifyToken.objects.filter(pk=self.token.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+            tokens.refresh_spotify_token(SpotifyToken.objects.get(pk=self.token.pk))
+            with self.assertNumQueries(0):
+                self.assertEqual(tokens.get_valid_token(self.user), 'refreshed-token-1')
+
+            response = Client().get('/api/auth/spotify/callback/', {'code': 'code'})
+            self.assertIn('/dashboard?access=', response['Location'])
+            with self.assertNumQueries(0):
+                self.assertEqual(tokens.get_valid_token(self.user), 'login-token')
+
+        failed = fake_response(400, {'error': 'invalid_grant'})
+        with mock.patch('api.upstream.request', return_value=failed):
+            self.assertIsNone(tokens.refresh_spotify_token(SpotifyToken.objects.get(user=self.user)))
+        self.assertIsNone(tokens._cached_token(self.user.id))
+
+    def test_tokens_close_to_expiry_refresh_in_the_background(self):
+        SpotifyToken.objects.filter(pk=self.token.pk).update(expires_at=timezone.now() + timedelta(seconds=60))
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_accounts):
+            started = time.monotonic()
+            self.assertEqual(tokens.get_valid_token(self.user), 'token')
+            self.assertLess(time.monotonic() - started, 0.2)
+
+            for _ in range(40):
+                if tokens.get_valid_token(self.user) != 'token':
+                    break
+                time.sleep(0.05)
+
+        self.assertEqual(tokens.get_valid_token(self.user), 'refreshed-token-1')
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(SpotifyToken.objects.get(user=self.user).access_token, 'refreshed-token-1')
+
+
+class ConnMaxAgeTests(SimpleTestCase):
+    def conn_max_age(self, entry_point):
+        env = {k: v for k, v in os.environ.items() if k not in ('CONN_MAX_AGE', 'API_ASYNC_VIEWS')}
+        code = (
+            f'import spotify.{entry_point}; from django.conf import settings; '
+            "print(settings.DATABASES['default']['CONN_MAX_AGE'])"
+        )
+        return int(subprocess.check_output([sys.executable, '-c', code], env=env, text=True))
+
+    def test_connections_persist_under_wsgi_only(self):
+        self.assertEqual(self.conn_max_age('wsgi'), 600)
+        self.assertEqual(self.conn_max_age('asgi'), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SQLITE_LOCK_RETRIES=3)
+class RetryLockedTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics._series.clear()
+
+    def locked_saves(self, failures):
+        """SpotifyToken.save, failing `failures` times with SQLite's lock error first."""
+        save = SpotifyToken.save
+        attempts = []
+
+        def flaky_save(token, *args, **kwargs):
+            attempts.append(1)
+            if len(attempts) <= failures:
+                raise OperationalError('database is locked')
+            return save(token, *args, **kwargs)
+
+        return mock.patch.object(SpotifyToken, 'save', flaky_save), attempts
+
+    def retries(self):
+        return metrics.snapshot().get(('db_lock_retries_total', ()), 0)
+
+    def test_locked_write_is_retried_until_it_goes_through(self):
+        locked, attempts = self.locked_saves(failures=2)
+        self.token.access_token = 'new-token'
+        with locked, mock.patch('api.tokens.time.sleep') as sleep:
+            tokens.retry_locked(self.token.save)
+
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.retries(), 2)
+        self.assertEqual(SpotifyToken.objects.get(pk=self.token.pk).access_token, 'new-token')
+
+    def test_gives_up_after_sqlite_lock_retries(self):
+        locked, attempts = self.locked_saves(failures=10)
+        self.token.access_token = 'new-token'
+        with locked, mock.patch('api.tokens.time.sleep'):
+            with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                tokens.retry_locked(self.token.save)
+
+        self.assertEqual(len(attempts), 4)
+        self.assertEqual(self.retries(), 3)
+        self.assertEqual(SpotifyToken.objects.get(pk=self.token.pk).access_token, 'token')
+
+    def test_other_database_errors_are_not_retried(self):
+        write = mock.Mock(side_effect=OperationalError('no such table: api_spotifytoken'))
+        with self.assertRaises(OperationalError):
+            tokens.retry_locked(write)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self.retries(), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class CacheCoalescingTests(AuthedTestCase):
+    CONCURRENCY = 20
+
+    def setUp(self):
+        super().setUp()
+        self.fetches = 0
+        self.counter_lock = threading.Lock()
+
+    def fake_upstream(self, method, url, **kwargs):
+        with self.counter_lock:
+            self.fetches += 1
+        time.sleep(0.2)
+        return fake_response(200, {'id': 'artist-1', 'name': 'Artist'})
+
+    def test_concurrent_misses_on_one_key_fetch_upstream_once(self):
+        saved_before = caching.stats()['upstream_calls_saved']['process']
+        statuses = []
+        barrier = threading.Barrier(self.CONCURRENCY)
+
+        def request_artist():
+            try:
+                barrier.wait()
+                response = self.get('/api/get_artist/', {'artist_id': 'artist-1'})
+                statuses.append((response.status_code, response.json()['name']))
+            finally:
+                connection.close()
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            threads = [threading.Thread(target=request_artist) for _ in range(self.CONCURRENCY)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(set(statuses), {(200, 'Artist')})
+        self.assertEqual(len(statuses), self.CONCURRENCY)
+        self.assertEqual(caching.stats()['upstream_calls_saved']['process'] - saved_before, self.CONCURRENCY - 1)
+
+
+    def async_artist_requests(self, n):
+        from django.test import AsyncRequestFactory
+        from . import async_views
+
+        async def request_artist():
+            request = AsyncRequestFactory().get(
+                '/api/get_artist/', {'artist_id': 'artist-1'}, headers={'Authorization': f'Bearer {self.jwt}'},
+            )
+            response = await async_views.get_artist(request)
+            return response.status_code, json.loads(response.content)['name']
+
+        async def run():
+            return await asyncio.gather(*(request_artist() for _ in range(n)))
+
+        return asyncio.run(run())
+
+    async def fake_arequest(self, method, url, **kwargs):
+        with self.counter_lock:
+            self.fetches += 1
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json={'id': 'artist-1', 'name': 'Artist'}, request=httpx.Request(method, url))
+
+    def test_concurrent_async_misses_fetch_upstream_once(self):
+        with mock.patch('api.upstream.arequest', side_effect=self.fake_arequest):
+            results = self.async_artist_requests(self.CONCURRENCY)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(results, [(200, 'Artist')] * self.CONCURRENCY)
+
+    def test_async_misses_wait_for_another_workers_fetch(self):
+        from django.core.cache import cache
+        cache.add('lock-artist-artist-1', 1)
+
+        def other_worker():
+            time.sleep(0.2)
+            caching.store('artist-artist-1', {'id': 'artist-1', 'name': 'Artist'}, fresh=60)
+            cache.delete('lock-artist-artist-1')
+
+        threading.Thread(target=other_worker).start()
+        with mock.patch('api.upstream.arequest', side_effect=self.fake_arequest):
+            results = self.async_artist_requests(3)
+
+        self.assertEqual(self.fetches, 0)
+        self.assertEqual(results, [(200, 'Artist')] * 3)
+
+    def fail_in_other_worker(self):
+        # Another worker takes the lock, its fetch raises, and it lets go
+        # without storing anything.
+        from django.core.cache import cache
+        cache.add('lock-artist-artist-1', 1)
+
+        def other_worker():
+            time.sleep(0.2)
+            cache.delete('lock-artist-artist-1')
+
+        threading.Thread(target=other_worker).start()
+
+    def test_waiting_workers_pick_a_new_fetcher_when_the_lock_holder_fails(self):
+        def fetch_artist():
+            time.sleep(0.1)
+            return {'name': 'Artist'}, None
+
+        compute = mock.Mock(side_effect=fetch_artist)
+        results = []
+
+        def waiting_worker():
+            results.append(caching._data(caching._fetch_across_workers('artist-artist-1', 60, compute, 0)))
+
+        self.fail_in_other_worker()
+        start = time.monotonic()
+        threads = [threading.Thread(target=waiting_worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(results, [({'name': 'Artist'}, None)] * 5)
+
+    def test_async_waiters_pick_a_new_fetcher_when_the_lock_holder_fails(self):
+        self.fail_in_other_worker()
+        start = time.monotonic()
+        with mock.patch('api.upstream.arequest', side_effect=self.fake_arequest):
+            results = self.async_artist_requests(3)
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(results, [(200, 'Artist')] * 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class CachedViewTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fetches = 0
+        self.fetched = threading.Event()
+
+    def fake_upstream(self, method, url, **kwargs):
+        self.fetches += 1
+        time.sleep(0.2)
+        self.fetched.set()
+        return fake_response(200, {'id': 'artist-1', 'name': 'Renamed'})
+
+    def get_artist(self):
+        return self.get('/api/get_artist/', {'artist_id': 'artist-1'})
+
+    def test_stale_entry_is_served_while_it_refreshes_in_the_background(self):
+        from django.core.cache import cache
+        cache.set('artist-artist-1', caching.Entry({'id': 'artist-1', 'name': 'Artist'}, time.time() - 1), timeout=60)
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            started = time.monotonic()
+            response = self.get_artist()
+            self.assertLess(time.monotonic() - started, 0.2)
+            self.assertEqual(response.json()['name'], 'Artist')
+
+            self.assertTrue(self.fetched.wait(2))
+            for _ in range(40):
+                data, is_stale = caching.read('artist-artist-1')
+                if not is_stale:
+                    break
+                time.sleep(0.05)
+
+            self.assertEqual(self.get_artist().json()['name'], 'Renamed')
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_cached_responses_carry_an_etag_and_answer_if_none_match_with_304(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            first = self.get_artist()
+        etag = first['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        response = self.get('/api/get_artist/', {'artist_id': 'artist-1'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+        narrowed = self.get('/api/get_artist/', {'artist_id': 'artist-1', 'fields': 'name'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(narrowed.status_code, 200)
+        self.assertEqual(narrowed.json(), {'name': 'Renamed'})
+        self.assertNotEqual(narrowed['ETag'], etag)
+        self.assertEqual(self.fetches, 1)
+
+    def test_empty_parameters_reach_the_views_own_check(self):
+        for path, params, status, body in [
+            ('/api/search_item/', {'q': ''}, 400, {'error': 'q is required'}),
+            ('/api/get_artist/', {'artist_id': ''}, 200, {'error': 'artist_id is required'}),
+            ('/api/get_similar_artist_links/', {'artist_mbid': ''}, 400, {'error': 'artist_mbid is required'}),
+            ('/api/call_next_api_url/', {'next_url': ''}, 200, 'error getting next url'),
+        ]:
+            with self.subTest(path), mock.patch('api.upstream.request') as request:
+                response = self.get(path, params)
+                self.assertEqual((response.status_code, response.json()), (status, body))
+                request.assert_not_called()
+
+    def test_hits_are_served_from_stored_compressed_bytes(self):
+        payload = {'id': 'artist-1', 'genres': [f'genre {n}' for n in range(200)]}
+        with mock.patch('api.upstream.request', return_value=fake_response(200, payload)):
+            self.get_artist()
+
+        with mock.patch('rest_framework.renderers.JSONRenderer.render') as render:
+            response = self.get('/api/get_artist/', {'artist_id': 'artist-1'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        render.assert_not_called()
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content)), payload)
+
+    def test_cached_artist_requests_still_count_towards_popularity(self):
+        from django.test import AsyncRequestFactory
+        from . import async_views
+        popularity._counts.clear()
+
+        async def async_get_artist():
+            request = AsyncRequestFactory().get(
+                '/api/get_artist/', {'artist_id': 'artist-1'}, headers={'Authorization': f'Bearer {self.jwt}'},
+            )
+            return await async_views.get_artist(request)
+
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            for _ in range(3):
+                self.assertEqual(self.get_artist().status_code, 200)
+        with mock.patch('api.upstream.arequest') as arequest:
+            for _ in range(2):
+                self.assertEqual(asyncio.run(async_get_artist()).status_code, 200)
+            arequest.assert_not_called()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(popularity._counts['artist-1'], 5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class AsyncViewParityTests(AuthedTestCase):
+    """The async views answer auth, rate limits and cache hits as the sync ones do."""
+
+    def sync_get(self, authorization=None, **headers):
+        if authorization:
+            headers['HTTP_AUTHORIZATION'] = authorization
+        response = Client().get('/api/get_artist/', {'artist_id': 'artist-1'}, **headers)
+        return response.status_code, response.content, response.get('ETag')
+
+    def async_get(self, authorization=None, **headers):
+        from django.test import AsyncRequestFactory
+        from . import async_views
+
+        if authorization:
+            headers['Authorization'] = authorization
+        request = AsyncRequestFactory().get('/api/get_artist/', {'artist_id': 'artist-1'}, headers=headers)
+        response = asyncio.run(async_views.get_artist(request))
+        return response.status_code, response.content, response.get('ETag')
+
+    def assertSameAnswer(self, sync, async_):
+        self.assertEqual(sync[0], async_[0])
+        self.assertEqual(json.loads(sync[1]), json.loads(async_[1]))
+
+    def test_auth_failures(self):
+        for authorization in (None, 'Bearer not-a-jwt'):
+            sync, async_ = self.sync_get(authorization), self.async_get(authorization)
+            self.assertEqual(sync[0], 401)
+            self.assertSameAnswer(sync, async_)
+
+        SpotifyToken.objects.all().delete()
+        sync, async_ = self.sync_get(f'Bearer {self.jwt}'), self.async_get(f'Bearer {self.jwt}')
+        self.assertEqual(json.loads(sync[1]), {'error': 'token_expired'})
+        self.assertSameAnswer(sync, async_)
+
+    def test_rate_limit_is_shared(self):
+        upstream_artist = fake_response(200, {'id': 'artist-1', 'name': 'Artist'})
+        # One rate-limit window for the whole test.
+        with mock.patch('django_ratelimit.core._get_window', return_value=int(time.time()) + 60), \
+                mock.patch('api.upstream.request', return_value=upstream_artist):
+            for _ in range(50):
+                self.assertEqual(self.sync_get(f'Bearer {self.jwt}')[0], 200)
+                self.assertEqual(self.async_get(f'Bearer {self.jwt}')[0], 200)
+            sync, async_ = self.sync_get(f'Bearer {self.jwt}'), self.async_get(f'Bearer {self.jwt}')
+
+        self.assertEqual(sync[0], 429)
+        self.assertSameAnswer(sync, async_)
+
+    def test_cache_entries_are_shared(self):
+        upstream_artist = fake_response(200, {'id': 'artist-1', 'name': 'Artist'})
+        with mock.patch('api.upstream.request', return_value=upstream_artist):
+            sync = self.sync_get(f'Bearer {self.jwt}')
+        with mock.patch('api.upstream.arequest') as arequest:
+            async_ = self.async_get(f'Bearer {self.jwt}')
+            not_modified = self.async_get(f'Bearer {self.jwt}', **{'If-None-Match': sync[2]})
+        arequest.assert_not_called()
+
+        self.assertEqual(sync, async_)
+        self.assertEqual(not_modified, (304, b'', sync[2]))
+
+
+def race_file_cache(directory, barrier, wins, increments):
+    # One "worker": an add() on a shared key, then a run of incr()s.
+    file_cache = cache_backends.FileCache(directory, {})
+    barrier.wait()
+    if file_cache.add('lock-key', os.getpid(), timeout=30):
+        with wins.get_lock():
+            wins.value += 1
+    for _ in range(increments):
+        file_cache.incr('counter')
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-tests'},
+})
+class TieredCacheTests(SimpleTestCase):
+    def tiered(self, **options):
+        from django.core.cache import caches
+        caches['shared'].clear()
+        location = f'tiered-{self._testMethodName}'
+        cache_backends._stores.pop(location, None)
+        return cache_backends.TieredCache(location, {'OPTIONS': {'L2': 'shared', **options}}), caches['shared']
+
+    def test_l1_is_bounded_by_bytes_and_evicts_least_recently_used(self):
+        value = 'x' * 1000
+        tier, l2 = self.tiered(L1_MAX_BYTES=3500)
+        for key in 'abc':
+            tier.set(key, value)
+        tier.get('a')
+        tier.set('d', value)
+
+        self.assertEqual(list(tier._l1.entries), [tier.make_key(key) for key in 'cad'])
+        self.assertLessEqual(tier._l1.bytes, 3500)
+        self.assertEqual(tier.stats()['l1_evictions'], 1)
+        # Evicted from L1 only: the next read falls through to L2.
+        self.assertEqual(tier.get('b'), value)
+        self.assertEqual(tier.stats()['l2_hits'], 1)
+
+    def test_l1_copies_expire_after_l1_timeout(self):
+        tier, l2 = self.tiered(L1_TIMEOUT=0.1)
+        tier.set('key', 'first')
+        l2.set('key', 'second')     # another worker's write
+        self.assertEqual(tier.get('key'), 'first')
+        time.sleep(0.15)
+        self.assertEqual(tier.get('key'), 'second')
+
+    def test_l2_misses_and_hits_fill_l1(self):
+        tier, l2 = self.tiered()
+        self.assertIsNone(tier.get('key'))
+        l2.set('key', 'value')
+        self.assertEqual(tier.get_many(['key', 'other']), {'key': 'value'})
+        l2.delete('key')
+        self.assertEqual(tier.get('key'), 'value')
+        self.assertEqual(tier.stats()['misses'], 2)
+
+    def test_bypassed_keys_add_and_incr_only_live_in_l2(self):
+        tier, l2 = self.tiered(L1_BYPASS=('lock-', 'stats-'))
+        tier.set('lock-a', 1)
+        self.assertTrue(tier.add('lock-b', 1))
+        self.assertFalse(tier.add('lock-b', 2))
+        tier.set('stats-n', 1)
+        tier.get('stats-n')
+        self.assertEqual(tier.incr('stats-n'), 2)
+        self.assertEqual(tier._l1.entries, {})
+        self.assertEqual(l2.get_many(['lock-a', 'lock-b', 'stats-n']), {'lock-a': 1, 'lock-b': 1, 'stats-n': 2})
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'api.cache_backends.TieredCache', 'LOCATION': 'tiered-refresh', 'OPTIONS': {'L2': 'shared'}},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-refresh'},
+    })
+    def test_background_refresh_takes_another_workers_fresh_entry(self):
+        from django.core.cache import cache, caches
+        cache.clear()
+        cache.set('artist-a', caching.Entry({'name': 'old'}, time.time() - 1))
+        # Another worker refreshed it; this one's L1 still has the stale copy.
+        caches['shared'].set('artist-a', caching.Entry({'name': 'new'}, time.time() + 60))
+        self.assertTrue(caching.read_entry('artist-a').is_stale)
+
+        compute = mock.Mock(return_value=({'name': 'newer'}, None))
+        caching._refresh('artist-a', 60, compute, 0)
+        asyncio.run(caching._arefresh('artist-a', 60, mock.AsyncMock(side_effect=compute), 0))
+
+        compute.assert_not_called()
+        self.assertEqual(caching.read('artist-a'), ({'name': 'new'}, False))
+
+    def test_file_cache_add_and_incr_are_atomic_across_processes(self):
+        workers, increments = 8, 25
+        context = multiprocessing.get_context('fork')
+        barrier, wins = context.Barrier(workers), context.Value('i', 0)
+        with tempfile.TemporaryDirectory() as directory:
+            cache_backends.FileCache(directory, {}).set('counter', 0, timeout=60)
+            processes = [
+                context.Process(target=race_file_cache, args=(directory, barrier, wins, increments))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+            file_cache = cache_backends.FileCache(directory, {})
+            self.assertEqual(wins.value, 1)
+            self.assertEqual(file_cache.get('counter'), workers * increments)
+            with self.assertRaises(ValueError):
+                file_cache.incr('missing')
+
+    def test_file_cache_culls_once_per_interval_not_on_every_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_cache = cache_backends.FileCache(directory, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_INTERVAL': 60}})
+            with mock.patch.object(file_cache, '_list_cache_files', wraps=file_cache._list_cache_files) as scan:
+                for i in range(30):
+                    file_cache.set(f'key-{i}', i)
+                    file_cache.add(f'lock-{i}', i)
+                file_cache.set('counter', 0)
+                for _ in range(10):
+                    file_cache.incr('counter')
+                self.assertEqual(scan.call_count, 1)
+
+                cache_backends._next_cull[file_cache._dir] = 0
+                file_cache.set('one-more', 1)
+                self.assertEqual(scan.call_count, 2)
+            # Past MAX_ENTRIES, a cull drops a third of the 62 entries.
+            self.assertEqual(len(file_cache._list_cache_files()), 42)
+
+
+class ProjectionTests(SimpleTestCase):
+    def test_parse_nested_field_lists(self):
+        self.assertEqual(
+            projection.parse('items(name,album(images)),next'),
+            {'items': {'name': None, 'album': {'images': None}}, 'next': None},
+        )
+        for spec in ('items(name', 'name)', '(name)'):
+            with self.assertRaises(ValueError):
+                projection.parse(spec)
+
+    def test_project_keeps_listed_fields_through_lists(self):
+        data = {
+            'items': [
+                {'name': 'a', 'available_markets': ['SE'], 'album': {'images': [{'url': 'x'}], 'available_markets': ['SE']}},
+                None,
+            ],
+            'next': None,
+            'href': 'h',
+        }
+        self.assertEqual(
+            projection.project(data, projection.parse('items(name,album(images)),next')),
+            {'items': [{'name': 'a', 'album': {'images': [{'url': 'x'}]}}, None], 'next': None},
+        )
+
+
+class CurrentlyPlayingStreamTests(SimpleTestCase):
+    def test_next_poll_waits_for_the_end_of_the_track_within_bounds(self):
+        track = {'id': 't1', 'duration_ms': 200_000}
+        self.assertEqual(streams.next_delay({'is_playing': False}), streams._idle_interval())
+        self.assertEqual(streams.next_delay({'is_playing': False, 'item': track}), streams._paused_interval())
+        self.assertEqual(streams.next_delay({'is_playing': True, 'item': track, 'progress_ms': 197_000}), 3.5)
+        self.assertEqual(streams.next_delay({'is_playing': True, 'item': track, 'progress_ms': 0}), streams._playing_max_interval())
+
+    def test_only_new_state_or_a_seek_counts_as_a_change(self):
+        playing = {'is_playing': True, 'progress_ms': 10_000, 'item': {'id': 't1'}}
+        self.assertTrue(streams.changed(None, 0, playing, 100))
+        self.assertFalse(streams.changed(playing, 100, {**playing, 'progress_ms': 15_000}, 105))
+        self.assertTrue(streams.changed(playing, 100, {**playing, 'progress_ms': 60_000}, 105))
+        self.assertTrue(streams.changed(playing, 100, {**playing, 'is_playing': False}, 105))
+        self.assertTrue(streams.changed(playing, 100, {**playing, 'item': {'id': 't2'}}, 105))
+
+
+class FakeSpotify(BaseHTTPRequestHandler):
+    """Answers every request with the server's next (status, headers) pair."""
+
+    protocol_version = 'HTTP/1.1'   # keep-alive, so pooled clients can reuse a connection
+
+    def do_GET(self):
+        self.server.hits += 1
+        self.server.connections.add(self.client_address)
+        status, headers = self.server.replies.pop(0) if self.server.replies else (200, {})
+        body = b'{"error": "slow down"}' if status == 429 else b'{"id": "artist-1"}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_spotify(test):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSpotify)
+    server.hits = 0
+    server.replies = []
+    server.connections = set()     # client (host, port) pairs seen
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UpstreamClientTests(SimpleTestCase):
+    def setUp(self):
+        upstream.close()
+        self.addCleanup(upstream.close)
+        self.server = start_fake_spotify(self)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v1/artists/artist-1'
+
+    def test_repeated_calls_reuse_one_connection(self):
+        for _ in range(5):
+            self.assertEqual(upstream.get(self.url).status_code, 200)
+        self.assertEqual(self.server.hits, 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_fanned_out_calls_reuse_the_hosts_pool(self):
+        for _ in range(3):
+            upstream.fan_out(lambda n: upstream.get(self.url), range(4), limit=4)
+        self.assertEqual(self.server.hits, 12)
+        self.assertLessEqual(len(self.server.connections), 4)
+
+    @override_settings(UPSTREAM_POOL_MAXSIZE=4, UPSTREAM_POOL_SIZES={'api.spotify.com': 20})
+    def test_one_session_and_pool_per_host(self):
+        session = upstream.session_for(self.url)
+        self.assertIs(upstream.session_for(self.url + '/albums'), session)
+        spotify = upstream.session_for('https://api.spotify.com/v1/me')
+        self.assertIsNot(spotify, session)
+        self.assertEqual(session.get_adapter(self.url)._pool_maxsize, 4)
+        self.assertEqual(spotify.get_adapter('https://api.spotify.com/')._pool_maxsize, 20)
+
+    def test_async_calls_reuse_one_connection(self):
+        async def calls():
+            return [(await upstream.aget(self.url)).status_code for _ in range(5)]
+
+        self.assertEqual(asyncio.run(calls()), [200] * 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+
+def spend_budget(url, barrier, calls, allowed):
+    # One "worker" calling a budgeted host.
+    barrier.wait()
+    for _ in range(calls):
+        if budget.acquire(url, {'Authorization': f'Bearer {os.getpid()}'}) == 0:
+            with allowed.get_lock():
+                allowed.value += 1
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, UPSTREAM_BUDGET_MAX_WAIT=0)
+class UpstreamBudgetTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = start_fake_spotify(self)
+        self.host = f'127.0.0.1:{self.server.server_port}'
+        self.url = f'http://{self.host}/v1/artists/artist-1'
+
+        budgets = override_settings(UPSTREAM_BUDGETS={
+            self.host: {'window': 3600, 'app': 5, 'token': 3},
+            'api.spotify.com': {'window': 3600, 'app': 100},
+        })
+        budgets.enable()
+        self.addCleanup(budgets.disable)
+
+    def call(self, token='a'):
+        return upstream.get(self.url, headers={'Authorization': f'Bearer {token}'})
+
+    def test_retry_after_pauses_calls_until_it_has_passed(self):
+        self.server.replies = [(429, {'Retry-After': '30'})]
+        self.assertEqual(self.call().status_code, 429)
+
+        response = self.call(token='b')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), {'error': 'upstream_throttled'})
+        self.assertIn(int(response.headers['Retry-After']), (29, 30))
+        self.assertEqual(self.server.hits, 1)
+
+    def test_calls_beyond_the_app_and_token_budgets_never_reach_the_host(self):
+        statuses = [self.call().status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+
+        statuses = [self.call(token='b').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.server.hits, 5)
+
+    def test_workers_share_one_budget(self):
+        workers, calls = 8, 10
+        context = multiprocessing.get_context('fork')
+        barrier, allowed = context.Barrier(workers), context.Value('i', 0)
+        budgets = {'budget.test': {'window': 10**6, 'app': 30, 'token': 8}}
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(CACHES=file_caches(directory), UPSTREAM_BUDGETS=budgets):
+            processes = [
+                context.Process(target=spend_budget, args=('https://budget.test/v1/me', barrier, calls, allowed))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+        # Each worker's token may take 8; all of them together, 30.
+        self.assertEqual(allowed.value, 30)
+
+    def test_cached_responses_are_still_served_while_throttled(self):
+        caching.store('artist-artist-1', {'id': 'artist-1', 'name': 'Artist'}, fresh=60)
+        budget.observe('https://api.spotify.com/v1/me', 429, {'Retry-After': '30'})
+
+        with mock.patch('api.upstream.session_for') as session_for:
+            cached = self.get('/api/get_artist/', {'artist_id': 'artist-1'})
+            uncached = self.get('/api/get_artist/', {'artist_id': 'artist-2'})
+        session_for.assert_not_called()
+
+        self.assertEqual(cached.status_code, 200)
+        self.assertEqual(cached.json()['name'], 'Artist')
+        self.assertEqual(uncached.status_code, 429)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MUSICBRAINZ_INTERVAL=0.1)
+class MusicBrainzQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def fake_musicbrainz(self, method, url, **kwargs):
+        self.calls.append((time.monotonic(), url))
+        mbid = url.split('/artist/')[1].split('?')[0]
+        if mbid == 'unlinked':
+            return fake_response(200, {'relations': []})
+        return fake_response(200, {'relations': [
+            {'url': {'resource': f'https://www.wikidata.org/wiki/{mbid}'}},
+            {'url': {'resource': f'https://open.spotify.com/artist/{mbid}'}},
+        ]})
+
+    def test_lookups_are_paced_merged_and_stored(self):
+        mbids = ['a', 'b', 'unlinked']
+        with mock.patch('api.upstream.request', side_effect=self.fake_musicbrainz):
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(musicbrainz.spotify_urls(mbids, wait=5)))
+                for _ in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            again = musicbrainz.spotify_urls(mbids, wait=5)
+
+        expected = {'a': 'https://open.spotify.com/artist/a', 'b': 'https://open.spotify.com/artist/b', 'unlinked': ''}
+        self.assertEqual(results, [expected] * 3)
+        self.assertEqual(again, expected)
+        self.assertEqual(len(self.calls), 3)
+        gaps = [later[0] - earlier[0] for earlier, later in zip(self.calls, self.calls[1:])]
+        self.assertTrue(all(gap >= 0.09 for gap in gaps), gaps)
+        self.assertEqual(MusicBrainzArtist.objects.count(), 3)
+
+    def test_a_lookup_that_blows_up_resolves_as_unknown_and_the_worker_carries_on(self):
+        def fake_musicbrainz(method, url, **kwargs):
+            if '/broken' in url:
+                return fake_response(200, {'relations': [{'url': {}}]})
+            return self.fake_musicbrainz(method, url, **kwargs)
+
+        with mock.patch('api.upstream.request', side_effect=fake_musicbrainz), \
+                self.assertLogs('api.musicbrainz', 'ERROR') as logs:
+            started = time.monotonic()
+            self.assertEqual(musicbrainz.spotify_urls(['broken'], wait=5), {})
+            self.assertLess(time.monotonic() - started, 1)
+            worker = musicbrainz._worker
+
+            self.assertEqual(musicbrainz.spotify_urls(['a'], wait=5), {'a': 'https://open.spotify.com/artist/a'})
+
+        self.assertIn('lookup of broken failed', logs.output[0])
+        self.assertIs(musicbrainz._worker, worker)
+        self.assertTrue(worker.is_alive())
+        self.assertNotIn('broken', musicbrainz._pending)
+
+    def test_rejected_mbids_are_stored_and_only_throttling_and_network_errors_retried(self):
+        def fake_musicbrainz(method, url, **kwargs):
+            self.calls.append((time.monotonic(), url))
+            if '/bad-mbid' in url:
+                return fake_response(400, {'error': 'Invalid mbid.'})
+            if '/gone' in url:
+                return fake_response(404, {'error': 'Not Found'})
+            if '/busy' in url:
+                return fake_response(503)
+            raise requests.exceptions.ConnectionError('unreachable')
+
+        with mock.patch('api.upstream.request', side_effect=fake_musicbrainz), self.assertLogs('api.musicbrainz'):
+            first = musicbrainz.spotify_urls(['bad-mbid', 'gone', 'busy', 'offline'], wait=10)
+            again = musicbrainz.spotify_urls(['bad-mbid', 'gone'], wait=10)
+
+        self.assertEqual(first, {'bad-mbid': '', 'gone': ''})
+        self.assertEqual(again, first)
+        self.assertEqual(musicbrainz.stored(['bad-mbid', 'gone', 'busy', 'offline']), first)
+        tried = [url.split('/artist/')[1].split('?')[0] for _, url in self.calls]
+        self.assertEqual({mbid: tried.count(mbid) for mbid in set(tried)}, {
+            'bad-mbid': 1, 'gone': 1, 'busy': musicbrainz.MAX_ATTEMPTS, 'offline': musicbrainz.MAX_ATTEMPTS,
+        })
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class CatalogTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.searches = []
+
+    def fake_search(self, method, url, **kwargs):
+        self.searches.append(kwargs['params']['q'])
+        if 'Unknown' in kwargs['params']['q']:
+            return fake_response(200, {'tracks': {'items': []}})
+        return fake_response(200, {'tracks': {'items': [{
+            'external_urls': {'spotify': 'https://open.spotify.com/track/t1'},
+            'album': {'images': [{'url': 'https://i.scdn.co/image/a1'}]},
+        }]}})
+
+    def lookup(self, tracks):
+        return self.post('/api/get_track_spotify_urls/', {'tracks': tracks}).json()['results']
+
+    def test_resolved_pairs_outlive_the_cache(self):
+        from django.core.cache import cache
+        tracks = [{'artist': 'The Beatles', 'track': 'Something'}, {'artist': 'Unknown', 'track': 'Nothing'}]
+        with mock.patch('api.upstream.request', side_effect=self.fake_search):
+            first = self.lookup(tracks)
+            cache.clear()
+            again = self.lookup([{'artist': '  the  BEATLES', 'track': 'something'}, tracks[1]])
+
+        self.assertEqual(len(self.searches), 2)
+        self.assertEqual(first[0]['spotify_url'], 'https://open.spotify.com/track/t1')
+        self.assertEqual(again[0]['spotify_url'], 'https://open.spotify.com/track/t1')
+        self.assertIsNone(again[1]['spotify_url'])
+        self.assertEqual(CatalogTrack.objects.get(artist_key='the beatles').spotify_id, 't1')
+
+    def test_batch_reads_the_cache_once_and_searches_only_the_misses(self):
+        from .views import track_spotify_cache_key
+        cached = {'spotify_url': 'https://open.spotify.com/track/cached', 'image': None}
+        caching.store(track_spotify_cache_key('A', 'One'), cached, fresh=60)
+        caching.store(track_spotify_cache_key('A', 'Two'), cached, fresh=60)
+        tracks = [{'artist': 'A', 'track': name} for name in ['One', 'Two', 'Three', 'Two', 'Four']]
+
+        read_many = caching.read_many
+        reads = []
+
+        def record_reads(keys, record=True):
+            keys = list(keys)
+            reads.append(keys)
+            return read_many(keys, record)
+
+        with mock.patch('api.caching.read_many', side_effect=record_reads), \
+                mock.patch('api.upstream.request', side_effect=self.fake_search):
+            results = self.lookup(tracks)
+
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(len(reads[0]), 4)
+        self.assertEqual(sorted(self.searches), ['track:Four artist:A', 'track:Three artist:A'])
+        self.assertEqual([r['track'] for r in results], ['One', 'Two', 'Three', 'Two', 'Four'])
+        self.assertEqual([r['spotify_url'].rsplit('/', 1)[1] for r in results], ['cached', 'cached', 't1', 'cached', 't1'])
+
+    @override_settings(UPSTREAM_FANOUT=3)
+    def test_batch_searches_at_most_upstream_fanout_at_a_time(self):
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_search(method, url, **kwargs):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.pop()
+            return self.fake_search(method, url, **kwargs)
+
+        tracks = [{'artist': 'A', 'track': f'Track {n}'} for n in range(10)]
+        with mock.patch('api.upstream.request', side_effect=slow_search):
+            results = self.lookup(tracks)
+
+        self.assertEqual(len(self.searches), 10)
+        self.assertEqual(max(peak), 3)
+        self.assertEqual({r['spotify_url'] for r in results}, {'https://open.spotify.com/track/t1'})
+
+        too_many = [{'artist': 'A', 'track': f'Track {n}'} for n in range(51)]
+        response = self.post('/api/get_track_spotify_urls/', {'tracks': too_many})
+        self.assertEqual(response.status_code, 400)
+
+    def test_store_tracks_updates_existing_rows(self):
+        catalog.store_tracks({('A', 'B'): {'spotify_url': None, 'image': None}})
+        catalog.store_tracks({('a', 'b'): {'spotify_url': 'https://open.spotify.com/track/t2', 'image': None}})
+        self.assertEqual(CatalogTrack.objects.count(), 1)
+        self.assertEqual(catalog.find_track('A', 'B', 60), {'spotify_url': 'https://open.spotify.com/track/t2', 'image': None})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, PREFETCH_TOP_ARTISTS=2)
+class PrefetchTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.paths = []
+
+    def fake_spotify(self, method, url, **kwargs):
+        path = url.split('/v1', 1)[1]
+        self.paths.append(path)
+        if path == '/me/top/artists':
+            return fake_response(200, {'items': [{'id': f'a{n}', 'name': f'Artist {n}'} for n in range(3)]})
+        if path == '/me/player/currently-playing':
+            return fake_response(204)
+        return fake_response(200, {'items': [], 'id': self.user.username})
+
+    def test_first_dashboard_load_after_prefetch_is_served_from_cache(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_spotify):
+            prefetch.warm_user(self.user)
+            self.assertEqual(self.paths.count('/me/top/tracks'), 3)
+            self.assertEqual(self.paths.count('/me/top/artists'), 3)
+            self.assertEqual(sorted(p for p in self.paths if p.startswith('/artists/')), ['/artists/a0/albums', '/artists/a1/albums'])
+
+            self.paths.clear()
+            dashboard = self.get('/api/dashboard/')
+            for path, params in [
+                ('/api/top_tracks/', {'time_range': 'long_term'}),
+                ('/api/get_my_playlists/', {}),
+                ('/api/get_artist/', {'artist_id': 'a1'}),
+                ('/api/get_artist_albums/', {'artist_id': 'a1'}),
+            ]:
+                self.assertEqual(self.get(path, params).status_code, 200)
+
+        self.assertEqual(dashboard.json()['errors'], {})
+        self.assertEqual(self.paths, ['/me/player/currently-playing'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, MUSICBRAINZ_INTERVAL=0)
+class SimilarArtistImagesTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.chunks = []
+
+    def fake_upstream(self, method, url, **kwargs):
+        if 'audioscrobbler' in url:
+            name = kwargs['params']['artist']
+            self.calls.append(f'last.fm {name}')
+            # Last.fm knows no MBID for "Nobody".
+            return fake_response(200, {'artist': {'name': name, 'mbid': '' if name == 'Nobody' else f'mbid-{name}'}})
+        if 'musicbrainz' in url:
+            mbid = url.split('/artist/')[1].split('?')[0]
+            self.calls.append(f'musicbrainz {mbid}')
+            return fake_response(200, {'relations': [
+                {'url': {'resource': f"https://open.spotify.com/artist/id-{mbid.removeprefix('mbid-')}"}},
+            ]})
+        ids = kwargs['params']['ids'].split(',')
+        self.chunks.append(ids)
+        self.calls.append(f'spotify {len(ids)} ids')
+        return fake_response(200, {'artists': [
+            {'id': i, 'name': i, 'images': [{'url': f'https://i.scdn.co/image/{i}'}]} for i in ids
+        ]})
+
+    def similar_artist_images(self, names):
+        return self.post('/api/similar_artist_images/', {'artists': names}).json()
+
+    def test_each_link_is_cached_and_only_new_artists_are_looked_up(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            first = self.similar_artist_images(['A', 'B', 'Nobody'])
+            self.assertEqual(sorted(self.calls), [
+                'last.fm A', 'last.fm B', 'last.fm Nobody', 'musicbrainz mbid-A', 'musicbrainz mbid-B', 'spotify 2 ids',
+            ])
+
+            self.calls.clear()
+            second = self.similar_artist_images(['A', 'C'])
+
+        self.assertEqual(first, {
+            'images': {'A': 'https://i.scdn.co/image/id-A', 'B': 'https://i.scdn.co/image/id-B', 'Nobody': None},
+            'ids': {'A': 'id-A', 'B': 'id-B', 'Nobody': None},
+        })
+        self.assertEqual(second['ids'], {'A': 'id-A', 'C': 'id-C'})
+        self.assertEqual(self.calls, ['last.fm C', 'musicbrainz mbid-C', 'spotify 1 ids'])
+
+    def test_spotify_artists_are_fetched_in_chunks_of_50(self):
+        from .views import resolve_spotify_artists
+        artist_ids = [f'id-{n}' for n in range(120)]
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            first = resolve_spotify_artists(artist_ids, 'token')
+            again = resolve_spotify_artists(artist_ids, 'token')
+
+        self.assertEqual(sorted(len(chunk) for chunk in self.chunks), [20, 50, 50])
+        self.assertEqual(sorted(sum(self.chunks, [])), sorted(artist_ids))
+        self.assertEqual(set(first), set(artist_ids))
+        self.assertEqual(again, first)
+        self.assertEqual(len(caching.get_many([f'artist-{i}' for i in artist_ids])), 120)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class DashboardTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.reads = []
+
+        # me and this month's top tracks are cached; the other parts aren't.
+        caching.store(f'me-{self.user.id}', {'id': 'listener'}, fresh=60)
+        caching.store(f'top-tracks-{self.user.id}-short_term', {'items': ['cached']}, fresh=60)
+
+    def payload(self, url, headers):
+        path = url.split('/v1', 1)[1]
+        self.calls.append((path, headers['Authorization']))
+        if path == '/me/player/currently-playing':
+            return 204, None
+        return 200, {'items': [path]}
+
+    def fake_upstream(self, method, url, **kwargs):
+        return fake_response(*self.payload(url, kwargs['headers']))
+
+    async def fake_arequest(self, method, url, **kwargs):
+        status, payload = self.payload(url, kwargs['headers'])
+        return httpx.Response(status, json=payload, request=httpx.Request(method, url))
+
+    def spy_on_reads(self, read_entry):
+        read_many = caching.read_many
+
+        def record_reads(keys, record=True):
+            keys = list(keys)
+            self.reads.append(keys)
+            return read_many(keys, record)
+
+        return (
+            mock.patch('api.caching.read_many', side_effect=record_reads),
+            mock.patch(f'api.caching.{read_entry}', wraps=getattr(caching, read_entry)),
+        )
+
+    def assert_dashboard(self, body, get_valid_token, read_entry):
+        self.assertEqual(get_valid_token.call_count, 1)
+        self.assertEqual(self.reads, [[
+            f'me-{self.user.id}',
+            f'{self.user.id}-recently-played-tracks',
+            f'top-tracks-{self.user.id}-short_term',
+            f'top-artist-{self.user.id}-short_term',
+        ]])
+        read_entry.assert_not_called()
+        self.assertEqual(sorted(self.calls), [
+            ('/me/player/currently-playing', 'Bearer token'),
+            ('/me/player/recently-played', 'Bearer token'),
+            ('/me/top/artists', 'Bearer token'),
+        ])
+        self.assertEqual(body, {
+            'me': {'id': 'listener'},
+            'recently_played': {'items': ['/me/player/recently-played']},
+            'top_tracks': {'items': ['cached']},
+            'top_artists': {'items': ['/me/top/artists']},
+            'currently_playing': {'is_playing': False},
+            'errors': {},
+        })
+
+    def test_one_token_lookup_one_multi_get_and_only_misses_fetched(self):
+        multi_get_spy, read_entry_spy = self.spy_on_reads('read_entry')
+        with mock.patch('api.views.get_valid_token', wraps=tokens.get_valid_token) as get_valid_token, \
+                multi_get_spy, read_entry_spy as read_entry, \
+                mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            response = self.get('/api/dashboard/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assert_dashboard(response.json(), get_valid_token, read_entry)
+
+    def test_async_variant_does_the_same(self):
+        from django.test import AsyncRequestFactory
+        from . import async_views
+
+        request = AsyncRequestFactory().get('/api/dashboard/', headers={'Authorization': f'Bearer {self.jwt}'})
+        multi_get_spy, read_entry_spy = self.spy_on_reads('aread_entry')
+        with mock.patch('api.async_views.get_valid_token', wraps=tokens.get_valid_token) as get_valid_token, \
+                multi_get_spy, read_entry_spy as read_entry, \
+                mock.patch('api.upstream.arequest', side_effect=self.fake_arequest):
+            response = asyncio.run(async_views.dashboard(request))
+
+        self.assertEqual(response.status_code, 200)
+        self.assert_dashboard(json.loads(response.content), get_valid_token, read_entry)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False)
+class ArtistProfileTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+    def payload(self, url, params):
+        if 'audioscrobbler' in url:
+            self.calls.append(f"last.fm {params['method']} {params['artist']}")
+            if params['method'] == 'artist.getTopTracks':
+                return 500, {'error': 8}
+            return 200, {'artist': {'name': params['artist']}}
+        path = url.split('/v1', 1)[1]
+        self.calls.append(path)
+        if path.endswith('/albums'):
+            return 200, {'items': [{'id': 'album-1'}]}
+        return 200, {'id': 'artist-1', 'name': 'Artist'}
+
+    def fake_upstream(self, method, url, **kwargs):
+        return fake_response(*self.payload(url, kwargs.get('params') or {}))
+
+    async def fake_arequest(self, method, url, **kwargs):
+        if url.endswith('/albums'):
+            raise httpx.ConnectError('connection refused')
+        status, payload = self.payload(url, kwargs.get('params') or {})
+        return httpx.Response(status, json=payload, request=httpx.Request(method, url))
+
+    def test_a_failing_source_leaves_the_others_in_the_response(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            response = self.get('/api/artist_profile/', {'artist_id': 'artist-1'})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['artist']['name'], 'Artist')
+        self.assertEqual(body['albums'], {'items': [{'id': 'album-1'}]})
+        self.assertEqual(body['artist_info'], {'artist': {'name': 'Artist'}})
+        self.assertIsNone(body['top_tracks'])
+        self.assertEqual(body['errors'], {
+            'top_tracks': {'error': 'Failed to get artist top tracks via last fm', 'status': 500},
+        })
+        # The Last.fm lookups wait for the artist's name, then run together.
+        self.assertEqual(sorted(self.calls[:2]), ['/artists/artist-1', '/artists/artist-1/albums'])
+        self.assertEqual(sorted(self.calls[2:]), ['last.fm artist.getInfo Artist', 'last.fm artist.getTopTracks Artist'])
+
+    def test_async_variant_reports_failures_per_source(self):
+        from django.test import AsyncRequestFactory
+        from . import async_views
+
+        request = AsyncRequestFactory().get(
+            '/api/artist_profile/', {'artist_id': 'artist-1', 'artist_name': 'Artist'},
+            headers={'Authorization': f'Bearer {self.jwt}'},
+        )
+        with mock.patch('api.upstream.arequest', side_effect=self.fake_arequest):
+            response = asyncio.run(async_views.artist_profile(request))
+
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body['artist']['name'], 'Artist')
+        self.assertIsNone(body['albums'])
+        self.assertEqual(body['artist_info'], {'artist': {'name': 'Artist'}})
+        self.assertEqual(body['errors']['albums'], {'error': 'connection refused', 'status': 502})
+        self.assertEqual(body['errors']['top_tracks']['status'], 500)
+        self.assertEqual(len(self.calls), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WarmCacheTests(TransactionTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        popularity._counts.clear()
+        self.paths = []
+
+    def fake_upstream(self, method, url, **kwargs):
+        if url == 'https://accounts.spotify.com/api/token':
+            return fake_response(200, {'access_token': 'app-token', 'expires_in': 3600})
+        if 'audioscrobbler' in url:
+            self.paths.append(f"last.fm {kwargs['params']['method']} {kwargs['params']['artist']}")
+            return fake_response(200, {'artist': {'name': kwargs['params']['artist']}})
+        path = url.split('/v1', 1)[1]
+        if path == '/artists':
+            self.paths.append(f"/artists?ids={kwargs['params']['ids']}")
+            ids = kwargs['params']['ids'].split(',')
+            return fake_response(200, {'artists': [{'id': i, 'name': f'Artist {i}'} for i in ids]})
+        self.paths.append(path)
+        return fake_response(200, {'items': []})
+
+    def test_warms_the_most_requested_artists(self):
+        for artist_id in ['a', 'b', 'b', 'c', 'c', 'c']:
+            popularity.record(artist_id)
+        popularity.flush()
+        self.assertEqual(popularity.top_artists(2, days=1), ['c', 'b'])
+
+        caching.store('artist_albums-c', {'items': []}, fresh=60)
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            call_command('warm_cache', '--top', '2', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertEqual(sorted(self.paths), [
+            '/artists/b/albums',
+            '/artists?ids=c,b',
+            'last.fm artist.getInfo Artist b',
+            'last.fm artist.getInfo Artist c',
+            'last.fm artist.getTopTracks Artist b',
+            'last.fm artist.getTopTracks Artist c',
+        ])
+        cached = caching.read_many(['artist-b', 'artist-c', 'artist_albums-b', 'artist-info-last-fm-Artist c'])
+        self.assertEqual(len(cached), 4)
+        self.assertNotIn('artist-a', caching.read_many(['artist-a']))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, METRICS_TOKEN='scrape-secret')
+class MetricsTests(TransactionTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        metrics._series.clear()
+        metrics._slot = None
+
+    def test_endpoint_hides_ids(self):
+        self.assertEqual(
+            metrics.endpoint('https://api.spotify.com/v1/artists/4Z8W4fKeB5YxbusRsdQVPb/albums'),
+            '/v1/artists/{id}/albums',
+        )
+        self.assertEqual(
+            metrics.endpoint('https://ws.audioscrobbler.com/2.0/', {'method': 'artist.getInfo', 'artist': 'X'}),
+            '/2.0/?method=artist.getInfo',
+        )
+        self.assertEqual(
+            metrics.endpoint('https://musicbrainz.org/ws/2/artist/5b11f4ce-a62d-471e-81fc-a69a8278c7da?inc=url-rels'),
+            '/ws/2/artist/{id}',
+        )
+
+    def test_upstream_labels_only_take_known_routes(self):
+        for url, params in [
+            ('https://api.spotify.com/v1/artists/made/up/path', None),
+            ('https://api.spotify.com/v1/anything-a-client-sends', None),
+            ('https://ws.audioscrobbler.com/2.0/', {'method': 'user.whatever'}),
+            ('https://attacker.example/v1/me', None),
+        ]:
+            self.assertEqual(metrics.endpoint(url, params), 'other')
+        self.assertEqual(metrics.host('https://attacker.example/v1/me'), 'other')
+        self.assertEqual(metrics.host('https://api.spotify.com/v1/me'), 'api.spotify.com')
+
+        for n in range(3):
+            with mock.patch('api.upstream.session_for') as session_for:
+                session_for.return_value.request.return_value = fake_response(200, {})
+                upstream.get(f'https://host-{n}.example/v1/artists/{n}')
+        labels = [dict(labels) for name, labels in metrics._series if name == 'upstream_seconds']
+        self.assertEqual(labels, [{'host': 'other', 'endpoint': 'other', 'status': 200}])
+
+    def test_adds_up_every_workers_totals(self):
+        compute = lambda: ({'id': 'x'}, None)
+        caching.cached_fetch('artist-x', 60, compute)
+        caching.cached_fetch('artist-x', 60, compute)
+        Client().get('/api/health_check/')
+
+        # What another worker published.
+        from django.core.cache import cache
+        cache.set('stats-metrics-7', {'worker': 'other', 'series': {
+            ('cache_lookups_total', (('family', 'artist'), ('result', 'hit'))): 3,
+        }})
+
+        response = Client().get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('spontify_workers 2\n', text)
+        self.assertIn('spontify_cache_lookups_total{family="artist",result="hit"} 4\n', text)
+        self.assertIn('spontify_cache_lookups_total{family="artist",result="miss"} 1\n', text)
+        self.assertIn('spontify_view_seconds_count{view="health_check",method="GET",status="200"} 1\n', text)
+        self.assertIn('spontify_view_seconds_bucket{view="health_check",method="GET",status="200",le="+Inf"} 1\n', text)
+
+    def test_only_the_metrics_token_and_staff_get_in(self):
+        user = User.objects.create(username='listener')
+        jwt = lambda: f'Bearer {RefreshToken.for_user(user).access_token}'
+
+        for path in ['/api/metrics/', '/api/cache_stats/']:
+            with self.subTest(path):
+                for authorization, status in [
+                    (None, 403),
+                    ('Bearer wrong-secret', 403),
+                    (jwt(), 403),
+                    ('Bearer scrape-secret', 200),
+                ]:
+                    headers = {'HTTP_AUTHORIZATION': authorization} if authorization else {}
+                    self.assertEqual(Client().get(path, **headers).status_code, status, authorization)
+
+        user.is_staff = True
+        user.save()
+        for path in ['/api/metrics/', '/api/cache_stats/']:
+            self.assertEqual(Client().get(path, HTTP_AUTHORIZATION=jwt()).status_code, 200)
+
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(Client().get('/api/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        self.assertEqual(Client().get('/api/health_check/').status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, SERVER_TIMING=True)
+class ServerTimingTests(AuthedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = mock.Mock()
+        self.session.request.side_effect = self.fake_request
+
+    def fake_request(self, method, url, **kwargs):
+        time.sleep(0.05)
+        return fake_response(200, {'id': 'artist-1', 'name': 'Artist'})
+
+    def get_artist(self, **headers):
+        with mock.patch('api.upstream.session_for', return_value=self.session):
+            return self.get('/api/get_artist/', {'artist_id': 'artist-1'}, **headers)
+
+    def phases(self, response):
+        return {part.split(';')[0]: part for part in response['Server-Timing'].split(', ')}
+
+    def test_reports_each_phase(self):
+        phases = self.phases(self.get_artist())
+        self.assertEqual(set(phases), {'auth', 'token', 'db', 'budget', 'upstream', 'total'})
+        self.assertIn('desc="1 call"', phases['upstream'])
+        upstream_ms = float(phases['upstream'].split('dur=')[1].split(';')[0])
+        self.assertGreaterEqual(upstream_ms, 50)
+
+    @override_settings(SERVER_TIMING=False)
+    def test_off(self):
+        self.assertNotIn('Server-Timing', self.get_artist())
+
+    @override_settings(SERVER_TIMING=False)
+    def test_when_off_only_staff_profiles_get_the_header(self):
+        with tempfile.TemporaryDirectory() as profiles, override_settings(PROFILE_DIR=profiles):
+            self.assertNotIn('Server-Timing', self.get_artist(HTTP_X_PROFILE='1'))
+
+            from django.core.cache import cache
+            cache.clear()
+            self.user.is_staff = True
+            self.user.save()
+            self.assertIn('upstream;dur=', self.get_artist(HTTP_X_PROFILE='1')['Server-Timing'])
+            self.assertNotIn('Server-Timing', self.get_artist())
+
+    def test_staff_requests_can_ask_for_a_profile(self):
+        with tempfile.TemporaryDirectory() as profiles, override_settings(PROFILE_DIR=profiles, PROFILE_INTERVAL=0.001):
+            self.get_artist(HTTP_X_PROFILE='1')
+            self.assertEqual(os.listdir(profiles), [])
+
+            from django.core.cache import cache
+            cache.clear()
+            self.user.is_staff = True
+            self.user.save()
+            self.get_artist(HTTP_X_PROFILE='1')
+            [name] = os.listdir(profiles)
+            self.assertIn('get_artist', name)
+            with open(os.path.join(profiles, name)) as f:
+                lines = f.read().splitlines()
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(int(count) > 0)
+        self.assertTrue(any('api.views.get_artist' in line for line in lines))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SPOTIFY_TOKEN_BACKGROUND_REFRESH=False, PAGES_LIMIT=50, PAGES_WINDOW=2)
+class AllPagesTests(AuthedTestCase):
+    TOTAL = 230
+
+    def setUp(self):
+        super().setUp()
+        self.in_flight = self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+    def page(self, params):
+        offset, limit = params['offset'], params['limit']
+        return {'total': self.TOTAL, 'items': [
+            {'id': f'playlist-{n}', 'name': f'Playlist {n}', 'available_markets': ['SE']}
+            for n in range(offset, min(offset + limit, self.TOTAL))
+        ]}
+
+    def fake_upstream(self, method, url, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        return fake_response(200, self.page(kwargs['params']))
+
+    def test_streams_every_item_in_order(self):
+        with mock.patch('api.upstream.request', side_effect=self.fake_upstream):
+            response = self.get('/api/get_my_playlists/', {'all': '1'})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual(lines[0], {'total': self.TOTAL})
+        self.assertEqual(lines[-1], {'done': True, 'count': self.TOTAL})
+        items = [line['item'] for line in lines[1:-1]]
+        self.assertEqual([item['id'] for item in items], [f'playlist-{n}' for n in range(self.TOTAL)])
+        self.assertNotIn('available_markets', items[0])
+        self.assertEqual(self.most_in_flight, 2)
+
+    def test_a_failed_page_ends_the_stream_with_its_error(self):
+        async def fake_arequest(method, url, **kwargs):
+            if kwargs['params']['offset'] == 100:
+                return httpx.Response(500, json={}, request=httpx.Request(method, url))
+            return httpx.Response(200, json=self.page(kwargs['params']), request=httpx.Request(method, url))
+
+        async def collect():
+            return [json.loads(line) async for line in paging.astream_pages('https://api.spotify.com/v1/me/playlists', 'token', 'Failed')]
+
+        with mock.patch('api.upstream.arequest', side_effect=fake_arequest):
+            lines = asyncio.run(collect())
+
+        self.assertEqual(len(lines), 1 + 100 + 1)
+        self.assertEqual(lines[-1], {'error': 'Failed', 'status': 500})
@@ -0,0 +1,232 @@
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+
+
+# ─── Per-request phase timings (Server-Timing) ──────────────────────────────
+#
+# TimingMiddleware gives each request a Timings in a context variable, and
+# code on the request path adds to it: JWT auth (`auth`), get_valid_token
+# (`token`), every database query (`db`), default-cache calls (`cache`, or
+# `ratelimit` for the rate limiter's keys), waiting on an upstream budget
+# (`budget`) and upstream calls (`upstream`). The totals go out in a
+# Server-Timing header. Phases nest (the token's query is also `db`), so
+# they needn't add up to `total`.
+#
+# upstream.fan_out() runs its calls in the caller's context, so fanned-out
+# calls count too; background refreshes don't belong to a request and don't.
+# With SERVER_TIMING off and no profile taken, no Timings is created and a
+# phase costs one context variable lookup. The header shows how the backend
+# spends its time, so with SERVER_TIMING off it only goes to staff requests
+# that ask for a profile.
+
+_current = contextvars.ContextVar('timings', default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}    # name -> [seconds, calls]
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def header(self):
+        with self.lock:
+            parts = [
+                f'{name};dur={seconds * 1000:.1f};desc="{calls} call{"s" if calls != 1 else ""}"'
+                for name, (seconds, calls) in self.phases.items()
+            ]
+        parts.append(f'total;dur={(time.perf_counter() - self.start) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def add(name, seconds):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+class phase:
+    """`with phase('cache'):` adds the block's duration to the request's timings."""
+
+    __slots__ = ('name', 'timings', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = _current.get()
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _time_query(execute, sql, params, many, context):
+    with phase('db'):
+        return execute(sql, params, many, context)
+
+
+def install_db_timing(sender, connection, **kwargs):
+    """connection_created receiver: time every query on the new connection."""
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+# ─── Sampling profiler ───────────────────────────────────────────────────────
+#
+# Opt-in: requests from staff users sending `X-Profile: 1` (PROFILE_STAFF),
+# and PROFILE_SAMPLE_RATE of all requests. A thread samples the stack of the
+# thread serving the request every PROFILE_INTERVAL seconds, and the counts
+# are written to PROFILE_DIR in the folded format flamegraph.pl, inferno and
+# speedscope read: one `frame;frame;frame count` line per distinct stack.
+# Under ASGI that thread is the event loop, so a profile also catches the
+# other requests it was serving at the time.
+
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, label):
+        """Write the folded stacks to PROFILE_DIR; returns the path, or None if nothing was sampled."""
+        if not self.counts:
+            return None
+        directory = settings.PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{label}-{os.getpid()}-{self.ident}.folded')
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def _is_staff(request):
+    from .authentication import JWTAuthentication
+
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except Exception:
+        return False
+    return bool(result and result[0].is_staff)
+
+
+def _sampled():
+    rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+    return bool(rate) and random.random() < rate
+
+
+def _asks_for_profile(request):
+    # Only then is the JWT checked for a staff user.
+    return getattr(settings, 'PROFILE_STAFF', True) and request.META.get('HTTP_X_PROFILE') == '1'
+
+
+def _label(request):
+    match = getattr(request, 'resolver_match', None)
+    return (match.url_name if match and match.url_name else request.path.strip('/').replace('/', '_')) or 'root'
+
+
+def _begin(profile):
+    timings = Timings()
+    sampler = None
+    if profile:
+        sampler = Sampler(threading.get_ident(), getattr(settings, 'PROFILE_INTERVAL', 0.005))
+        sampler.start()
+    return timings, _current.set(timings), sampler
+
+
+def _end(request, response, timings, token, sampler, header):
+    _current.reset(token)
+    if sampler is not None:
+        sampler.stop()
+        path = sampler.write(_label(request))
+        if path:
+            print(f"[profile] {request.method} {request.path}: {path}")
+    if response is not None and header:
+        response['Server-Timing'] = timings.header()
+        if settings.FRONTEND_URL:
+            # Lets the frontend's devtools show the breakdown too.
+            response['Timing-Allow-Origin'] = settings.FRONTEND_URL
+    return response
+
+
+@sync_and_async_middleware
+def TimingMiddleware(get_response):
+    """Adds Server-Timing to responses, and profiles the requests that ask for it."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            staff = _asks_for_profile(request) and await sync_to_async(_is_staff)(request)
+            profile = staff or _sampled()
+            header = staff or getattr(settings, 'SERVER_TIMING', False)
+            if not profile and not header:
+                return await get_response(request)
+
+            timings, token, sampler = _begin(profile)
+            response = None
+            try:
+                response = await get_response(request)
+            finally:
+                _end(request, response, timings, token, sampler, header)
+            return response
+    else:
+        def middleware(request):
+            staff = _asks_for_profile(request) and _is_staff(request)
+            profile = staff or _sampled()
+            header = staff or getattr(settings, 'SERVER_TIMING', False)
+            if not profile and not header:
+                return get_response(request)
+
+            timings, token, sampler = _begin(profile)
+            response = None
+            try:
+                response = get_response(request)
+            finally:
+                _end(request, response, timings, token, sampler, header)
+            return response
+    return middleware
@@ -0,0 +1,300 @@
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, close_old_connections
+from django.utils import timezone
+
+from .models import SpotifyToken
+from . import metrics, timing, upstream
+
+
+# ─── Spotify access-token cache ──────────────────────────────────────────────
+#
+# Access tokens are served from a process-local dict, then the shared cache,
+# and only then from SpotifyToken in the database. Every write to a token
+# (refresh or login) goes through store_token() so both tiers are updated.
+# Tokens close to expiry are refreshed in the background, so a request only
+# waits on accounts.spotify.com if its token has already expired.
+
+_local = {}            # user_id -> (access_token, expires_at, checked_at)
+_last_seen = {}        # user_id -> last time a request used the token
+_pending = set()       # user_ids with a background refresh queued
+_lock = threading.Lock()
+_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='token-refresh')
+_sweeper = None
+
+
+def _refresh_ahead():
+    return getattr(settings, 'SPOTIFY_TOKEN_REFRESH_AHEAD', 300)
+
+
+def _local_ttl():
+    return getattr(settings, 'SPOTIFY_TOKEN_LOCAL_TTL', 30)
+
+
+def _cache_key(user_id):
+    return f'spotify-token-{user_id}'
+
+
+def store_token(token):
+    expires_at = token.expires_at.timestamp()
+    with _lock:
+        _local[token.user_id] = (token.access_token, expires_at, time.time())
+    cache.set(
+        _cache_key(token.user_id),
+        {'access_token': token.access_token, 'expires_at': expires_at},
+        timeout=max(int(expires_at - time.time()), 1),
+    )
+
+
+def forget_token(user_id):
+    with _lock:
+        _local.pop(user_id, None)
+    cache.delete(_cache_key(user_id))
+
+
+def _cached_token(user_id):
+    now = time.time()
+    entry = _local.get(user_id)
+    if entry and now - entry[2] < _local_ttl():
+        return entry[0], entry[1]
+
+    shared = cache.get(_cache_key(user_id))
+    if not shared:
+        return None
+    with _lock:
+        _local[user_id] = (shared['access_token'], shared['expires_at'], now)
+    return shared['access_token'], shared['expires_at']
+
+
+@timing.timed('token')
+def get_valid_token(user):
+    _ensure_sweeper()
+    now = time.time()
+    _last_seen[user.id] = now
+
+    cached = _cached_token(user.id)
+    if cached and cached[1] > now:
+        if cached[1] - now < _refresh_ahead():
+            schedule_refresh(user.id)
+        return cached[0]
+
+    try:
+        token = SpotifyToken.objects.get(user=user)
+    except SpotifyToken.DoesNotExist:
+        return None
+
+    if token.expires_at <= timezone.now():
+        token = refresh_spotify_token(token)
+        if token is None:
+            return None
+    else:
+        store_token(token)
+        if token.expires_at.timestamp() - now < _refresh_ahead():
+            schedule_refresh(user.id)
+
+    return token.access_token
+
+
+def _exchange_refresh_token(token):
+    response = upstream.post(
+        'https://accounts.spotify.com/api/token',
+        data={
+            'grant_type': 'refresh_token',
+            'refresh_token': token.refresh_token,
+            'client_id': settings.SPOTIFY_CLIENT_ID,
+            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
+        },
+        headers={'Content-Type': 'application/x-www-form-urlencoded'}
+    )
+
+    new_data = response.json() if response.content else {}
+    if not response.ok or not new_data.get('access_token'):
+        print(f"[refresh_spotify_token] user {token.user_id} failed: {response.status_code} {new_data.get('error')}")
+        metrics.inc('token_refreshes_total', result='failed')
+        forget_token(token.user_id)
+        return None
+
+    token.access_token = new_data['access_token']
+    token.refresh_token = new_data.get('refresh_token') or token.refresh_token
+    token.expires_at = timezone.now() + timedelta(seconds=new_data.get('expires_in', 3600))
+    retry_locked(token.save)
+    store_token(token)
+    metrics.inc('token_refreshes_total', result='ok')
+
+    return token
+
+
+# ─── Token writes under contention ──────────────────────────────────────────
+#
+# SQLite has one writer at a time. With the busy timeout in settings a write
+# waits for its turn; if that wait runs out anyway, a token write is retried
+# a few times with backoff rather than losing a token Spotify already issued.
+
+def _locked(error):
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def retry_locked(write):
+    attempts = getattr(settings, 'SQLITE_LOCK_RETRIES', 3) + 1
+    for attempt in range(attempts):
+        try:
+            return write()
+        except OperationalError as e:
+            if attempt == attempts - 1 or not _locked(e):
+                raise
+            metrics.inc('db_lock_retries_total')
+            print(f"[tokens] database locked, retrying write ({attempt + 1}/{attempts - 1})")
+            time.sleep(0.05 * 2 ** attempt * (0.5 + random.random()))
+
+
+# ─── Single-flight refresh ───────────────────────────────────────────────────
+#
+# Only one caller per user refreshes at a time: a per-user lock inside the
+# process, and a lock key in the shared cache across workers. Everyone else
+# waits (bounded by SPOTIFY_TOKEN_REFRESH_WAIT) for the winner's token.
+# A user's lock lives only while some caller holds a reference to it, so
+# _user_locks stays as small as the number of refreshes in progress.
+
+_user_locks = weakref.WeakValueDictionary()
+
+
+def _user_lock(user_id):
+    with _lock:
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = threading.Lock()
+        return lock
+
+
+def _refresh_wait():
+    return getattr(settings, 'SPOTIFY_TOKEN_REFRESH_WAIT', 5)
+
+
+def _newer_token(token):
+    current = SpotifyToken.objects.filter(pk=token.pk).first()
+    if current and current.expires_at > token.expires_at:
+        return current
+    return None
+
+
+def _wait_for_refresh(token, deadline):
+    while time.time() < deadline:
+        shared = cache.get(_cache_key(token.user_id))
+        if shared and shared['expires_at'] > token.expires_at.timestamp():
+            return _newer_token(token)
+        time.sleep(0.05)
+    return _newer_token(token)
+
+
+def refresh_spotify_token(token):
+    deadline = time.time() + _refresh_wait()
+    lock = _user_lock(token.user_id)
+    if not lock.acquire(timeout=_refresh_wait()):
+        return _newer_token(token)
+
+    try:
+        # Someone refreshed it while we waited for the lock.
+        current = _newer_token(token)
+        if current:
+            store_token(current)
+            return current
+
+        lock_key = f'spotify-token-refresh-{token.user_id}'
+        if not cache.add(lock_key, 1, timeout=getattr(settings, 'SPOTIFY_TOKEN_REFRESH_LOCK_TTL', 30)):
+            return _wait_for_refresh(token, deadline)
+
+        try:
+            return _exchange_refresh_token(token)
+        finally:
+            cache.delete(lock_key)
+    finally:
+        lock.release()
+
+
+# ─── Background refresh ──────────────────────────────────────────────────────
+
+def schedule_refresh(user_id):
+    with _lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+    _refresh_pool.submit(_refresh_in_background, user_id)
+
+
+def _refresh_in_background(user_id):
+    try:
+        token = SpotifyToken.objects.filter(user_id=user_id).first()
+        # Another process may have refreshed it already.
+        if token and token.expires_at.timestamp() - time.time() < _refresh_ahead():
+            refresh_spotify_token(token)
+        elif token:
+            store_token(token)
+    except Exception as e:
+        print(f"[token-refresh] user {user_id} failed: {e}")
+    finally:
+        with _lock:
+            _pending.discard(user_id)
+        close_old_connections()
+
+
+def _sweep():
+    # Keep tokens of recently active users ahead of expiry, so the next
+    # request (e.g. the currently-playing poll) never finds them expired.
+    interval = getattr(settings, 'SPOTIFY_TOKEN_SWEEP_INTERVAL', 60)
+    active_window = getattr(settings, 'SPOTIFY_TOKEN_ACTIVE_WINDOW', 60*30)
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        for user_id, seen in list(_last_seen.items()):
+            if now - seen > active_window:
+                _last_seen.pop(user_id, None)
+                continue
+            cached = _cached_token(user_id)
+            if not cached or cached[1] - now < _refresh_ahead() + interval:
+                schedule_refresh(user_id)
+
+
+def _ensure_sweeper():
+    global _sweeper
+    if _sweeper is not None or not getattr(settings, 'SPOTIFY_TOKEN_BACKGROUND_REFRESH', True):
+        return
+    with _lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep, name='token-sweeper', daemon=True)
+            _sweeper.start()
+
+
+# ─── App token (client credentials) ──────────────────────────────────────────
+#
+# For calls made on no user's behalf, like warm_cache. It can read the
+# catalog (artists, albums, search) but nothing under /me.
+
+def app_token():
+    shared = cache.get(_cache_key('app'))
+    if shared and shared['expires_at'] - time.time() > 60:
+        return shared['access_token']
+
+    response = upstream.post(
+        'https://accounts.spotify.com/api/token',
+        data={'grant_type': 'client_credentials'},
+        auth=(settings.SPOTIFY_CLIENT_ID, settings.SPOTIFY_CLIENT_SECRET),
+    )
+    data = response.json() if response.content else {}
+    if not response.ok or not data.get('access_token'):
+        print(f"[app_token] failed: {response.status_code} {data.get('error')}")
+        return None
+
+    expires_in = data.get('expires_in', 3600)
+    cache.set(
+        _cache_key('app'),
+        {'access_token': data['access_token'], 'expires_at': time.time() + expires_in},
+        timeout=expires_in,
+    )
+    return data['access_token']
@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from . import budget, metrics, timing
+
+
+# ─── Shared upstream HTTP client ─────────────────────────────────────────────
+#
+# Every call to Spotify, Last.fm and MusicBrainz goes through here instead of
+# module-level requests.get/post/put. Each host gets its own Session with a
+# keep-alive connection pool, so repeat calls reuse an open TCP+TLS connection
+# instead of paying a fresh handshake every time. Calls to hosts with a
+# budget (api/budget.py) wait for room in it first. Each call's latency and
+# every 429 go to api/metrics.py, and to the request's Server-Timing.
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _timeout():
+    return (
+        getattr(settings, 'UPSTREAM_CONNECT_TIMEOUT', 3.05),
+        getattr(settings, 'UPSTREAM_READ_TIMEOUT', 10),
+    )
+
+
+def _pool_size(host):
+    sizes = getattr(settings, 'UPSTREAM_POOL_SIZES', {})
+    return sizes.get(host, getattr(settings, 'UPSTREAM_POOL_MAXSIZE', 10))
+
+
+def _new_session(host):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=_pool_size(host),
+        pool_block=getattr(settings, 'UPSTREAM_POOL_BLOCK', False),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_for(url):
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _sessions[host] = _new_session(host)
+    return session
+
+
+def _throttled(method, url, retry_after):
+    # What the host would have said, without asking it.
+    response = requests.Response()
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    response.headers['Content-Type'] = 'application/json'
+    response._content = b'{"error": "upstream_throttled"}'
+    response.url = url
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+
+def _target(url):
+    # UPSTREAM_HOST_OVERRIDES = {'api.spotify.com': 'http://127.0.0.1:8001'}
+    # sends a host's calls elsewhere; bench/e2e.py points them at its fake.
+    overrides = getattr(settings, 'UPSTREAM_HOST_OVERRIDES', None)
+    if not overrides:
+        return url
+    parts = urlsplit(url)
+    base = overrides.get(parts.netloc)
+    return base + url[len(f'{parts.scheme}://{parts.netloc}'):] if base else url
+
+
+def _record(url, params, start, status):
+    host = metrics.host(url)
+    seconds = time.perf_counter() - start
+    timing.add('upstream', seconds)
+    metrics.observe(
+        'upstream_seconds', seconds,
+        host=host, endpoint=metrics.endpoint(url, params), status=status,
+    )
+    if status == 429:
+        metrics.inc('upstream_throttled_total', host=host, source='upstream')
+
+
+def _record_budget(url):
+    metrics.inc('upstream_throttled_total', host=metrics.host(url), source='budget')
+
+
+def request(method, url, **kwargs):
+    with timing.phase('budget'):
+        wait = budget.acquire(url, kwargs.get('headers'))
+    if wait:
+        _record_budget(url)
+        return _throttled(method, url, wait)
+    kwargs.setdefault('timeout', _timeout())
+    target = _target(url)
+    start = time.perf_counter()
+    try:
+        response = session_for(target).request(method, target, **kwargs)
+    except requests.exceptions.RequestException:
+        _record(url, kwargs.get('params'), start, 'error')
+        raise
+    _record(url, kwargs.get('params'), start, response.status_code)
+    budget.observe(url, response.status_code, response.headers)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def fan_out(fn, items, limit=None):
+    """Call fn on every item with at most `limit` calls in flight; results keep item order."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+
+    limit = limit or getattr(settings, 'UPSTREAM_FANOUT', 8)
+    # In the caller's context, so the calls count toward its request's timings.
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=min(limit, len(items))) as pool:
+        return list(pool.map(lambda item: context.copy().run(fn, item), items))
+
+
+def close():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+# ─── Async client (ASGI views) ───────────────────────────────────────────────
+#
+# httpx keeps its own per-host keep-alive pools. An AsyncClient is bound to
+# the event loop it was first used on, so there is one per running loop.
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        connect, read = _timeout()
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(
+                max_connections=getattr(settings, 'UPSTREAM_ASYNC_MAX_CONNECTIONS', 1000),
+                max_keepalive_connections=getattr(settings, 'UPSTREAM_ASYNC_MAX_KEEPALIVE', 100),
+            ),
+        )
+    return client
+
+
+async def arequest(method, url, **kwargs):
+    with timing.phase('budget'):
+        wait = await budget.aacquire(url, kwargs.get('headers'))
+    if wait:
+        _record_budget(url)
+        return httpx.Response(
+            429,
+            headers={'Retry-After': str(math.ceil(wait))},
+            json={'error': 'upstream_throttled'},
+            request=httpx.Request(method, url),
+        )
+    start = time.perf_counter()
+    try:
+        response = await async_client().request(method, _target(url), **kwargs)
+    except httpx.HTTPError:
+        _record(url, kwargs.get('params'), start, 'error')
+        raise
+    _record(url, kwargs.get('params'), start, response.status_code)
+    await budget.aobserve(url, response.status_code, response.headers)
+    return response
+
+
+async def aget(url, **kwargs):
+    return await arequest('GET', url, **kwargs)
+
+
+async def apost(url, **kwargs):
+    return await arequest('POST', url, **kwargs)
+
+
+async def aput(url, **kwargs):
+    return await arequest('PUT', url, **kwargs)
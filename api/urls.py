@@ -1,29 +1,45 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# Under ASGI the Spotify proxy routes are served by the async views.
+proxy = async_views if settings.API_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('auth/spotify/login/', views.spotify_login, name='spotify_login'),
     path('auth/spotify/callback/', views.spotify_callback, name='spotify_callback'),
-    path('auth/spotify/me/', views.me, name='me'),
-    path('top_tracks/', views.top_tracks, name="top_tracks"),
-    path('top_artists/', views.top_artists, name="top_artists"),
-    path('play_track/', views.play_track, name="play_track"),
+    path('auth/spotify/me/', proxy.me, name='me'),
+    path('top_tracks/', proxy.top_tracks, name="top_tracks"),
+    path('top_artists/', proxy.top_artists, name="top_artists"),
+    path('play_track/', proxy.play_track, name="play_track"),
     path('logout/', views.logout_view, name="logout"),
     path('logout/', views.logout_view, name="logout"),
-    path('get_artist/', views.get_artist, name="get_artist"),
-    path('get_my_playlists/', views.get_my_playlists, name="get_my_playlists"),
-    path('get_artist_albums/', views.get_artist_albums, name="get_artist_albums"),
-    path('get_artist_info_via_last_fm/', views.get_artist_info_via_last_fm, name="get_artist_info_via_last_fm"),
-    path('get_artist_top_tracks_via_last_fm/', views.get_artist_top_tracks_via_last_fm, name="get_artist_top_tracks_via_last_fm"),
-    path('get_similar_artist_links/', views.get_similar_artist_links, name="get_similar_artist_links"),
-    path('get_track_spotify_url/', views.get_track_spotify_url, name="get_track_spotify_url"),
-    path('get_recently_played_tracks/', views.get_recently_played_tracks, name="get_recently_played_tracks"),
-    path('call_next_api_url/', views.call_next_api_url, name="call_next_api_url"),
-    path('search_item/', views.search_item, name="search_item"),
-    path('get_currently_playing/', views.get_currently_playing, name="get_currently_playing"),
+    path('get_artist/', proxy.get_artist, name="get_artist"),
+    path('get_my_playlists/', proxy.get_my_playlists, name="get_my_playlists"),
+    path('get_artist_albums/', proxy.get_artist_albums, name="get_artist_albums"),
+    path('get_artist_info_via_last_fm/', proxy.get_artist_info_via_last_fm, name="get_artist_info_via_last_fm"),
+    path('get_artist_top_tracks_via_last_fm/', proxy.get_artist_top_tracks_via_last_fm, name="get_artist_top_tracks_via_last_fm"),
+    path('get_similar_artist_links/', proxy.get_similar_artist_links, name="get_similar_artist_links"),
+    path('dashboard/', proxy.dashboard, name="dashboard"),
+    path('artist_profile/', proxy.artist_profile, name="artist_profile"),
+    path('similar_artist_images/', views.similar_artist_images, name="similar_artist_images"),
+    path('get_track_spotify_url/', proxy.get_track_spotify_url, name="get_track_spotify_url"),
+    path('get_track_spotify_urls/', views.get_track_spotify_urls, name="get_track_spotify_urls"),
+    path('get_recently_played_tracks/', proxy.get_recently_played_tracks, name="get_recently_played_tracks"),
+    path('call_next_api_url/', proxy.call_next_api_url, name="call_next_api_url"),
+    path('search_item/', proxy.search_item, name="search_item"),
+    path('get_currently_playing/', proxy.get_currently_playing, name="get_currently_playing"),
 
 
     path('health_check/', views.health_check, name="health_check"),
+    path('cache_stats/', views.cache_stats, name="cache_stats"),
+    path('metrics/', views.prometheus_metrics, name="metrics"),
     path('request_access/', views.request_access, name="request_access"),
 
-]
\ No newline at end of file
+]
+
+# Long-lived streams need the ASGI server; under WSGI the frontend keeps polling.
+if settings.API_ASYNC_VIEWS:
+    urlpatterns.append(
+        path('currently_playing_stream/', async_views.currently_playing_stream, name="currently_playing_stream"),
+    )
\ No newline at end of file
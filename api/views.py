@@ -2,6 +2,7 @@ import requests
 from datetime import timedelta
 from urllib.parse import urlencode
 import hashlib
+import hmac
 from django_ratelimit.decorators import ratelimit
 
 
@@ -10,15 +11,19 @@ from django.contrib.auth.models import User
 from django.shortcuts import redirect
 from django.utils import timezone
 
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, authentication_classes
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from .authentication import JWTAuthentication
 from .models import SpotifyToken
+from . import budget, caching, catalog, metrics, musicbrainz, popularity, prefetch, projection, upstream
+from .paging import all_pages
+from .caching import cached_many, cached_view, fetch_once, fetch_part
+from .tokens import get_valid_token, retry_locked, store_token
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
-
-from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
 
 from functools import wraps
 
@@ -68,21 +73,74 @@ def health_check(request):
     return Response({'status': 'ok'})
 
 
+# ─── Operational endpoints: metrics and cache stats ─────────────────────────
+
+def is_internal(request):
+    """The request carries `Bearer <METRICS_TOKEN>` (Prometheus' bearer_token) or a staff user's JWT."""
+    expected = getattr(settings, 'METRICS_TOKEN', '')
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if expected and hmac.compare_digest(header.encode(), f'Bearer {expected}'.encode()):
+        return True
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return bool(result and result[0].is_staff)
+
+
+def internal_only(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_internal(request):
+            return JsonResponse({'error': 'forbidden'}, status=403)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@api_view(['GET'])
+@authentication_classes([])
+@internal_only
+def cache_stats(request):
+    return Response({**caching.stats(), 'upstream_budget': budget.stats()})
+
+
+@require_http_methods(["GET"])
+@internal_only
+def prometheus_metrics(request):
+    # Plain Django view: Prometheus wants text, not DRF's content negotiation.
+    totals, workers = metrics.collect()
+    return HttpResponse(metrics.render(totals, workers), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def ratelimit_error(request, exception):
+    match = getattr(request, 'resolver_match', None)
+    metrics.inc('rate_limited_total', view=match.url_name if match else 'unmatched')
     return JsonResponse({'error': 'rate_limited'}, status=429)
 
+# Shared by every authenticated Spotify proxy view, sync and async.
+SPOTIFY_RATELIMIT = {'group': 'spotify_api', 'key': 'ip', 'rate': '100/m'}
+
+
 def spotify_auth_required(func):
     @wraps(func)
-    @ratelimit(key='ip', rate='100/m', block=True)
+    # Not block=True: DRF would answer its Ratelimited (a PermissionDenied)
+    # with a 403 before RATELIMIT_VIEW saw it.
+    @ratelimit(**SPOTIFY_RATELIMIT, block=False)
     def wrapper(request, *args, **kwargs):
+        if request.limited:
+            return ratelimit_error(request, None)
         if not request.user.is_authenticated:
             return Response({'error': 'not_authenticated'}, status=401)
         
-        access_token = get_valid_token(request.user)
-        if not access_token:
-            return Response({'error': 'token_expired'}, status=401)
-        
-        return func(request, *args, access_token=access_token, **kwargs)
+        try:
+            access_token = get_valid_token(request.user)
+            if not access_token:
+                return Response({'error': 'token_expired'}, status=401)
+
+            return func(request, *args, access_token=access_token, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print(f"[upstream] {func.__name__} failed: {e}")
+            return Response({'error': 'upstream_unavailable'}, status=502)
     return wrapper
 
 
@@ -126,7 +184,7 @@ def spotify_callback(request):
     if error:
         return redirect(f"{settings.FRONTEND_URL}?error=access_denied")
 
-    token_response = requests.post(
+    token_response = upstream.post(
         'https://accounts.spotify.com/api/token',
         data={
             'grant_type': 'authorization_code',
@@ -152,7 +210,7 @@ def spotify_callback(request):
         print("TOKEN ERROR:", token_data)
         return redirect(f"{settings.FRONTEND_URL}?error=no_access_token&detail={token_data.get('error', 'unknown')}")
 
-    profile_response = requests.get(
+    profile_response = upstream.get(
         'https://api.spotify.com/v1/me',
         headers={'Authorization': f'Bearer {access_token}'}
     )
@@ -178,14 +236,16 @@ def spotify_callback(request):
     )
 
     expires_at = timezone.now() + timedelta(seconds=expires_in)
-    SpotifyToken.objects.update_or_create(
+    token, _ = retry_locked(lambda: SpotifyToken.objects.update_or_create(
         user=user,
         defaults={
             'access_token': access_token,
             'refresh_token': refresh_token,
             'expires_at': expires_at,
         }
-    )
+    ))
+    store_token(token)
+    prefetch.prefetch_user(user)
 
     refresh = RefreshToken.for_user(user)
     jwt_access = str(refresh.access_token)
@@ -197,122 +257,59 @@ def spotify_callback(request):
     )
 
 
-# ─── Helper: Get a valid token, refreshing if needed ────────────────────────
-
-def get_valid_token(user):
-    try:
-        token = SpotifyToken.objects.get(user=user)
-    except SpotifyToken.DoesNotExist:
-        return None
-
-    if token.expires_at <= timezone.now():
-        token = refresh_spotify_token(token)
-
-    return token.access_token
-
-
-def refresh_spotify_token(token):
-    response = requests.post(
-        'https://accounts.spotify.com/api/token',
-        data={
-            'grant_type': 'refresh_token',
-            'refresh_token': token.refresh_token,
-            'client_id': settings.SPOTIFY_CLIENT_ID,
-            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
-        },
-        headers={'Content-Type': 'application/x-www-form-urlencoded'}
-    )
-
-    new_data = response.json()
-    token.access_token = new_data.get('access_token')
-    token.expires_at = timezone.now() + timedelta(seconds=new_data.get('expires_in', 3600))
-    token.save()
-
-    return token
-
-
 # ─── Get current user's Spotify profile ─────────────────────────────────────
 
 @api_view(['GET'])
 @spotify_auth_required
+@cached_view('me-{user}', fresh=60*60*24, stale=60*60*24*7)
 def me(request, access_token):
-    cache_key = f'me-{request.user.id}'
-    cached = cache.get(cache_key)
-    if cached:
-        print("ME cached")
-        return Response(cached)
-    
-    response = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={'Authorization': f'Bearer {access_token}'}
+    return fetch_part(
+        lambda: upstream.get(
+            'https://api.spotify.com/v1/me',
+            headers={'Authorization': f'Bearer {access_token}'}
+        ),
+        'Failed to fetch profile',
     )
 
-    if not response.ok:
-        return Response({'error': 'Failed to fetch profile', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24)
-    return Response(data)
-
 
 # ─── Get user's top tracks ───────────────────────────────────────────────────
 
 @api_view(['GET'])
 @spotify_auth_required
+@cached_view('top-tracks-{user}-{time_range}', fresh=60*30, stale=60*60*24, params={'time_range': 'medium_term'})
 def top_tracks(request, access_token):
 
     time_range = request.query_params.get("time_range", "medium_term")
     
-    cache_key = f'top-tracks-{request.user.id}-{time_range}'
-    cached = cache.get(cache_key)
-    
-    if cached:
-        print(f"top-tracks {time_range} cached")
-        return Response(cached)
-    
-    response = requests.get(
-        'https://api.spotify.com/v1/me/top/tracks',
-        headers={'Authorization': f'Bearer {access_token}'},
-        params={"time_range": time_range, "limit": 50}
+    return fetch_part(
+        lambda: upstream.get(
+            'https://api.spotify.com/v1/me/top/tracks',
+            headers={'Authorization': f'Bearer {access_token}'},
+            params={"time_range": time_range, "limit": 50}
+        ),
+        'Failed to fetch top tracks',
+        projection.TOP_TRACKS,
     )
 
-    if not response.ok:
-        return Response({'error': 'Failed to fetch top tracks', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*30)
-    return Response(data)
-
 
 # ─── Get user's top artists ──────────────────────────────────────────────────
 
 @api_view(['GET'])
 @spotify_auth_required
+@cached_view('top-artist-{user}-{time_range}', fresh=60*60*24, stale=60*60*24*7, params={'time_range': 'medium_term'})
 def top_artists(request, access_token):
     
     time_range = request.query_params.get("time_range", "medium_term")
     
-    cache_key = f'top-artist-{request.user.id}-{time_range}'
-    cached = cache.get(cache_key)
-    if cached:
-        print(f"top-artist {time_range} cached!")
-        return Response(cached)
-    
-    
-    response = requests.get(
-        'https://api.spotify.com/v1/me/top/artists',
-        headers={'Authorization': f'Bearer {access_token}'},
-        params={"time_range": time_range, "limit": 50, "fields": "items(id,name,images,genres,followers,popularity,external_urls,uri)"}
+    return fetch_part(
+        lambda: upstream.get(
+            'https://api.spotify.com/v1/me/top/artists',
+            headers={'Authorization': f'Bearer {access_token}'},
+            params={"time_range": time_range, "limit": 50, "fields": "items(id,name,images,genres,followers,popularity,external_urls,uri)"}
+        ),
+        'Failed to fetch top artists',
     )
 
-    if not response.ok:
-        return Response({'error': 'Failed to fetch top artists', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24)
-    
-    return Response(data)
-
 
 
 
@@ -329,7 +326,7 @@ def play_track(request, access_token):
 
     headers = {'Authorization': f'Bearer {access_token}'}
 
-    response = requests.put(
+    response = upstream.put(
         "https://api.spotify.com/v1/me/player/play",
         headers=headers,
         json={"uris": [track_uri]}
@@ -337,7 +334,7 @@ def play_track(request, access_token):
 
     # No active device — try to find one and retry
     if response.status_code == 404:
-        devices_response = requests.get(
+        devices_response = upstream.get(
             "https://api.spotify.com/v1/me/player/devices",
             headers=headers
         )
@@ -352,14 +349,14 @@ def play_track(request, access_token):
         device_id = devices[0]["id"]
 
         # Transfer playback to device first
-        requests.put(
+        upstream.put(
             "https://api.spotify.com/v1/me/player",
             headers=headers,
             json={"device_ids": [device_id], "play": False}
         )
 
         # Retry play on that device
-        response = requests.put(
+        response = upstream.put(
             f"https://api.spotify.com/v1/me/player/play?device_id={device_id}",
             headers=headers,
             json={"uris": [track_uri]}
@@ -382,181 +379,462 @@ def logout_view(request):
 
 @api_view(["GET"])
 @spotify_auth_required
+@popularity.counted
+@cached_view('artist-{artist_id}', fresh=60*60*24, stale=60*60*24*7)
 def get_artist(request, access_token):
     artist_id = request.query_params.get('artist_id')
     if not artist_id:
         return Response({'error': 'artist_id is required'})
-    
-    cache_key = f'artist-{artist_id}'
-    cached = cache.get(cache_key)
-    if cached:
-        print(f'cached {cache_key}!')
-        return Response(cached)
-        
-    response = requests.get(
-        f'https://api.spotify.com/v1/artists/{artist_id}',
-        headers={'Authorization': f'Bearer {access_token}'},
-    )
-    
-    if not response.ok:
-        return Response({'error': 'Failed to fetch top artists', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24)
 
-    return Response(data)
+    return fetch_part(
+        lambda: upstream.get(
+            f'https://api.spotify.com/v1/artists/{artist_id}',
+            headers={'Authorization': f'Bearer {access_token}'},
+        ),
+        'Failed to fetch top artists',
+    )
 
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@all_pages('https://api.spotify.com/v1/me/playlists', 'Failed to fetch playlists', projection.PLAYLISTS)
+@cached_view('myplaylists-{user}', fresh=60*60*24, stale=60*60*24)
 def get_my_playlists(request, access_token):
 
-    cache_key = f'myplaylists-{request.user.id}'
-    cached = cache.get(cache_key)
-    if cached:
-        print(f'cached {cache_key}!')
-        return Response(cached)
-        
-    response = requests.get(
-        f'https://api.spotify.com/v1/me/playlists',
-        headers={'Authorization': f'Bearer {access_token}'},
+    return fetch_part(
+        lambda: upstream.get(
+            f'https://api.spotify.com/v1/me/playlists',
+            headers={'Authorization': f'Bearer {access_token}'},
+        ),
+        'Failed to fetch playlists',
+        projection.PLAYLISTS,
     )
-    
-    if not response.ok:
-        return Response({'error': 'Failed to fetch playlists', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24)
-
-    return Response(data)
 
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@all_pages('https://api.spotify.com/v1/artists/{artist_id}/albums', 'Failed to fetch albums')
+@cached_view('artist_albums-{artist_id}', fresh=60*60*24, stale=60*60*24*7)
 def get_artist_albums(request, access_token):
     artist_id = request.query_params.get('artist_id')
     
-    cache_key = f'artist_albums-{artist_id}'
-    cached = cache.get(cache_key)
-    
-    if cached:
-        print(f"cached {cache_key}")
-        return Response(cached)
-    
-    response = requests.get(
-        f"https://api.spotify.com/v1/artists/{artist_id}/albums",
-        headers={'Authorization': f'Bearer {access_token}'}
+    return fetch_part(
+        lambda: upstream.get(
+            f"https://api.spotify.com/v1/artists/{artist_id}/albums",
+            headers={'Authorization': f'Bearer {access_token}'}
+        ),
+        'Failed to fetch playlists',
     )
-    
-    if not response.ok:
-        return Response({'error': 'Failed to fetch playlists', 'status': response.status_code}, status=response.status_code)
-    
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24)
-    return Response(data)
+
+
+# ─── Last.fm / MusicBrainz helpers ──────────────────────────────────────────
+
+def last_fm_params(method, artist_name):
+    return {
+        "method": method,
+        "artist": artist_name,
+        "api_key": settings.LAST_FM_API_KEY,
+        "format": "json"
+    }
+
+
+def fetch_last_fm(method, artist_name):
+    return upstream.get("https://ws.audioscrobbler.com/2.0/", params=last_fm_params(method, artist_name))
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('artist-info-last-fm-{artist_name}', fresh=60*60*24*3, stale=60*60*24*7)
 def get_artist_info_via_last_fm(request, access_token):
     artist_name = request.query_params.get('artist_name')
     
-    cache_key = f"artist-info-last-fm-{artist_name}"
-    cached = cache.get(cache_key)
-    
-    if cached:
-        print(f"cached {cache_key}")
-        return Response(cached)
-    
-    response = requests.get(
-        f"https://ws.audioscrobbler.com/2.0/",
-        params = {
-            "method": "artist.getInfo",
-            "artist": artist_name,
-            "api_key": settings.LAST_FM_API_KEY,
-            "format": "json"
-        }
+    return fetch_part(
+        lambda: fetch_last_fm("artist.getInfo", artist_name),
+        'Failed to get artist info via last fm',
     )
-    
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24*3)
-    return Response(data)
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('artist-top-tracks-last-fm-{artist_name}', fresh=60*60*24*3, stale=60*60*24*7)
 def get_artist_top_tracks_via_last_fm(request, access_token):
     artist_name = request.query_params.get('artist_name')
     
-    cache_key = f"artist-top-tracks-last-fm-{artist_name}"
-    cached = cache.get(cache_key)
-    
-    if cached:
-        print(f"cached {cache_key}")
-        return Response(cached)
-
-    response = requests.get(
-        "https://ws.audioscrobbler.com/2.0/",
-        params={
-            "method": "artist.getTopTracks",
-            "artist": artist_name,
-            "api_key": settings.LAST_FM_API_KEY,
-            "format": "json"
-        }
+    return fetch_part(
+        lambda: fetch_last_fm("artist.getTopTracks", artist_name),
+        'Failed to get artist top tracks via last fm',
     )
-    
-    if not response.ok:
-        return Response({'error': 'Failed to get artist top tracks via last fm', 'status': response.status_code}, status=response.status_code)
-    
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*60*24*3)
-    return Response(data)
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('artist-mbid-{artist_mbid}', fresh=60*60*24*3, stale=60*60*24*30)
 def get_similar_artist_links(request, access_token):
     artist_mbid = request.query_params.get('artist_mbid')
     
     if not artist_mbid:
         return Response({"error": "artist_mbid is required"}, status=400)
-    
-    cache_key = f"artist-mbid-{artist_mbid}"
-    cached = cache.get(cache_key)
-    
-    if cached:
-        print(f"cached {cache_key}")
-        return Response(cached)
-    
+
+    spotify_url = musicbrainz.spotify_url(artist_mbid, wait=settings.MUSICBRAINZ_WAIT)
+    if spotify_url is None:
+        return None, {"error": "Failed to fetch from MusicBrainz", "status": 503}
+    return {"spotify_url": spotify_url or None}, None
+
+
+# ─── Similar-artist images: Last.fm → MusicBrainz → Spotify, server-side ────
+
+MAX_SIMILAR_ARTISTS = 50
+SPOTIFY_ARTISTS_CHUNK = 50
+
+
+def spotify_artist_id(spotify_url):
+    return spotify_url.rstrip('/').split('/')[-1].split('?')[0] or None
+
+
+def resolve_spotify_artists(artist_ids, access_token):
+    """Artist objects by ID: from `artist-{id}`, the catalog, or Spotify's multi-ID endpoint in chunks of 50.
+
+    Catalog rows only carry id, name and images, which is all similar_artist_images reads.
+    """
+    keys = {artist_id: f'artist-{artist_id}' for artist_id in artist_ids}
+    cached = caching.get_many(keys.values())
+    found = {artist_id: cached[key] for artist_id, key in keys.items() if key in cached}
+    missing = [artist_id for artist_id in keys if artist_id not in found]
+    if missing:
+        found.update(catalog.find_artists(missing))
+        missing = [artist_id for artist_id in missing if artist_id not in found]
+    chunks = [missing[i:i + SPOTIFY_ARTISTS_CHUNK] for i in range(0, len(missing), SPOTIFY_ARTISTS_CHUNK)]
+
+    def fetch(chunk):
+        try:
+            response = upstream.get(
+                "https://api.spotify.com/v1/artists",
+                headers={'Authorization': f'Bearer {access_token}'},
+                params={"ids": ",".join(chunk)},
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"[resolve_spotify_artists] {e}")
+            return []
+        return [a for a in response.json().get("artists", []) if a] if response.ok else []
+
+    fetched = {}
+    for artists in upstream.fan_out(fetch, chunks):
+        for artist in artists:
+            found[artist["id"]] = fetched[f'artist-{artist["id"]}'] = artist
+
+    if fetched:
+        caching.store_many(fetched, fresh=60*60*24, stale=60*60*24*7)
+        catalog.store_artists(fetched.values())
+    return found
+
+
+@api_view(["POST"])
+@spotify_auth_required
+def similar_artist_images(request, access_token):
+    names = request.data.get("artists")
+
+    if not isinstance(names, list) or not names:
+        return Response({"error": "artists must be a non-empty list of names"}, status=400)
+
+    if len(names) > MAX_SIMILAR_ARTISTS:
+        return Response({"error": f"at most {MAX_SIMILAR_ARTISTS} artists per request"}, status=400)
+
+    names = list(dict.fromkeys(str(name) for name in names if name))
+
+    def last_fm_info(name):
+        try:
+            response = fetch_last_fm("artist.getInfo", name)
+        except requests.exceptions.RequestException:
+            return None
+        return response.json() if response.ok else None
+
+    infos = cached_many(names, lambda name: f"artist-info-last-fm-{name}", last_fm_info, 60*60*24*3, 60*60*24*7)
+    mbids = {name: (info.get("artist") or {}).get("mbid") for name, info in infos.items()}
+
+    # Lookups MusicBrainz hasn't answered in time stay queued and are stored
+    # for next time; those artists just have no image in this response.
+    links = musicbrainz.spotify_urls({m for m in mbids.values() if m}, wait=settings.MUSICBRAINZ_BATCH_WAIT)
+    spotify_ids = {
+        name: spotify_artist_id(links[mbid])
+        for name, mbid in mbids.items()
+        if links.get(mbid)
+    }
+
+    artists = resolve_spotify_artists(list(dict.fromkeys(i for i in spotify_ids.values() if i)), access_token)
+
+    images = {}
+    for name in names:
+        artist = artists.get(spotify_ids.get(name))
+        artist_images = (artist or {}).get("images") or []
+        images[name] = artist_images[0]["url"] if artist_images else None
+
+    # The IDs let the page link each similar artist without looking it up again.
+    return Response({"images": images, "ids": {name: spotify_ids.get(name) for name in names}})
+
+
+# ─── Dashboard: everything the first render needs, in one round trip ──────
+
+TIME_RANGES = ('short_term', 'medium_term', 'long_term')
+
+
+# The parts builders below take the fetch strategy: `fetcher` here, or
+# async_views._fetcher, which awaits the same request. Both are called as
+# fetch(url, error, keep, **request kwargs) and return a compute() for caching.
+
+def fetcher(url, error, keep=None, **kwargs):
+    """A compute() for caching: GET `url` through fetch_part, trimmed to `keep`."""
+    return lambda: fetch_part(lambda: upstream.get(url, **kwargs), error, keep)
+
+
+def spotify_parts(access_token, fetch):
+    """spotify(path, error, keep, **params): a compute() for GET /v1{path}.
+
+    `keep` is our projection; `fields` in params is Spotify's own.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    def spotify(path, error, keep=None, **params):
+        return fetch(f"https://api.spotify.com/v1{path}", error, keep, headers=headers, params=params or None)
+    return spotify
+
+
+def user_parts(user, access_token, time_range, fetch=fetcher):
+    """name: (cache key, fresh, stale, compute) — same keys, TTLs and fields as the single views."""
+    spotify = spotify_parts(access_token, fetch)
+    return {
+        'me': (f'me-{user}', 60*60*24, 60*60*24*7, spotify('/me', 'Failed to fetch profile')),
+        'recently_played': (
+            f"{user}-recently-played-tracks", 60*5, 60*60,
+            spotify('/me/player/recently-played', 'Failed to fetch recently played tracks',
+                    projection.RECENTLY_PLAYED, limit=50),
+        ),
+        'top_tracks': (
+            f'top-tracks-{user}-{time_range}', 60*30, 60*60*24,
+            spotify('/me/top/tracks', 'Failed to fetch top tracks',
+                    projection.TOP_TRACKS, time_range=time_range, limit=50),
+        ),
+        'top_artists': (
+            f'top-artist-{user}-{time_range}', 60*60*24, 60*60*24*7,
+            spotify('/me/top/artists', 'Failed to fetch top artists', time_range=time_range, limit=50,
+                    fields="items(id,name,images,genres,followers,popularity,external_urls,uri)"),
+        ),
+        'playlists': (
+            f'myplaylists-{user}', 60*60*24, 60*60*24,
+            spotify('/me/playlists', 'Failed to fetch playlists', projection.PLAYLISTS),
+        ),
+    }
+
+
+def artist_parts(artist_id, access_token, fetch=fetcher):
+    """Same as user_parts, for the get_artist and get_artist_albums entries of one artist."""
+    spotify = spotify_parts(access_token, fetch)
+    return {
+        'artist': (
+            f'artist-{artist_id}', 60*60*24, 60*60*24*7,
+            spotify(f'/artists/{artist_id}', 'Failed to fetch artist'),
+        ),
+        'albums': (
+            f'artist_albums-{artist_id}', 60*60*24, 60*60*24*7,
+            spotify(f'/artists/{artist_id}/albums', 'Failed to fetch artist albums'),
+        ),
+    }
+
+
+def last_fm_parts(artist_name, fetch=fetcher):
+    """Same as user_parts, for the Last.fm artist info and top tracks entries."""
+    def last_fm(method, error):
+        return fetch("https://ws.audioscrobbler.com/2.0/", error, params=last_fm_params(method, artist_name))
+
+    return {
+        'artist_info': (
+            f"artist-info-last-fm-{artist_name}", 60*60*24*3, 60*60*24*7,
+            last_fm("artist.getInfo", 'Failed to get artist info via last fm'),
+        ),
+        'top_tracks': (
+            f"artist-top-tracks-last-fm-{artist_name}", 60*60*24*3, 60*60*24*7,
+            last_fm("artist.getTopTracks", 'Failed to get artist top tracks via last fm'),
+        ),
+    }
+
+
+@api_view(["GET"])
+@spotify_auth_required
+def dashboard(request, access_token):
+    time_range = request.query_params.get("time_range", "short_term")
+    parts = user_parts(request.user.id, access_token, time_range)
+    # The dashboard doesn't render playlists.
+    del parts['playlists']
+
+    cached = caching.read_many(key for key, _, _, _ in parts.values())
+    result = {}
+    for name, (key, fresh, stale, compute) in parts.items():
+        result[name], is_stale = cached.get(key, (None, False))
+        if is_stale:
+            caching.refresh_in_background(key, fresh, compute, stale)
+    missing = [name for name in parts if result[name] is None]
+
+    def resolve(name):
+        if name == 'currently_playing':
+            try:
+                return currently_playing_part(access_token)
+            except requests.exceptions.RequestException as e:
+                return None, {'error': str(e), 'status': 502}
+        key, fresh, stale, compute = parts[name]
+        return fetch_once(key, fresh, compute, stale)
+
+    errors = {}
+    fetched = upstream.fan_out(resolve, missing + ['currently_playing'], limit=len(missing) + 1)
+    for name, (data, error) in zip(missing + ['currently_playing'], fetched):
+        result[name] = data
+        if error:
+            errors[name] = error
+
+    result['errors'] = errors
+    return Response(result)
+
+
+# ─── Artist page: Spotify artist + albums + Last.fm info + top tracks ──────
+
+@api_view(["GET"])
+@spotify_auth_required
+@popularity.counted
+def artist_profile(request, access_token):
+    artist_id = request.query_params.get('artist_id')
+    if not artist_id:
+        return Response({'error': 'artist_id is required'}, status=400)
+
+    # Optional: lets the Last.fm lookups start without waiting for the artist.
+    artist_name = request.query_params.get('artist_name')
+
+    def fetch(part):
+        key, fresh, stale, compute = part
+        return caching.cached_fetch(key, fresh, compute, stale)
+
+    def fetch_parts(parts):
+        return dict(zip(parts, upstream.fan_out(fetch, parts.values())))
+
+    parts = artist_parts(artist_id, access_token)
+    if artist_name:
+        parts.update(last_fm_parts(artist_name))
+    fetched = fetch_parts(parts)
+
+    if not artist_name:
+        artist, _ = fetched['artist']
+        if artist and artist.get('name'):
+            fetched.update(fetch_parts(last_fm_parts(artist['name'])))
+
+    return Response(artist_profile_result(fetched, artist_name))
+
+
+def artist_profile_result(fetched, artist_name):
+    """The artist_profile response from name: (data, error) of the parts fetched."""
+    result = {'artist': None, 'albums': None, 'artist_info': None, 'top_tracks': None}
+    errors = {}
+    for name, (data, error) in fetched.items():
+        result[name] = data
+        if error:
+            errors[name] = error
+
+    if result['artist'] is None and not artist_name:
+        errors.setdefault('artist_info', {'error': 'artist name unavailable', 'status': 424})
+        errors.setdefault('top_tracks', {'error': 'artist name unavailable', 'status': 424})
+    result['errors'] = errors
+    return result
+
+
+# ─── Spotify URL + artwork for a Last.fm (artist, track) pair ──────────────
+
+# Resolved pairs are kept in the catalog; the cache only holds a hot copy.
+# Pairs Spotify found nothing for are searched again after a day.
+TRACK_FOUND_TIMEOUT = 60*60*24
+TRACK_NOT_FOUND_TIMEOUT = 60*60*24
+TRACK_STALE_TIMEOUT = 60*60*24*7
+MAX_TRACK_BATCH = 50
+
+
+def track_spotify_cache_key(artist_name, track_name):
+    raw_key = f"track-spotify-{artist_name}-{track_name}"
+    return "track-spotify-" + hashlib.md5(raw_key.encode()).hexdigest()
+
+
+def track_result_timeout(result):
+    return TRACK_FOUND_TIMEOUT if result.get("spotify_url") else TRACK_NOT_FOUND_TIMEOUT
+
+
+def track_search_params(artist_name, track_name):
+    return {
+        "q": f"track:{track_name} artist:{artist_name}",
+        "type": "track",
+        "limit": 1
+    }
+
+
+def track_search_result(data):
+    """The {spotify_url, image} result for a pair from Spotify's search response."""
+    tracks = data.get("tracks", {}).get("items", [])
+
+    if not tracks:
+        return {"spotify_url": None, "image": None, "reason": "not found on Spotify"}
+
+    track = tracks[0]
+
+    spotify_url = track.get("external_urls", {}).get("spotify")
+
+    images = (track.get("album") or {}).get("images") or []
+    image_url = images[0]["url"] if images else None
+
+    return {"spotify_url": spotify_url, "image": image_url}
+
+
+def search_track_spotify_url(artist_name, track_name, access_token):
+    response = upstream.get(
+        "https://api.spotify.com/v1/search",
+        headers={"Authorization": f"Bearer {access_token}"},
+        params=track_search_params(artist_name, track_name),
+    )
+
+    if not response.ok:
+        return None, response.status_code
+
+    return track_search_result(response.json()), 200
+
+
+def track_request_cache_key(request):
+    artist_name = request.query_params.get('artist')
+    track_name = request.query_params.get('track')
+    if not artist_name or not track_name:
+        return None
+    return track_spotify_cache_key(artist_name, track_name)
+
+
+def track_search_part(artist_name, track_name, access_token):
     try:
-        response = requests.get(
-            f"https://musicbrainz.org/ws/2/artist/{artist_mbid}?inc=url-rels&fmt=json",
-            headers={"User-Agent": "Spontify/1.0 (avilakraeg@gmail.com)"}
-        )
-        
-        if response.status_code != 200:
-            return Response({"error": "Failed to fetch from MusicBrainz"}, status=response.status_code)
-        
-        data = response.json()
-        relations = data.get("relations", [])
-        
-        spotify_url = next(
-            (r["url"]["resource"] for r in relations if "spotify.com/artist" in r["url"]["resource"]),
-            None
-        )
-        
-        result = {"spotify_url": spotify_url}
-        cache.set(cache_key, result, timeout=60*60*24*3)
-        return Response(result)
-    
+        result, status = search_track_spotify_url(artist_name, track_name, access_token)
     except requests.exceptions.RequestException as e:
-        return Response({"error": str(e)}, status=500)
-    
+        return None, {"error": str(e), "status": 500}
+
+    if result is None:
+        return None, {"error": "Failed to search Spotify", "status": status}
+    return result, None
+
+
+def track_lookup_part(artist_name, track_name, access_token):
+    """The catalog's result for the pair, or a Spotify search, stored in the catalog."""
+    result = catalog.find_track(artist_name, track_name, TRACK_NOT_FOUND_TIMEOUT)
+    if result is not None:
+        return result, None
+
+    result, error = track_search_part(artist_name, track_name, access_token)
+    if result is not None:
+        catalog.store_tracks({(artist_name, track_name): result})
+    return result, error
+
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view(track_request_cache_key, fresh=track_result_timeout, stale=TRACK_STALE_TIMEOUT)
 def get_track_spotify_url(request, access_token):
     artist_name = request.query_params.get('artist')
     track_name = request.query_params.get('track')
@@ -564,155 +842,151 @@ def get_track_spotify_url(request, access_token):
     if not artist_name or not track_name:
         return Response({"error": "artist and track are required"}, status=400)
 
-    raw_key = f"track-spotify-{artist_name}-{track_name}"
-    cache_key = "track-spotify-" + hashlib.md5(raw_key.encode()).hexdigest()    
-    cached = cache.get(cache_key)
-    if cached:
-        return Response(cached)
+    return track_lookup_part(artist_name, track_name, access_token)
 
-    try:
-        response = requests.get(
-            "https://api.spotify.com/v1/search",
-            headers={"Authorization": f"Bearer {access_token}"},
-            params={
-                "q": f"track:{track_name} artist:{artist_name}",
-                "type": "track",
-                "limit": 1
-            }
-        )
 
-        if not response.ok:
-            return Response({"error": "Failed to search Spotify"}, status=response.status_code)
-
-        data = response.json()
-        tracks = data.get("tracks", {}).get("items", [])
-
-        if not tracks:
-            result = {"spotify_url": None, "image": None, "reason": "not found on Spotify"}
-            cache.set(cache_key, result, timeout=60*60*24)
-            return Response(result)
-
-        track = tracks[0]
+@api_view(["POST"])
+@spotify_auth_required
+def get_track_spotify_urls(request, access_token):
+    tracks = request.data.get("tracks")
+
+    if not isinstance(tracks, list) or not tracks:
+        return Response({"error": "tracks must be a non-empty list of {artist, track}"}, status=400)
+
+    if len(tracks) > MAX_TRACK_BATCH:
+        return Response({"error": f"at most {MAX_TRACK_BATCH} tracks per request"}, status=400)
+
+    pairs = []
+    for item in tracks:
+        if not isinstance(item, dict) or not item.get("artist") or not item.get("track"):
+            return Response({"error": "artist and track are required"}, status=400)
+        pairs.append((str(item["artist"]), str(item["track"])))
+
+    cache_keys = {pair: track_spotify_cache_key(*pair) for pair in pairs}
+    cached = caching.read_many(cache_keys.values())
+    results = {}
+    for pair, key in cache_keys.items():
+        data, is_stale = cached.get(key, (None, False))
+        if data is None:
+            continue
+        results[pair] = data
+        if is_stale:
+            caching.refresh_in_background(
+                key, track_result_timeout, lambda pair=pair: track_lookup_part(*pair, access_token), TRACK_STALE_TIMEOUT,
+            )
+    missing = [pair for pair in cache_keys if pair not in results]
+
+    stored = catalog.find_tracks(missing, TRACK_NOT_FOUND_TIMEOUT)
+    if stored:
+        caching.store_many(
+            {cache_keys[pair]: result for pair, result in stored.items()},
+            fresh=TRACK_NOT_FOUND_TIMEOUT, stale=TRACK_STALE_TIMEOUT,
+        )
+        results.update(stored)
+        missing = [pair for pair in missing if pair not in stored]
 
-        spotify_url = track.get("external_urls", {}).get("spotify")
+    def resolve(pair):
+        return fetch_once(
+            cache_keys[pair], track_result_timeout, lambda: track_search_part(*pair, access_token), TRACK_STALE_TIMEOUT,
+        )
 
-        images = (track.get("album") or {}).get("images") or []
-        image_url = images[0]["url"] if images else None  
+    searched = {}
+    for pair, (result, error) in zip(missing, upstream.fan_out(resolve, missing)):
+        results[pair] = result if error is None else {"spotify_url": None, "image": None, **error}
+        if error is None:
+            searched[pair] = result
+    if searched:
+        catalog.store_tracks(searched)
 
-        result = {"spotify_url": spotify_url, "image": image_url}
+    return Response({
+        "results": [{"artist": artist, "track": track, **results[(artist, track)]} for artist, track in pairs]
+    })
 
-        cache.set(cache_key, result, timeout=60*60*24*120)
-        return Response(result)
 
-    except requests.exceptions.RequestException as e:
-        return Response({"error": str(e)}, status=500)
-    
-    
-    
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('{user}-recently-played-tracks', fresh=60*5, stale=60*60)
 def get_recently_played_tracks(request, access_token):
     
-    user = request.user.id
-    cache_key = f"{user}-recently-played-tracks"
-    cached = cache.get(cache_key)
-    if cached:
-        print(f"cached - {cache_key}")
-        return Response(cached)
-    
-    response = requests.get(
-        "https://api.spotify.com/v1/me/player/recently-played",
-        params={'limit': 50},
-        headers={'Authorization': f'Bearer {access_token}'}
+    return fetch_part(
+        lambda: upstream.get(
+            "https://api.spotify.com/v1/me/player/recently-played",
+            params={'limit': 50},
+            headers={'Authorization': f'Bearer {access_token}'}
+        ),
+        'Failed to fetch recently played tracks',
+        projection.RECENTLY_PLAYED,
     )
-        
-    if not response.ok:
-        return Response({'error': 'Failed to fetch recently played tracks', 'status': response.status_code}, status=response.status_code)
-    
-    data = response.json()
-    cache.set(cache_key, data, timeout=60*5)
-    
-    return Response(data)
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('{user}-{next_url}', fresh=60*10, stale=60*60)
 def call_next_api_url(request, access_token):
     next_url = request.query_params.get("next_url")
-    user = request.user.id
 
     if not next_url:
         return Response("error getting next url")
 
-    cache_key = f"{user}-{next_url}"
-    cached = cache.get(cache_key)
-    if cached:
-        print(f"cached {cache_key}") 
-        return Response(cached)
-
-    response = requests.get(
-        next_url,
-        headers={'Authorization': f'Bearer {access_token}'}
+    return fetch_part(
+        lambda: upstream.get(
+            next_url,
+            headers={'Authorization': f'Bearer {access_token}'}
+        ),
+        'Failed to fetch next url',
+        projection.for_url(next_url),
     )
 
-    if not response.ok:
-        return Response({'error': 'Failed to fetch next url', 'status': response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, 60 * 10) 
-    return Response(data)  
-
 
 
 @api_view(["GET"])
 @spotify_auth_required
+@cached_view('search-{q}', fresh=60*10, stale=60*60)
 def search_item(request, access_token):
     q = request.query_params.get("q")
 
     if not q:
         return Response({"error": "q is required"}, status=400)
 
-    cache_key = f"search-{q}"
-    cached = cache.get(cache_key)
-    if cached:
-        print(f"cached - {cache_key}")
-        return Response(cached)
-
-    response = requests.get(
-        "https://api.spotify.com/v1/search",
-        params={
-            "q": q,
-            "limit": 10,
-            "type": "album,playlist,track,artist,episode,show,audiobook",
-            "offset": 0,
-            "include_external": "audio",
-        },
-        headers={"Authorization": f"Bearer {access_token}"}
+    return fetch_part(
+        lambda: upstream.get(
+            "https://api.spotify.com/v1/search",
+            params={
+                "q": q,
+                "limit": 10,
+                "type": "album,playlist,track,artist,episode,show,audiobook",
+                "offset": 0,
+                "include_external": "audio",
+            },
+            headers={"Authorization": f"Bearer {access_token}"}
+        ),
+        'Failed to search',
+        projection.SEARCH,
     )
 
-    if not response.ok:
-        return Response({"error": "Failed to search", "status": response.status_code}, status=response.status_code)
-
-    data = response.json()
-    cache.set(cache_key, data, timeout=60 * 10)
-
-    return Response(data)
-
 
 
-@api_view(["GET"])
-@spotify_auth_required
-def get_currently_playing(request, access_token):
-    response = requests.get(
+def currently_playing_part(access_token):
+    response = upstream.get(
         "https://api.spotify.com/v1/me/player/currently-playing",
         params={"additional_types": "track"},
         headers={"Authorization": f"Bearer {access_token}"}
     )
 
     if response.status_code == 204 or not response.content:
-        return Response({"is_playing": False}, status=200)
+        return {"is_playing": False}, None
 
     if not response.ok:
-        return Response({"error": "Failed to get currently playing", "status": response.status_code}, status=response.status_code)
+        return None, {"error": "Failed to get currently playing", "status": response.status_code}
+
+    return response.json(), None
 
-    return Response(response.json())
\ No newline at end of file
+
+@api_view(["GET"])
+@spotify_auth_required
+def get_currently_playing(request, access_token):
+    data, error = currently_playing_part(access_token)
+    if error:
+        return Response(error, status=error["status"])
+
+    return Response(data)
@@ -0,0 +1,9 @@
+import os
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'spotify.settings')
+    os.environ.setdefault('DJANGO_SECRET_KEY', 'bench')
+
+    import django
+    django.setup()
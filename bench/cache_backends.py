@@ -0,0 +1,122 @@
+"""Cache latency: FileBasedCache vs. FileCache writes, and FileBasedCache vs.
+TieredCache (LRU L1 + shared L2) reads.
+
+    python -m bench.cache_backends [--keys 100000] [--gets 20000] [--value-bytes 2000]
+
+Use --keys 1000000 for the top of the range; populating takes a few minutes.
+Reads are skewed like real traffic: 80% of gets go to 20% of the keys.
+set(), add() and incr() are timed on the populated directory, where
+FileBasedCache lists every file per write and FileCache culls periodically.
+"""
+import argparse
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from bench import setup_django
+
+
+def _payload(size):
+    # Roughly the shape of a cached Spotify response.
+    item = {'id': 'x' * 22, 'name': 'track name', 'uri': 'spotify:track:' + 'x' * 22, 'popularity': 50}
+    return {'items': [dict(item, n=i) for i in range(max(size // 100, 1))]}
+
+
+def _keys(n):
+    return [f'artist-{i:07d}' for i in range(n)]
+
+
+def _skewed(keys, count):
+    hot = keys[:max(len(keys) // 5, 1)]
+    return [random.choice(hot) if random.random() < 0.8 else random.choice(keys) for _ in range(count)]
+
+
+def _measure(name, op, keys):
+    latencies = []
+    for key in keys:
+        start = time.perf_counter()
+        op(key)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(
+        f"{name:<28} p50={statistics.median(latencies) * 1e6:8.1f}us "
+        f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1e6:9.1f}us "
+        f"mean={statistics.fmean(latencies) * 1e6:8.1f}us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--gets', type=int, default=20000)
+    parser.add_argument('--value-bytes', type=int, default=2000)
+    parser.add_argument('--writes', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.cache import caches
+    from django.test import override_settings
+
+    location = tempfile.mkdtemp(prefix='bench-cache-')
+    bench_caches = {
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': location,
+            'TIMEOUT': None,
+            'OPTIONS': {'MAX_ENTRIES': args.keys * 2},
+        },
+        'locked': {
+            'BACKEND': 'api.cache_backends.FileCache',
+            'LOCATION': location,
+            'TIMEOUT': None,
+            'OPTIONS': {'MAX_ENTRIES': args.keys * 2},
+        },
+        'tiered': {
+            'BACKEND': 'api.cache_backends.TieredCache',
+            'LOCATION': 'bench-tiered',
+            'TIMEOUT': None,
+            'OPTIONS': {'L2': 'file', 'L1_MAX_BYTES': 64 * 1024 * 1024, 'L1_TIMEOUT': 600},
+        },
+    }
+
+    try:
+        with override_settings(CACHES=bench_caches):
+            file_cache, locked, tiered = caches['file'], caches['locked'], caches['tiered']
+            keys = _keys(args.keys)
+            value = _payload(args.value_bytes)
+
+            print(f"populating {args.keys} keys in {location} ...")
+            start = time.perf_counter()
+            # Skip the per-set cull (a full directory listing) while filling;
+            # the set() latency below measures it separately.
+            file_cache._cull = lambda: None
+            for key in keys:
+                file_cache.set(key, value)
+            print(f"  {args.keys / (time.perf_counter() - start):.0f} sets/s without culling")
+            del file_cache._cull
+
+            # FileBasedCache.incr() is BaseCache's get() then set().
+            file_cache.set('counter', 0)
+            locked.set('counter', 0)
+            writes = random.sample(keys, min(args.writes, len(keys)))
+            _measure('FileBasedCache.set', lambda key: file_cache.set(key, value), writes)
+            _measure('FileCache.set', lambda key: locked.set(key, value), writes)
+            _measure('FileBasedCache.add', lambda key: file_cache.add('lock-' + key, 1), writes)
+            _measure('FileCache.add', lambda key: locked.add('lock-' + key, 1), writes)
+            _measure('FileBasedCache.incr', lambda key: file_cache.incr('counter'), writes)
+            _measure('FileCache.incr', lambda key: locked.incr('counter'), writes)
+
+            reads = _skewed(keys, args.gets)
+            _measure('FileBasedCache.get', file_cache.get, reads)
+
+            _measure('TieredCache.get (cold L1)', tiered.get, reads)
+            _measure('TieredCache.get (warm L1)', tiered.get, reads)
+            print(f"  tier stats: {tiered.stats()}")
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
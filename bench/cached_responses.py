@@ -0,0 +1,74 @@
+"""Per-hit CPU of a cache hit: unpickle dict + DRF render vs. stored JSON bytes.
+
+    python -m bench.cached_responses [--rounds 2000]
+
+"dict" is the path before entries held bytes: unpickle the data, render
+it with DRF's JSONRenderer, and gzip it per response if the client asks.
+"bytes" unpickles a caching.Entry and sends its stored body or the
+pre-compressed copy for the negotiated encoding.
+"""
+import argparse
+import gzip
+import pickle
+import time
+
+from bench import payloads, setup_django
+
+
+def _per_hit_us(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from rest_framework.renderers import JSONRenderer
+
+    from api import caching, projection
+
+    renderer = JSONRenderer()
+    plain = RequestFactory().get('/')
+    gzipped = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+    brotli = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='br, gzip')
+
+    cases = {
+        'search_item': projection.project(payloads.search(), projection.SEARCH),
+        'top_tracks': projection.project(payloads.top_tracks(), projection.TOP_TRACKS),
+        'search_item (unprojected)': payloads.search(),
+        'top_tracks (unprojected)': payloads.top_tracks(),
+    }
+
+    print(f"{'payload':<28}{'path':<16}{'us/hit':>9}{'bytes sent':>12}")
+    for name, data in cases.items():
+        old_blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        new_blob = pickle.dumps(caching.Entry(data, time.time() + 60), pickle.HIGHEST_PROTOCOL)
+
+        def old(compress):
+            body = renderer.render(pickle.loads(old_blob))
+            return HttpResponse(gzip.compress(body) if compress else body, content_type='application/json')
+
+        def new(request):
+            return caching.entry_response(request, pickle.loads(new_blob))
+
+        rows = [
+            ('dict', lambda: old(False)),
+            ('dict + gzip', lambda: old(True)),
+            ('bytes', lambda: new(plain)),
+            ('bytes, gzip', lambda: new(gzipped)),
+            ('bytes, br', lambda: new(brotli)),
+        ]
+        for i, (label, fn) in enumerate(rows):
+            print(f"{name if i == 0 else '':<28}{label:<16}{_per_hit_us(fn, args.rounds):>9.1f}{len(fn().content):>12,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+"""End-to-end load test: the frontend's request mixes, through Django, against a fake upstream.
+
+    python -m bench.e2e [--mix dashboard,artist_page,...] [--sessions 100]
+                        [--concurrency 8] [--users 20] [--artists 50]
+                        [--latency 0.02] [--error-rate 0] [--rate-429 0] [--budgets]
+                        [--baseline bench/e2e_baseline.json] [--save-baseline]
+
+One local server stands in for api.spotify.com, accounts.spotify.com,
+ws.audioscrobbler.com and musicbrainz.org (via UPSTREAM_HOST_OVERRIDES).
+Every call to it takes --latency seconds; --error-rate and --rate-429 of
+them fail with a 500, or a 429 with Retry-After: 1. Requests go through
+Django's test client from --concurrency threads, against a throwaway
+database and a two-tier cache with an in-memory L2. Each mix starts with
+an empty cache, so its hit ratio includes the cold start.
+
+The upstream budgets and MusicBrainz pacing are off unless --budgets is
+given; with them, throughput is bounded by the budgets, not the service.
+
+Mixes, one session each:
+  dashboard      Dashboard bootstrap: me, recently played, short-term top
+                 tracks and artists, currently playing
+  dashboard_api  the same through the aggregate /dashboard/ route
+  artist_page    ArtistProfile: artist, albums, Last.fm info and top tracks,
+                 10 track links, 5 similar artists (MBID link + artist)
+  artist_api     /artist_profile/, /similar_artist_images/ and
+                 /get_track_spotify_urls/ for the same page
+  polling        10 currently-playing polls (the frontend's 3-second poll)
+  all_routes     every route in api/urls.py once, except request_access
+                 (it sends an email)
+
+Reports requests/s, p50/p95/p99 latency, errors (5xx, and 4xx other than
+the expected ones), upstream calls per request and cache hit ratio per
+mix. --save-baseline writes them to --baseline; when that file exists,
+each mix is compared with it and regressions beyond --tolerance flagged.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from bench import payloads, setup_django
+from bench.fake_upstream import FakeUpstream
+
+
+HOSTS = ('api.spotify.com', 'accounts.spotify.com', 'ws.audioscrobbler.com', 'musicbrainz.org')
+SIMILAR = 5
+TOP_TRACKS = 10
+
+
+def _artist_n(text):
+    match = re.search(r'(\d+)', text or '')
+    return int(match.group(1)) if match else 0
+
+
+class FakeServices(FakeUpstream):
+    """The Spotify, Last.fm and MusicBrainz endpoints api/views.py calls."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_429=0.0, seed=0):
+        super().__init__(latency=latency)
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.random = random.Random(seed)
+        self.bodies = {}
+
+    def route(self, method, path):
+        roll = self.random.random()
+        if roll < self.rate_429:
+            return 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': '1'}
+        if roll < self.rate_429 + self.error_rate:
+            return 500, {'error': {'status': 500, 'message': 'Server error'}}
+
+        if method == 'PUT':
+            return 204, None
+        key = (method, path)
+        body = self.bodies.get(key)
+        if body is None:
+            status, payload = self.payload(method, path)
+            if status != 200:
+                return status, payload
+            body = self.bodies[key] = json.dumps(payload).encode()
+        return 200, body
+
+    def payload(self, method, path):
+        url = urlsplit(path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        p = url.path.rstrip('/')
+
+        if p == '/api/token':
+            return 200, {'access_token': 'bench-token', 'refresh_token': 'bench-refresh', 'expires_in': 3600}
+        if p == '/2.0':
+            return 200, self.last_fm(query.get('method'), query.get('artist', ''))
+        if p.startswith('/ws/2/artist/'):
+            n = _artist_n(p.rsplit('/', 1)[1])
+            return 200, {'relations': [
+                {'url': {'resource': f'https://www.wikidata.org/wiki/Q{n}'}},
+                {'url': {'resource': f"https://open.spotify.com/artist/{payloads.artist(n)['id']}"}},
+            ]}
+
+        if p == '/v1/me':
+            return 200, {'id': 'bench-user', 'display_name': 'Bench', 'email': 'bench@example.com',
+                         'images': [], 'country': 'SE', 'product': 'premium'}
+        if p == '/v1/me/top/tracks':
+            return 200, payloads.top_tracks()
+        if p == '/v1/me/top/artists':
+            return 200, payloads.page([payloads.artist(n, full=True) for n in range(50)], 'me/top/artists')
+        if p == '/v1/me/player/recently-played':
+            return 200, payloads.recently_played()
+        if p == '/v1/me/playlists':
+            return 200, payloads.playlists()
+        if p == '/v1/me/player/currently-playing':
+            return 200, {'is_playing': True, 'progress_ms': 1000, 'item': payloads.track(1),
+                         'device': {'id': 'device'}, 'currently_playing_type': 'track'}
+        if p == '/v1/me/player/devices':
+            return 200, {'devices': [{'id': 'device'}]}
+        if p == '/v1/artists':
+            return 200, {'artists': [payloads.artist(_artist_n(i), full=True) for i in query.get('ids', '').split(',')]}
+        if p.startswith('/v1/artists/') and p.endswith('/albums'):
+            return 200, payloads.page([payloads.album(n) for n in range(20)], 'artists/x/albums')
+        if p.startswith('/v1/artists/'):
+            return 200, payloads.artist(_artist_n(p.rsplit('/', 1)[1]), full=True)
+        if p == '/v1/search':
+            if query.get('type') == 'track':
+                return 200, {'tracks': payloads.page([payloads.track(_artist_n(query.get('q')))], 'search')}
+            return 200, payloads.search()
+        return 404, {'error': {'status': 404, 'message': f'no fake for {p}'}}
+
+    def last_fm(self, method, artist_name):
+        n = _artist_n(artist_name)
+        if method == 'artist.getInfo':
+            return {'artist': {
+                'name': artist_name, 'mbid': f'mb-{n}',
+                'stats': {'listeners': '1000', 'playcount': '5000'},
+                'similar': {'artist': [{'name': f'Artist {n + k}'} for k in range(1, SIMILAR + 1)]},
+                'bio': {'summary': 'A band. ' * 50},
+            }}
+        return {'toptracks': {'track': [
+            {'name': f'Track {n}-{k}', 'playcount': '100', 'artist': {'name': artist_name}}
+            for k in range(TOP_TRACKS)
+        ]}}
+
+
+# ─── Mixes ───────────────────────────────────────────────────────────────────
+#
+# A mix is a function (client, artist n) -> [(method, path, params, expected statuses)].
+
+OK = (200,)
+
+
+def dashboard(n):
+    return [
+        ('get', '/api/auth/spotify/me/', {}, OK),
+        ('get', '/api/get_recently_played_tracks/', {}, OK),
+        ('get', '/api/top_tracks/', {'time_range': 'short_term'}, OK),
+        ('get', '/api/top_artists/', {'time_range': 'short_term'}, OK),
+        ('get', '/api/get_currently_playing/', {}, OK),
+    ]
+
+
+def dashboard_api(n):
+    return [('get', '/api/dashboard/', {}, OK)]
+
+
+def artist_page(n):
+    artist_id = payloads.artist(n)['id']
+    name = f'Artist {n}'
+    calls = [
+        ('get', '/api/get_artist/', {'artist_id': artist_id}, OK),
+        ('get', '/api/get_artist_albums/', {'artist_id': artist_id}, OK),
+        ('get', '/api/get_artist_info_via_last_fm/', {'artist_name': name}, OK),
+        ('get', '/api/get_artist_top_tracks_via_last_fm/', {'artist_name': name}, OK),
+    ]
+    calls += [
+        ('get', '/api/get_track_spotify_url/', {'artist': name, 'track': f'Track {n}-{k}'}, OK)
+        for k in range(TOP_TRACKS)
+    ]
+    for k in range(1, SIMILAR + 1):
+        calls += [
+            ('get', '/api/get_similar_artist_links/', {'artist_mbid': f'mb-{n + k}'}, OK),
+            ('get', '/api/get_artist/', {'artist_id': payloads.artist(n + k)['id']}, OK),
+        ]
+    return calls
+
+
+def artist_api(n):
+    name = f'Artist {n}'
+    return [
+        ('get', '/api/artist_profile/', {'artist_id': payloads.artist(n)['id'], 'artist_name': name}, OK),
+        ('post', '/api/similar_artist_images/',
+         {'artists': [f'Artist {n + k}' for k in range(1, SIMILAR + 1)]}, OK),
+        ('post', '/api/get_track_spotify_urls/',
+         {'tracks': [{'artist': name, 'track': f'Track {n}-{k}'} for k in range(TOP_TRACKS)]}, OK),
+    ]
+
+
+def polling(n):
+    return [('get', '/api/get_currently_playing/', {}, OK)] * 10
+
+
+def all_routes(n):
+    artist_id = payloads.artist(n)['id']
+    name = f'Artist {n}'
+    return [
+        ('get', '/api/auth/spotify/login/', {}, (302,)),
+        ('get', '/api/auth/spotify/callback/', {'code': 'bench'}, (302,)),
+        ('get', '/api/auth/spotify/me/', {}, OK),
+        ('get', '/api/top_tracks/', {'time_range': 'long_term'}, OK),
+        ('get', '/api/top_artists/', {'time_range': 'long_term'}, OK),
+        ('post', '/api/play_track/', {'track_uri': payloads.track(n)['uri']}, OK),
+        ('post', '/api/logout/', {}, OK),
+        ('get', '/api/get_artist/', {'artist_id': artist_id}, OK),
+        ('get', '/api/get_my_playlists/', {}, OK),
+        ('get', '/api/get_artist_albums/', {'artist_id': artist_id}, OK),
+        ('get', '/api/get_artist_info_via_last_fm/', {'artist_name': name}, OK),
+        ('get', '/api/get_artist_top_tracks_via_last_fm/', {'artist_name': name}, OK),
+        ('get', '/api/get_similar_artist_links/', {'artist_mbid': f'mb-{n}'}, OK),
+        ('get', '/api/dashboard/', {}, OK),
+        ('get', '/api/artist_profile/', {'artist_id': artist_id}, OK),
+        ('post', '/api/similar_artist_images/', {'artists': [name]}, OK),
+        ('get', '/api/get_track_spotify_url/', {'artist': name, 'track': f'Track {n}-0'}, OK),
+        ('post', '/api/get_track_spotify_urls/', {'tracks': [{'artist': name, 'track': f'Track {n}-1'}]}, OK),
+        ('get', '/api/get_recently_played_tracks/', {}, OK),
+        ('get', '/api/call_next_api_url/',
+         {'next_url': 'https://api.spotify.com/v1/me/top/tracks?offset=50&limit=50'}, OK),
+        ('get', '/api/search_item/', {'q': name}, OK),
+        ('get', '/api/get_currently_playing/', {}, OK),
+        ('get', '/api/health_check/', {}, OK),
+        ('get', '/api/cache_stats/', {}, OK),
+        ('get', '/api/metrics/', {}, OK),
+    ]
+
+
+MIXES = {
+    'dashboard': dashboard,
+    'dashboard_api': dashboard_api,
+    'artist_page': artist_page,
+    'artist_api': artist_api,
+    'polling': polling,
+    'all_routes': all_routes,
+}
+
+
+# ─── Runner ──────────────────────────────────────────────────────────────────
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+def _session(client, calls):
+    results = []
+    for method, path, params, expected in calls:
+        start = time.perf_counter()
+        if method == 'get':
+            response = client.get(path, params)
+        else:
+            response = client.post(path, params, content_type='application/json')
+        results.append((path, response.status_code, time.perf_counter() - start, response.status_code in expected))
+    return results
+
+
+def run_mix(name, fake, clients, args):
+    from django.core.cache import cache
+    from django.db import connection
+
+    from api import caching
+
+    cache.clear()
+    fake.reset_counters()
+    before = caching.stats()['process']
+
+    # Artists are picked with a long tail, like real listening.
+    rng = random.Random(args.seed)
+    sessions = [
+        (clients[i % len(clients)], MIXES[name](int(rng.paretovariate(1.2)) % args.artists))
+        for i in range(args.sessions)
+    ]
+
+    def run(session):
+        try:
+            return _session(*session)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = [result for session in pool.map(run, sessions) for result in session]
+    elapsed = time.perf_counter() - start
+
+    after = caching.stats()['process']
+    hits = sum(after[k] - before[k] for k in ('hits', 'stale_hits'))
+    lookups = hits + after['misses'] - before['misses']
+    latencies = sorted(latency for _, _, latency, _ in results)
+    failed = [(path, status) for path, status, _, ok in results if not ok]
+
+    return {
+        'requests': len(results),
+        'rps': len(results) / elapsed,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'errors': len(failed),
+        'upstream_per_request': fake.requests / len(results),
+        'hit_ratio': hits / lookups if lookups else None,
+    }, failed
+
+
+def _print(name, m):
+    hit_ratio = f"{m['hit_ratio'] * 100:5.1f}%" if m['hit_ratio'] is not None else '    -'
+    print(
+        f"{name:<14} {m['rps']:8.1f} req/s  p50={m['p50_ms']:7.2f}ms  p95={m['p95_ms']:7.2f}ms  "
+        f"p99={m['p99_ms']:7.2f}ms  errors={m['errors']:<4}  upstream/req={m['upstream_per_request']:5.2f}  "
+        f"hits={hit_ratio}"
+    )
+
+
+def _compare(name, m, base, tolerance):
+    rps = m['rps'] / base['rps'] - 1
+    p95 = m['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+    upstream = m['upstream_per_request'] - base['upstream_per_request']
+    regressed = rps < -tolerance or p95 > tolerance or upstream > 0.01
+    print(
+        f"{'':<14} vs baseline: req/s {rps * 100:+6.1f}%  p95 {p95 * 100:+6.1f}%  "
+        f"upstream/req {upstream:+5.2f}{'  REGRESSION' if regressed else ''}"
+    )
+    return regressed
+
+
+def _users(count):
+    from datetime import timedelta
+
+    from django.contrib.auth.models import User
+    from django.test import Client
+    from django.utils import timezone
+    from rest_framework_simplejwt.tokens import RefreshToken
+
+    from api.models import SpotifyToken
+
+    clients = []
+    for n in range(count):
+        user = User.objects.create(username=f'bench-{n}')
+        SpotifyToken.objects.create(
+            user=user, access_token=f'token-{n}', refresh_token=f'refresh-{n}',
+            expires_at=timezone.now() + timedelta(hours=2),
+        )
+        jwt = RefreshToken.for_user(user).access_token
+        clients.append(Client(raise_request_exception=False, HTTP_AUTHORIZATION=f'Bearer {jwt}'))
+    return clients
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mix', default=','.join(MIXES), help=f"Comma-separated, of: {', '.join(MIXES)}")
+    parser.add_argument('--sessions', type=int, default=100, help="Sessions per mix.")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--artists', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds per upstream call.")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--budgets', action='store_true', help="Keep the upstream budgets and MusicBrainz pacing.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(__file__), 'e2e_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed req/s drop and p95 rise.")
+    args = parser.parse_args()
+
+    mixes = [name.strip() for name in args.mix.split(',') if name.strip()]
+    unknown = set(mixes) - set(MIXES)
+    if unknown:
+        parser.error(f"unknown mix: {', '.join(sorted(unknown))}")
+
+    os.environ.setdefault('FRONTEND_URL', 'http://localhost:5173')
+    setup_django()
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment
+
+    from api import upstream
+
+    setup_test_environment()
+    db_dir = tempfile.TemporaryDirectory()
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(db_dir.name, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    fake = FakeServices(latency=args.latency, error_rate=args.error_rate, rate_429=args.rate_429, seed=args.seed)
+    fake.start()
+    overrides = {
+        'UPSTREAM_HOST_OVERRIDES': {host: fake.url for host in HOSTS},
+        'CACHES': {
+            'default': {'BACKEND': 'api.cache_backends.TieredCache', 'LOCATION': 'bench', 'OPTIONS': {
+                'L2': 'shared', 'L1_BYPASS': ('lock-', 'stats-', 'spotify-token-', 'rl:', 'live-', 'budget-'),
+            }},
+            'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench-l2'},
+        },
+        'RATELIMIT_ENABLE': False,
+        'PREFETCH_ON_LOGIN': False,
+        'SPOTIFY_TOKEN_BACKGROUND_REFRESH': False,
+    }
+    if not args.budgets:
+        overrides.update(UPSTREAM_BUDGETS={}, MUSICBRAINZ_INTERVAL=0)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    try:
+        with override_settings(**overrides):
+            clients = _users(args.users)
+            print(f"{args.sessions} sessions per mix, {args.concurrency} threads, {args.users} users, "
+                  f"upstream latency {args.latency * 1000:.0f}ms")
+            for name in mixes:
+                results[name], failed = run_mix(name, fake, clients, args)
+                _print(name, results[name])
+                for path, status in sorted(set(failed))[:5]:
+                    print(f"{'':<14} {status} {path}")
+                if name in baseline and _compare(name, results[name], baseline[name], args.tolerance):
+                    regressions.append(name)
+    finally:
+        fake.stop()
+        upstream.close()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        db_dir.cleanup()
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        raise SystemExit(f"Regressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# ─── Local stand-in for the upstream APIs ────────────────────────────────────
+#
+# A keep-alive HTTP/1.1 server on 127.0.0.1. `connect_latency` is slept once
+# per accepted connection to stand in for the TCP+TLS handshake we pay
+# against the real hosts; `latency` is slept on every request.
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self):
+        upstream = self.server.upstream
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        with upstream.lock:
+            upstream.requests += 1
+
+        if upstream.latency:
+            time.sleep(upstream.latency)
+
+        # route() returns (status, payload) or (status, payload, headers);
+        # a bytes payload is sent as is.
+        status, payload, *headers = upstream.route(self.command, self.path)
+        if isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(payload).encode() if payload is not None else b''
+
+        self.send_response(status)
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _respond
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def finish_request(self, request, client_address):
+        with self.upstream.lock:
+            self.upstream.connections += 1
+        if self.upstream.connect_latency:
+            time.sleep(self.upstream.connect_latency)
+        super().finish_request(request, client_address)
+
+
+class FakeUpstream:
+    def __init__(self, latency=0.0, connect_latency=0.0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def route(self, method, path):
+        return 200, {'ok': True, 'path': path}
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.upstream = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
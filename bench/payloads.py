@@ -0,0 +1,140 @@
+"""Synthetic Spotify responses, shaped (and sized) like the real ones."""
+
+MARKETS = [f'{a}{b}' for a in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' for b in 'ABCDEFG'][:185]
+
+
+def _id(kind, n):
+    return f'{kind[:2]}{n:020d}'
+
+
+def _images(kind, n):
+    return [
+        {'url': f'https://i.scdn.co/image/{_id(kind, n)}{size}', 'height': size, 'width': size}
+        for size in (640, 300, 64)
+    ]
+
+
+def _object(kind, n, **extra):
+    object_id = _id(kind, n)
+    return {
+        'id': object_id,
+        'name': f'{kind.title()} {n}',
+        'type': kind,
+        'uri': f'spotify:{kind}:{object_id}',
+        'href': f'https://api.spotify.com/v1/{kind}s/{object_id}',
+        'external_urls': {'spotify': f'https://open.spotify.com/{kind}/{object_id}'},
+        **extra,
+    }
+
+
+def artist(n, full=False):
+    if not full:
+        return _object('artist', n)
+    return _object(
+        'artist', n,
+        images=_images('artist', n), genres=['indie pop', 'bedroom pop'],
+        followers={'href': None, 'total': 1000 + n}, popularity=60,
+    )
+
+
+def album(n):
+    return _object(
+        'album', n,
+        album_type='album', total_tracks=12, release_date='2021-05-14',
+        release_date_precision='day', available_markets=MARKETS,
+        images=_images('album', n), artists=[artist(n), artist(n + 1)],
+        is_playable=True,
+    )
+
+
+def track(n):
+    return _object(
+        'track', n,
+        album=album(n), artists=[artist(n), artist(n + 1)],
+        available_markets=MARKETS, disc_number=1, duration_ms=200000 + n,
+        explicit=False, external_ids={'isrc': f'USRC1{n:07d}'},
+        is_local=False, popularity=70, preview_url=None, track_number=n % 12 + 1,
+    )
+
+
+def playlist(n):
+    return _object(
+        'playlist', n,
+        collaborative=False, description='A playlist ' * 10, images=_images('playlist', n),
+        owner=_object('user', n, display_name=f'User {n}'), public=True,
+        snapshot_id='x' * 56, tracks={'href': 'https://api.spotify.com/v1/playlists/x/tracks', 'total': 40},
+        primary_color=None,
+    )
+
+
+def episode(n):
+    return _object(
+        'episode', n,
+        audio_preview_url='https://p.scdn.co/mp3-preview/' + 'x' * 40, description='An episode ' * 40,
+        html_description='<p>' + 'An episode ' * 40 + '</p>', duration_ms=3600000,
+        explicit=False, images=_images('episode', n), is_externally_hosted=False,
+        is_playable=True, languages=['en'], release_date='2024-01-01', release_date_precision='day',
+    )
+
+
+def show(n):
+    return _object(
+        'show', n,
+        available_markets=MARKETS, copyrights=[], description='A show ' * 40,
+        html_description='<p>' + 'A show ' * 40 + '</p>', explicit=False,
+        images=_images('show', n), is_externally_hosted=False, languages=['en'],
+        media_type='audio', publisher='Publisher', total_episodes=120,
+    )
+
+
+def audiobook(n):
+    return _object(
+        'audiobook', n,
+        authors=[{'name': 'Author'}], available_markets=MARKETS, copyrights=[],
+        description='An audiobook ' * 40, html_description='<p>' + 'An audiobook ' * 40 + '</p>',
+        edition='Unabridged', explicit=False, images=_images('audiobook', n),
+        languages=['en'], media_type='audio', narrators=[{'name': 'Narrator'}],
+        publisher='Publisher', total_chapters=30,
+    )
+
+
+def page(items, kind='me/top/tracks'):
+    return {
+        'href': f'https://api.spotify.com/v1/{kind}?offset=0&limit={len(items)}',
+        'items': items, 'limit': len(items), 'offset': 0, 'total': len(items) * 4,
+        'next': f'https://api.spotify.com/v1/{kind}?offset={len(items)}&limit={len(items)}',
+        'previous': None,
+    }
+
+
+def top_tracks(count=50):
+    return page([track(n) for n in range(count)])
+
+
+def recently_played(count=50):
+    return {
+        'items': [
+            {'track': track(n), 'played_at': '2024-01-01T00:00:00.000Z', 'context': None}
+            for n in range(count)
+        ],
+        'next': 'https://api.spotify.com/v1/me/player/recently-played?before=1&limit=50',
+        'cursors': {'after': '2', 'before': '1'},
+        'limit': count,
+        'href': 'https://api.spotify.com/v1/me/player/recently-played?limit=50',
+    }
+
+
+def playlists(count=50):
+    return page([playlist(n) for n in range(count)], 'me/playlists')
+
+
+def search(count=10):
+    return {
+        'tracks': page([track(n) for n in range(count)], 'search'),
+        'artists': page([artist(n, full=True) for n in range(count)], 'search'),
+        'albums': page([album(n) for n in range(count)], 'search'),
+        'playlists': page([playlist(n) for n in range(count)], 'search'),
+        'episodes': page([episode(n) for n in range(count)], 'search'),
+        'shows': page([show(n) for n in range(count)], 'search'),
+        'audiobooks': page([audiobook(n) for n in range(count)], 'search'),
+    }
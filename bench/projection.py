@@ -0,0 +1,62 @@
+"""What field projection saves per endpoint: cache bytes, JSON render time, response size.
+
+    python -m bench.projection [--rounds 200]
+"""
+import argparse
+import gzip
+import pickle
+import time
+
+from bench import payloads, setup_django
+
+
+def _render_ms(renderer, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        renderer.render(data)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.renderers import JSONRenderer
+
+    from api import projection
+
+    renderer = JSONRenderer()
+    endpoints = {
+        'top_tracks': (payloads.top_tracks(), projection.TOP_TRACKS),
+        'recently_played': (payloads.recently_played(), projection.RECENTLY_PLAYED),
+        'get_my_playlists': (payloads.playlists(), projection.PLAYLISTS),
+        'search_item': (payloads.search(), projection.SEARCH),
+    }
+
+    print(f"{'endpoint':<18}{'':>10}{'cache bytes':>13}{'render ms':>11}{'response':>11}{'gzipped':>10}")
+    for name, (full, fields) in endpoints.items():
+        start = time.perf_counter()
+        trimmed = projection.project(full, fields)
+        project_ms = (time.perf_counter() - start) * 1000
+
+        rows = {}
+        for label, data in (('full', full), ('projected', trimmed)):
+            body = renderer.render(data)
+            rows[label] = (
+                len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)),
+                _render_ms(renderer, data, args.rounds),
+                len(body),
+                len(gzip.compress(body)),
+            )
+            print(f"{name if label == 'full' else '':<18}{label:>10}{rows[label][0]:>13,}"
+                  f"{rows[label][1]:>11.3f}{rows[label][2]:>11,}{rows[label][3]:>10,}")
+
+        saved = [1 - p / f for f, p in zip(rows['full'], rows['projected'])]
+        print(f"{'':<18}{'saved':>10}{saved[0]:>13.0%}{saved[1]:>11.0%}{saved[2]:>11.0%}{saved[3]:>10.0%}"
+              f"   (projection itself: {project_ms:.3f}ms, once per upstream fetch)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""SQLite under several workers: SQLite's defaults against the settings in spotify/settings.py.
+
+    python -m bench.sqlite [--workers 4] [--threads 4] [--seconds 5]
+                           [--users 200] [--write-ratio 0.2]
+
+For each configuration, a fresh database file is migrated and seeded with
+--users users and tokens, then --workers processes (like gunicorn workers)
+with --threads threads each run requests for --seconds: a token read, or
+with --write-ratio a token write the way spotify_callback and a refresh do
+it (update_or_create, then save), with the connection handling of a real
+request in between (close_old_connections on start and finish).
+
+  defaults  rollback journal, synchronous=FULL, deferred transactions,
+            5s busy timeout, a new connection per request, no retries
+  tuned     WAL, synchronous=NORMAL, IMMEDIATE transactions, 20s busy
+            timeout, persistent connections, lock retries for token writes
+
+Reports reads/s, writes/s, p50/p99 read and write latency, and failed
+writes ("database is locked").
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+MODES = {
+    'defaults': {
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_TRANSACTION_MODE': '',
+        'SQLITE_BUSY_TIMEOUT': '5',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_KB': '2000',
+        'SQLITE_LOCK_RETRIES': '0',
+        'CONN_MAX_AGE': '0',
+    },
+    'tuned': {},
+}
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+def prepare(users):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from api.models import SpotifyToken
+
+    call_command('migrate', verbosity=0)
+    accounts = User.objects.bulk_create([User(username=f'bench-{n}') for n in range(users)])
+    SpotifyToken.objects.bulk_create([
+        SpotifyToken(user=user, access_token='token', refresh_token='refresh', expires_at=timezone.now())
+        for user in accounts
+    ])
+
+
+def work(args):
+    from datetime import timedelta
+
+    from django.contrib.auth.models import User
+    from django.db import OperationalError, close_old_connections
+    from django.utils import timezone
+
+    from api.models import SpotifyToken
+    from api.tokens import retry_locked
+
+    user_ids = list(User.objects.values_list('id', flat=True))
+    close_old_connections()
+    deadline = time.monotonic() + args.seconds
+
+    def run(seed):
+        rng = random.Random(seed)
+        reads, writes, failed = [], [], 0
+        while time.monotonic() < deadline:
+            close_old_connections()     # request_started
+            user_id = rng.choice(user_ids)
+            start = time.perf_counter()
+            try:
+                if rng.random() < args.write_ratio:
+                    token, _ = retry_locked(lambda: SpotifyToken.objects.update_or_create(
+                        user_id=user_id,
+                        defaults={'access_token': f'token-{seed}', 'expires_at': timezone.now() + timedelta(hours=1)},
+                    ))
+                    token.refresh_token = f'refresh-{seed}'
+                    retry_locked(token.save)
+                    writes.append(time.perf_counter() - start)
+                else:
+                    SpotifyToken.objects.get(user_id=user_id)
+                    reads.append(time.perf_counter() - start)
+            except OperationalError:
+                failed += 1
+            finally:
+                close_old_connections()     # request_finished
+        return reads, writes, failed
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(run, [os.getpid() * 100 + n for n in range(args.threads)]))
+    print(json.dumps({
+        'reads': [t for r, _, _ in results for t in r],
+        'writes': [t for _, w, _ in results for t in w],
+        'failed': sum(f for _, _, f in results),
+    }))
+
+
+def run_mode(name, args):
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ, **MODES[name],
+            'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3'),
+            'DJANGO_SECRET_KEY': 'bench',
+            'FRONTEND_URL': os.environ.get('FRONTEND_URL', 'http://localhost:5173'),
+        }
+        command = [sys.executable, '-m', 'bench.sqlite', '--users', str(args.users), '--threads', str(args.threads),
+                   '--seconds', str(args.seconds), '--write-ratio', str(args.write_ratio)]
+        subprocess.run(command + ['--prepare'], env=env, check=True)
+
+        workers = [
+            subprocess.Popen(command + ['--work'], env=env, stdout=subprocess.PIPE, text=True)
+            for _ in range(args.workers)
+        ]
+        reads, writes, failed = [], [], 0
+        for worker in workers:
+            out, _ = worker.communicate()
+            result = json.loads(out.strip().splitlines()[-1])
+            reads += result['reads']
+            writes += result['writes']
+            failed += result['failed']
+
+    reads.sort()
+    writes.sort()
+    print(
+        f"{name:<9} {len(reads) / args.seconds:9.0f} reads/s  {len(writes) / args.seconds:7.0f} writes/s  "
+        f"read p50={_percentile(reads, 0.5) * 1000:6.2f}ms p99={_percentile(reads, 0.99) * 1000:7.2f}ms  "
+        f"write p50={_percentile(writes, 0.5) * 1000:6.2f}ms p99={_percentile(writes, 0.99) * 1000:7.2f}ms  "
+        f"failed writes={failed}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', action='append', choices=list(MODES), help="Default: all of them.")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--work', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare or args.work:
+        from bench import setup_django
+        setup_django()
+        return prepare(args.users) if args.prepare else work(args)
+
+    print(f"{args.workers} processes x {args.threads} threads, {args.seconds:g}s, "
+          f"{args.write_ratio:.0%} writes over {args.users} users")
+    for name in args.mode or MODES:
+        run_mode(name, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Pooled upstream client vs. one-shot requests.get against the fake upstream.
+
+    python -m bench.upstream_client [--requests 500] [--concurrency 8]
+                                    [--latency 0.005] [--connect-latency 0.03]
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench import setup_django
+from bench.fake_upstream import FakeUpstream
+
+
+def _timed(fn, url):
+    start = time.perf_counter()
+    fn(url).raise_for_status()
+    return time.perf_counter() - start
+
+
+def _run(name, fn, upstream, total, concurrency):
+    upstream.reset_counters()
+    url = f"{upstream.url}/v1/me"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(lambda _: _timed(fn, url), range(total)))
+    elapsed = time.perf_counter() - start
+
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{name:<14} p50={statistics.median(latencies) * 1000:7.2f}ms "
+        f"p95={p95 * 1000:7.2f}ms  {total / elapsed:8.1f} req/s  "
+        f"connections={upstream.connections}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--connect-latency', type=float, default=0.03)
+    args = parser.parse_args()
+
+    setup_django()
+    from api import upstream as client
+
+    with FakeUpstream(latency=args.latency, connect_latency=args.connect_latency) as upstream:
+        _run('requests.get', requests.get, upstream, args.requests, args.concurrency)
+        _run('upstream.get', client.get, upstream, args.requests, args.concurrency)
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
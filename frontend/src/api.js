@@ -82,6 +82,16 @@ export const getTopArtists = (timeRange) => {
   });
 };
 
+// Spotify artist + albums and Last.fm info + top tracks in one round trip;
+// parts that failed are null, with the reason under `errors`.
+export const getArtistProfile = (artistID) => {
+  return api.get('/artist_profile/', {
+    params: {
+      artist_id: artistID
+    }
+  });
+};
+
 export const getSimilarArtists = (artistMBID) => {
   return api.get('/get_similar_artist_links/', {
     params: {
@@ -91,6 +101,18 @@ export const getSimilarArtists = (artistMBID) => {
 };
 
 
+// Spotify image + artist ID for up to 50 artist names in one request, resolved
+// server-side through Last.fm and MusicBrainz: { images: {name: url}, ids: {name: id} }.
+export const getSimilarArtistImages = (artistNames) => {
+  return api.post('/similar_artist_images/', { artists: artistNames });
+};
+
+// Spotify URL + artwork for up to 50 {artist, track} pairs in one request;
+// `results` keeps the order of `tracks`.
+export const getTrackSpotifyUrls = (tracks) => {
+  return api.post('/get_track_spotify_urls/', { tracks });
+};
+
 export const getTrackSpotifyUrl = (artistName, trackName) => {
   return api.get('/get_track_spotify_url/', {
     params: {
@@ -100,11 +122,120 @@ export const getTrackSpotifyUrl = (artistName, trackName) => {
   });
 };
 
+// Profile, recently played, top tracks and artists for `timeRange`, and the
+// currently playing track in one round trip; failed parts are null, with
+// the reason under `errors`.
+export const getDashboard = (timeRange) => {
+  return api.get('/dashboard/', {
+    params: {
+      time_range: timeRange
+    }
+  });
+};
+
 export const getMe = () => api.get('/auth/spotify/me/')
 export const getMyPlaylists = () => api.get('/get_my_playlists/')
 export const getRecentlyPlayedTracks = () => api.get('/get_recently_played_tracks/')
 export const getCurrentlyPLaying = () => api.get('/get_currently_playing/')
 
+// Server-pushed currently-playing updates (ASGI deployments only). Uses fetch
+// rather than EventSource so the JWT can go in the Authorization header. If
+// the stream isn't available, falls back to polling every 3 seconds.
+export const streamCurrentlyPlaying = (onData) => {
+  const controller = new AbortController()
+  let pollTimer = null
+
+  const poll = () => {
+    if (pollTimer) return
+    pollTimer = setInterval(async () => {
+      try {
+        const res = await getCurrentlyPLaying()
+        onData(res.data)
+      } catch (err) {
+        console.log('polling error', err)
+      }
+    }, 3000)
+  }
+
+  const listen = async () => {
+    const res = await fetch(`${API_BASE_URL}/currently_playing_stream/`, {
+      headers: { Authorization: `Bearer ${localStorage.getItem('access_token')}` },
+      signal: controller.signal,
+    })
+    if (!res.ok || !res.body) throw new Error(`stream unavailable (${res.status})`)
+
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    for (;;) {
+      const { value, done } = await reader.read()
+      if (done) break
+      buffer += value
+      const messages = buffer.split('\n\n')
+      buffer = messages.pop()
+      for (const message of messages) {
+        const data = message.split('\n').filter(line => line.startsWith('data:')).map(line => line.slice(5)).join('\n')
+        if (data) onData(JSON.parse(data))
+      }
+    }
+    throw new Error('stream closed')
+  }
+
+  listen().catch(err => {
+    if (controller.signal.aborted) return
+    console.log('currently playing stream error, polling instead', err)
+    poll()
+  })
+
+  return () => {
+    controller.abort()
+    clearInterval(pollTimer)
+  }
+}
+
+// Every item of a paged collection (`?all=1`), streamed as NDJSON so the
+// first items render before the last page is fetched. Calls onTotal(total)
+// once, onItems(items) for each batch that arrives, and onDone() or
+// onError(err) at the end. Returns a function that cancels the stream.
+export const streamAllPages = (path, params, { onTotal, onItems, onDone, onError }) => {
+  const controller = new AbortController()
+  const query = new URLSearchParams({ ...params, all: '1' })
+
+  const read = async () => {
+    const res = await fetch(`${API_BASE_URL}${path}?${query}`, {
+      headers: { Authorization: `Bearer ${localStorage.getItem('access_token')}` },
+      signal: controller.signal,
+    })
+    if (!res.ok || !res.body) throw new Error(`stream unavailable (${res.status})`)
+
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    for (;;) {
+      const { value, done } = await reader.read()
+      if (done) break
+      buffer += value
+      const lines = buffer.split('\n')
+      buffer = lines.pop()
+      const items = []
+      let failure = null
+      for (const line of lines) {
+        if (!line) continue
+        const message = JSON.parse(line)
+        if ('item' in message) items.push(message.item)
+        else if ('total' in message) onTotal?.(message.total)
+        else if (message.error) failure = new Error(message.error)
+      }
+      if (items.length) onItems(items)
+      if (failure) throw failure
+    }
+    onDone?.()
+  }
+
+  read().catch(err => {
+    if (!controller.signal.aborted) onError?.(err)
+  })
+  return () => controller.abort()
+}
+
 export const logoutUser = () => {
     localStorage.removeItem('access_token')
     localStorage.removeItem('refresh_token')
@@ -1,5 +1,5 @@
 import { useEffect, useState } from 'react'
-import { getArtist, getArtistAlbums, getArtistLASTFM, getArtistTopTracksLASTFM, getSimilarArtists, getTrackSpotifyUrl } from '../../api'
+import { getArtistProfile, getSimilarArtistImages, getTrackSpotifyUrls } from '../../api'
 import { useParams, useNavigate } from "react-router-dom"
 import './ArtistProfile.css'
 import Navbar from '../../components/Navbar/Navbar'
@@ -41,28 +41,11 @@ function ArtistAlbums({ album }) {
   )
 }
 
-function TopTrackCard({ track, delay = 0, token }) {
-  const [spotifyUrl, setSpotifyUrl] = useState(null)
-  const [loaded, setLoaded] = useState(false)
-  const [spotifyImg, setSpotifyImg] = useState(null)
-
-  useEffect(() => {
-    if (!track.name || !track.artist?.name || !token) return
-
-    const timer = setTimeout(() => {
-      getTrackSpotifyUrl(track.artist.name, track.name)
-        .then(res => {
-          const url = res.data?.spotify_url
-          const img = res.data?.image
-          setSpotifyUrl(url || null)
-          setSpotifyImg(img || null)
-        })
-        .catch(err => console.log("error fetching track spotify url", track.name, err))
-        .finally(() => setLoaded(true))
-    }, delay)
-
-    return () => clearTimeout(timer)
-  }, [track.name, track.artist?.name, delay, token])
+// `match` is the track's get_track_spotify_urls result; undefined while it loads.
+function TopTrackCard({ track, match }) {
+  const loaded = match !== undefined
+  const spotifyUrl = match?.spotify_url || null
+  const spotifyImg = match?.image || null
 
   if (loaded && !spotifyUrl) return null
 
@@ -103,6 +86,7 @@ function ArtistInfo({ artistInfo, artistImg }) {
   const [bioExpanded, setBioExpanded] = useState(false)
   const [wikiImage, setWikiImage] = useState(null)
   const [similarWikiImages, setSimilarWikiImages] = useState({})
+  const [similarIds, setSimilarIds] = useState({})
 
   const data = artistInfo?.artist
 
@@ -147,44 +131,37 @@ function ArtistInfo({ artistInfo, artistImg }) {
     if (!data?.name) return
 
     async function fetchSimilarArtistImages() {
-      const similarArtists = data.similar?.artist || []
-      const results = {}
+      const names = (data.similar?.artist || []).map(a => a.name).filter(Boolean)
+      if (!names.length) return
 
-      await Promise.all(
-        similarArtists.map(async (a) => {
+      // Spotify images and IDs for every similar artist come from one request;
+      // a Wikipedia thumbnail still wins where there is one.
+      const [wikiImages, spotify] = await Promise.all([
+        Promise.all(names.map(async (name) => {
           try {
             const res = await fetch(
-              `https://en.wikipedia.org/api/rest_v1/page/summary/${encodeURIComponent(a.name)}`
+              `https://en.wikipedia.org/api/rest_v1/page/summary/${encodeURIComponent(name)}`
             )
             const json = await res.json()
-            if (json.thumbnail?.source) {
-              results[a.name] = json.thumbnail.source
-              return
-            }
-          } catch { /* fall through */ }
-
-          try {
-            const lfm = await getArtistLASTFM(a.name)
-            const mbid = lfm.data?.artist?.mbid
-            if (!mbid) return
-
-            const mbRes = await getSimilarArtists(mbid)
-            const spotifyUrl = mbRes.data?.spotify_url
-            if (!spotifyUrl) return
-
-            const spotifyID = spotifyUrl.split('/').pop()?.split('?')[0]
-            if (!spotifyID) return
-
-            const spotifyRes = await getArtist(spotifyID)
-            results[a.name] = spotifyRes.data?.images?.[0]?.url || null
-          } catch (err) {
-            console.log('error fetching similar artist image', a.name, err)
-            results[a.name] = null
+            return json.thumbnail?.source || null
+          } catch {
+            return null
           }
-        })
-      )
+        })),
+        getSimilarArtistImages(names.slice(0, 50))
+          .then(res => res.data)
+          .catch(err => {
+            console.log('error fetching similar artist images', err)
+            return {}
+          }),
+      ])
 
+      const results = {}
+      names.forEach((name, i) => {
+        results[name] = wikiImages[i] || spotify.images?.[name] || null
+      })
       setSimilarWikiImages(results)
+      setSimilarIds(spotify.ids || {})
     }
 
     fetchSimilarArtistImages()
@@ -271,6 +248,7 @@ function ArtistInfo({ artistInfo, artistImg }) {
                 key={a.name}
                 artist={a}
                 image={similarWikiImages[a.name] || a.image || null}
+                artistId={similarIds[a.name]}
               />
             ))}
           </div>
@@ -290,36 +268,14 @@ function ArtistInfo({ artistInfo, artistImg }) {
   )
 }
 
-function SimilarArtistChip({ artist, image }) {
-  const [spotifyUrl, setSpotifyUrl] = useState(null)
-  const [loaded, setLoaded] = useState(false)
+// `artistId` is the artist's Spotify ID from similar_artist_images, if it has one.
+function SimilarArtistChip({ artist, image, artistId }) {
   const navigate = useNavigate()
 
-
-  useEffect(() => {
-    if (!artist.name) return
-    getArtistLASTFM(artist.name)
-      .then(res => {
-        const mbid = res.data?.artist?.mbid
-        if (!mbid) return
-        return getSimilarArtists(mbid)
-      })
-      .then(res => {
-        const url = res?.data?.spotify_url
-        if (url) {
-          // extract ID from https://open.spotify.com/artist/7gW0r5CkdEUMm42w9XpyZO
-          const artistId = url.split('/artist/')[1]?.split('?')[0]
-          if (artistId) setSpotifyUrl(`/artist/${artistId}`)
-        }
-      })
-      .catch(err => console.log("error fetching similar artist spotify url", artist.name, err))
-      .finally(() => setLoaded(true))
-  }, [artist.name])
-
-  if (!loaded || !spotifyUrl) return null
+  if (!artistId) return null
 
   return (
-    <div onClick={() => navigate(spotifyUrl)} className="ai-similar-chip">
+    <div onClick={() => navigate(`/artist/${artistId}`)} className="ai-similar-chip">
       {image
         ? <img className="ai-similar-img" src={image} alt={artist.name} />
         : <div className="ai-similar-placeholder">🎵</div>
@@ -336,21 +292,19 @@ function ArtistProfile() {
   const [albums, setAlbums] = useState([])
   const [artistInfo, setArtistInfo] = useState(null)
   const [artistTopTracks, setArtistTopTracks] = useState(null)
-  const [token, setToken] = useState(localStorage.getItem('access_token'))
+  const [trackMatches, setTrackMatches] = useState({})
 
 
   useEffect(() => {
     setLoading(true)
-    Promise.all([getArtist(artistID), getArtistAlbums(artistID)])
-      .then(([ArtRes, AlbRes]) => {
-        const artistData = ArtRes.data
-        setArtist(artistData)
-        setAlbums(AlbRes.data.items || [])
-        return Promise.all([getArtistLASTFM(artistData.name), getArtistTopTracksLASTFM(artistData.name)])
-      })
-      .then(([ArtistlastFmRes, ArtistTopTrackslastFmRes]) => {
-        setArtistInfo(ArtistlastFmRes.data)
-        setArtistTopTracks(ArtistTopTrackslastFmRes.data)
+    getArtistProfile(artistID)
+      .then(res => {
+        const { artist, albums, artist_info, top_tracks, errors } = res.data
+        if (Object.keys(errors || {}).length) console.log('artist profile errors', errors)
+        setArtist(artist)
+        setAlbums(albums?.items || [])
+        setArtistInfo(artist_info)
+        setArtistTopTracks(top_tracks)
       })
       .catch(err => console.log('error', err))
       .finally(() => setLoading(false))
@@ -359,6 +313,29 @@ function ArtistProfile() {
 
   const topTracks = artistTopTracks?.toptracks?.track || []
 
+  // One batch lookup for every card instead of a request per card.
+  useEffect(() => {
+    const tracks = topTracks
+      .filter(t => t.name && t.artist?.name)
+      .slice(0, 50)
+      .map(t => ({ artist: t.artist.name, track: t.name }))
+    if (!tracks.length) return
+
+    setTrackMatches({})
+    getTrackSpotifyUrls(tracks)
+      .then(res => {
+        const matches = {}
+        for (const result of res.data?.results || []) {
+          matches[`${result.artist}-${result.track}`] = result
+        }
+        setTrackMatches(matches)
+      })
+      .catch(err => {
+        console.log("error fetching track spotify urls", err)
+        setTrackMatches(Object.fromEntries(tracks.map(t => [`${t.artist}-${t.track}`, null])))
+      })
+  }, [artistTopTracks])
+
   return (
     <>      
       <Navbar />
@@ -424,8 +401,7 @@ function ArtistProfile() {
                   <TopTrackCard
                     key={`${t.name}-${t.artist?.name}-${i}`}
                     track={t}
-                    delay={i * 240}
-                    token={token}
+                    match={trackMatches[`${t.artist?.name}-${t.name}`]}
                   />
                 ))}
               </div>
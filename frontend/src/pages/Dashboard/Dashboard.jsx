@@ -1,6 +1,6 @@
 import { useEffect, useState, useMemo } from 'react'
 import { useNavigate, useParams } from 'react-router-dom'
-import { getTopTracks, getMe, logoutUser, playTrack, getRecentlyPlayedTracks, callNextApiUrl, getTopArtists, getCurrentlyPLaying } from '../../api'
+import { getTopTracks, getDashboard, logoutUser, playTrack, callNextApiUrl, streamCurrentlyPlaying } from '../../api'
 import './Dashboard.css'
 import Navbar from '../../components/Navbar/Navbar'
 import Loading from '../../components/Loading/Loading'
@@ -432,36 +432,28 @@ function Dashboard() {
   };
 
   useEffect(() => {
-    Promise.all([getMe(), getRecentlyPlayedTracks(), getTopTracks('short_term'), getTopArtists('short_term'), getCurrentlyPLaying() ])
-      .then(([meRes, recentlyRes, topTracksRes, topArtRes, curPlayRes]) => {
-        setProfile(meRes.data)
-        setRecentlyPlayed(recentlyRes.data?.items || [])
-        setNextUrl(recentlyRes.data?.next || null)
-        setCurrentlyPlaying(curPlayRes.data)
-
-        const TTM = topTracksRes.data?.items.slice(0, 10) ?? []
+    getDashboard('short_term')
+      .then(res => {
+        const { me, recently_played, top_tracks, top_artists, currently_playing, errors } = res.data
+        if (Object.keys(errors || {}).length) console.log("dashboard errors", errors)
+        setProfile(me)
+        setRecentlyPlayed(recently_played?.items || [])
+        setNextUrl(recently_played?.next || null)
+        setCurrentlyPlaying(currently_playing)
+
+        const TTM = top_tracks?.items?.slice(0, 10) ?? []
         const shuffled_tts = TTM.sort(() => Math.random() - 0.5).slice(0, 5)
         setTopTracksThisMonth(shuffled_tts)
 
-        const ATM = topArtRes.data?.items.slice(0, 10) ?? []
+        const ATM = top_artists?.items?.slice(0, 10) ?? []
         const shuffled_artist = ATM.sort(() => Math.random() - 0.5).slice(0, 5)
         setTopArtistThisMonth(shuffled_artist)
       })
       .catch(err => console.log("error", err))
   }, [])
 
-  // Poll every 3 seconds
-  useEffect(() => {
-    const interval = setInterval(async () => {
-      try {
-        const res = await getCurrentlyPLaying();
-        setCurrentlyPlaying(res.data);
-      } catch (err) {
-        console.log('polling error', err);
-      }
-    }, 3000);
-    return () => clearInterval(interval);
-  }, []);
+  // Pushed by the server when the track, device or play state changes
+  useEffect(() => streamCurrentlyPlaying(setCurrentlyPlaying), []);
 
 
   useEffect(() => {
@@ -1,5 +1,5 @@
 import { useEffect, useState } from 'react'
-import { getMyPlaylists } from '../../api'
+import { getMyPlaylists, streamAllPages } from '../../api'
 import Navbar from '../../components/Navbar/Navbar'
 import './MyPlaylists.css'
 import '../../index.css'
@@ -50,10 +50,26 @@ function MyPlaylists() {
 
   useEffect(() => {
     setLoading(true)
-    getMyPlaylists()
-      .then((res) => setPlaylists(res.data))
-      .catch(err => console.log("error", err))
-      .finally(() => setLoading(false))
+    setPlaylists({ total: 0, items: [] })
+    let received = false
+    return streamAllPages('/get_my_playlists/', {}, {
+      onTotal: (total) => setPlaylists(current => ({ ...current, total })),
+      onItems: (items) => {
+        received = true
+        setPlaylists(current => ({ ...current, items: [...current.items, ...items] }))
+        setLoading(false)
+      },
+      onDone: () => setLoading(false),
+      onError: (err) => {
+        console.log("playlists stream error", err)
+        // Keep what arrived; with nothing at all, fall back to the first page.
+        if (received) return setLoading(false)
+        getMyPlaylists()
+          .then((res) => setPlaylists(res.data))
+          .catch(err => console.log("error", err))
+          .finally(() => setLoading(false))
+      },
+    })
   }, [])
 
   if (loading) return (
@@ -3,6 +3,15 @@ ASGI config for spotify project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The Spotify proxy routes are served by the async views in api/async_views.py,
+so a single worker can keep many upstream requests in flight:
+
+    gunicorn spotify.asgi:application -k uvicorn.workers.UvicornWorker
+
+Database connections aren't kept between requests here (CONN_MAX_AGE=0):
+Django runs an async view's ORM calls on threads that don't outlive the
+request, so a persistent connection would only be left open, not reused.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -12,5 +21,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'spotify.settings')
+os.environ.setdefault('API_ASYNC_VIEWS', 'True')
+os.environ.setdefault('CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
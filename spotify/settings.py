@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.timing.TimingMiddleware',
+    'api.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware', 
@@ -73,10 +75,41 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'spotify.wsgi.application'
 
+# SQLite, set up for several workers. WAL lets reads go on while one
+# connection writes; IMMEDIATE transactions take the write lock when they
+# start, since a deferred one that reads and then writes fails at once with
+# "database is locked" if another writer got in between. A writer waits up
+# to SQLITE_BUSY_TIMEOUT seconds for the lock. Under WSGI (spotify/wsgi.py)
+# connections are kept for CONN_MAX_AGE seconds instead of opened per
+# request; spotify/asgi.py sets it to 0, as Django advises for ASGI.
+# bench/sqlite.py compares this with SQLite's defaults.
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+# NORMAL is safe with WAL: a power loss can lose the last commits, not corrupt.
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20))
+SQLITE_TRANSACTION_MODE = os.environ.get('SQLITE_TRANSACTION_MODE', 'IMMEDIATE') or None
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 128 * 1024 * 1024))
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 32 * 1024))
+# Token writes that still find the database locked are retried this many times.
+SQLITE_LOCK_RETRIES = int(os.environ.get('SQLITE_LOCK_RETRIES', 3))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+            'transaction_mode': SQLITE_TRANSACTION_MODE,
+            'init_command': ';'.join([
+                f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}',
+                f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}',
+                'PRAGMA temp_store=MEMORY',
+                f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}',
+                f'PRAGMA cache_size=-{SQLITE_CACHE_KB}',
+            ]),
+        },
     }
 }
 
@@ -112,7 +145,7 @@ CORS_ALLOW_CREDENTIALS = True
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.JWTAuthentication',
     ),
 }
 
@@ -121,11 +154,158 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
 }
 
+# Two tiers (api/cache_backends.py): a per-process LRU bounded by bytes in
+# front of the shared cache every worker sees. The default L2 is a file cache
+# whose add() and incr() are atomic across the workers of one machine, which
+# the cache locks and upstream budgets need. Point CACHE_L2_BACKEND at
+# django.core.cache.backends.redis.RedisCache (and CACHE_L2_LOCATION at the
+# redis URL) to share it across machines. Django's own FileBasedCache can't
+# be used with more than one worker: two of them can win the same add().
+# FileCache culls down from MAX_ENTRIES once every CULL_INTERVAL seconds per
+# worker rather than listing the directory on every write.
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": "/tmp/django_cache",
-    }
+        "BACKEND": "api.cache_backends.TieredCache",
+        "OPTIONS": {
+            "L2": "shared",
+            "L1_MAX_BYTES": int(os.environ.get('CACHE_L1_MAX_BYTES', 64 * 1024 * 1024)),
+            "L1_TIMEOUT": int(os.environ.get('CACHE_L1_TIMEOUT', 60)),
+            "L1_BYPASS": ("lock-", "stats-", "spotify-token-", "rl:", "live-", "budget-"),
+        },
+    },
+    "shared": {
+        "BACKEND": os.environ.get('CACHE_L2_BACKEND', "api.cache_backends.FileCache"),
+        "LOCATION": os.environ.get('CACHE_L2_LOCATION', "/tmp/django_cache"),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.environ.get('CACHE_L2_MAX_ENTRIES', 100000)),
+            "CULL_INTERVAL": int(os.environ.get('CACHE_L2_CULL_INTERVAL', 60)),
+        },
+    },
 }
 
 RATELIMIT_VIEW = 'api.views.ratelimit_error'
+
+# Request coalescing (api/caching.py): how long concurrent misses wait for the
+# fetching caller, and how long its shared-cache lock lives if it dies.
+CACHE_COALESCE_WAIT = float(os.environ.get('CACHE_COALESCE_WAIT', 5))
+CACHE_COALESCE_LOCK_TTL = int(os.environ.get('CACHE_COALESCE_LOCK_TTL', 15))
+
+# ─── Upstream HTTP client (api/upstream.py) ─────────────────────────────────
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 10))
+UPSTREAM_POOL_SIZES = {
+    'api.spotify.com': int(os.environ.get('SPOTIFY_POOL_MAXSIZE', 20)),
+}
+
+# Max concurrent upstream calls a single request may fan out to.
+UPSTREAM_FANOUT = int(os.environ.get('UPSTREAM_FANOUT', 8))
+
+UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_ASYNC_MAX_CONNECTIONS', 1000))
+UPSTREAM_ASYNC_MAX_KEEPALIVE = int(os.environ.get('UPSTREAM_ASYNC_MAX_KEEPALIVE', 100))
+
+# Shared call budgets per host (api/budget.py): at most `app` calls per
+# `window` seconds from all workers together, and `token` per access token.
+# A 429 pauses the host for its Retry-After (`retry_after` if it sent none).
+UPSTREAM_BUDGETS = {
+    'api.spotify.com': {
+        'window': 30,
+        'app': int(os.environ.get('SPOTIFY_BUDGET_APP', 900)),
+        'token': int(os.environ.get('SPOTIFY_BUDGET_TOKEN', 180)),
+        'retry_after': 5,
+    },
+    # About one request a second per client, from all workers together.
+    'musicbrainz.org': {'window': 1, 'app': 1, 'retry_after': 5},
+}
+# Longest a call waits for budget before it gets a local 429 instead.
+UPSTREAM_BUDGET_MAX_WAIT = float(os.environ.get('UPSTREAM_BUDGET_MAX_WAIT', 2))
+
+# MusicBrainz lookup queue (api/musicbrainz.py): seconds between calls from
+# one worker, and how long a request waits for its lookups to come back.
+MUSICBRAINZ_INTERVAL = float(os.environ.get('MUSICBRAINZ_INTERVAL', 1.1))
+MUSICBRAINZ_WAIT = float(os.environ.get('MUSICBRAINZ_WAIT', 10))
+MUSICBRAINZ_BATCH_WAIT = float(os.environ.get('MUSICBRAINZ_BATCH_WAIT', 2))
+
+# ─── Logging ─────────────────────────────────────────────────────────────────
+
+# Modules under api/ that use `logging` (api/musicbrainz.py) write to stderr,
+# prefixed with their name, from INFO up.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {'api': {'format': '[%(name)s] %(levelname)s %(message)s'}},
+    'handlers': {'api': {'class': 'logging.StreamHandler', 'formatter': 'api'}},
+    'loggers': {'api': {'handlers': ['api'], 'level': os.environ.get('API_LOG_LEVEL', 'INFO'), 'propagate': False}},
+}
+
+# ─── Post-login prefetch (api/prefetch.py) ──────────────────────────────────
+
+PREFETCH_ON_LOGIN = os.environ.get('PREFETCH_ON_LOGIN', 'True') == 'True'
+# A user logging in again within this many seconds isn't prefetched again.
+PREFETCH_COOLDOWN = int(os.environ.get('PREFETCH_COOLDOWN', 600))
+# How many of the user's top artists get their artist page entries warmed.
+PREFETCH_TOP_ARTISTS = int(os.environ.get('PREFETCH_TOP_ARTISTS', 5))
+# Upstream calls one prefetch makes at a time.
+PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 3))
+
+# Serve the Spotify proxy routes with the async views (api/async_views.py).
+# spotify/asgi.py turns this on.
+API_ASYNC_VIEWS = os.environ.get('API_ASYNC_VIEWS', 'False') == 'True'
+
+# ─── Spotify access-token cache (api/tokens.py) ─────────────────────────────
+
+# Refresh tokens this many seconds before they expire, off the request thread.
+SPOTIFY_TOKEN_REFRESH_AHEAD = int(os.environ.get('SPOTIFY_TOKEN_REFRESH_AHEAD', 300))
+# How long a worker trusts its process-local copy before re-reading the shared cache.
+SPOTIFY_TOKEN_LOCAL_TTL = int(os.environ.get('SPOTIFY_TOKEN_LOCAL_TTL', 30))
+SPOTIFY_TOKEN_BACKGROUND_REFRESH = os.environ.get('SPOTIFY_TOKEN_BACKGROUND_REFRESH', 'True') == 'True'
+SPOTIFY_TOKEN_SWEEP_INTERVAL = int(os.environ.get('SPOTIFY_TOKEN_SWEEP_INTERVAL', 60))
+SPOTIFY_TOKEN_ACTIVE_WINDOW = int(os.environ.get('SPOTIFY_TOKEN_ACTIVE_WINDOW', 60*30))
+# Single-flight refresh: how long other callers wait for the refreshing one,
+# and how long the cross-worker refresh lock lives if its holder dies.
+SPOTIFY_TOKEN_REFRESH_WAIT = float(os.environ.get('SPOTIFY_TOKEN_REFRESH_WAIT', 5))
+SPOTIFY_TOKEN_REFRESH_LOCK_TTL = int(os.environ.get('SPOTIFY_TOKEN_REFRESH_LOCK_TTL', 30))
+
+# ─── Currently-playing stream (api/streams.py, ASGI only) ───────────────────
+
+# Seconds between Spotify checks when nothing is playing, when paused, and at
+# most while playing (otherwise it waits for the end of the track).
+NOW_PLAYING_IDLE_INTERVAL = float(os.environ.get('NOW_PLAYING_IDLE_INTERVAL', 15))
+NOW_PLAYING_PAUSED_INTERVAL = float(os.environ.get('NOW_PLAYING_PAUSED_INTERVAL', 5))
+NOW_PLAYING_MAX_INTERVAL = float(os.environ.get('NOW_PLAYING_MAX_INTERVAL', 8))
+NOW_PLAYING_MIN_INTERVAL = float(os.environ.get('NOW_PLAYING_MIN_INTERVAL', 1))
+# Keep-alive comment on idle streams, so proxies don't close them.
+NOW_PLAYING_HEARTBEAT = float(os.environ.get('NOW_PLAYING_HEARTBEAT', 15))
+
+# ─── Metrics (api/metrics.py, served at /api/metrics/) ──────────────────────
+
+# How often each worker publishes its totals to the shared cache, and how many
+# workers (slots) /api/metrics/ adds up.
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', 10))
+METRICS_MAX_WORKERS = int(os.environ.get('METRICS_MAX_WORKERS', 64))
+# /api/metrics/ and /api/cache_stats/ answer requests with
+# `Authorization: Bearer <METRICS_TOKEN>` (set it as Prometheus' bearer_token)
+# and staff users; everyone else gets a 403. Unset, only staff get in.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# ─── Server-Timing and profiling (api/timing.py) ────────────────────────────
+
+# Send each request's phase timings (auth, token, db, cache, upstream...) in a
+# Server-Timing header. Off unless DEBUG: it shows anyone how the backend
+# spends its time. Staff requests that ask for a profile get it regardless.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', str(DEBUG)) == 'True'
+# Profile requests from staff users that send `X-Profile: 1`, and this
+# fraction of all requests. Folded stacks for flame graphs go to PROFILE_DIR.
+PROFILE_STAFF = os.environ.get('PROFILE_STAFF', 'True') == 'True'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/spontify-profiles')
+
+# ─── "All pages" streaming (api/paging.py, `?all=1`) ────────────────────────
+
+# Items per page asked of Spotify (50 is its maximum), pages fetched at once,
+# and the most items one stream sends.
+PAGES_LIMIT = int(os.environ.get('PAGES_LIMIT', 50))
+PAGES_WINDOW = int(os.environ.get('PAGES_WINDOW', 4))
+PAGES_MAX_ITEMS = int(os.environ.get('PAGES_MAX_ITEMS', 5000))